@@ -0,0 +1,69 @@
+"""
+Measures the cost per commit of `branch history` and of finding the lowest
+common ancestor of two branches, for commit format 1 and 2. Needs a running
+IPFS daemon.
+
+    python benchmarks/bench_history.py --commits 100
+"""
+import sys
+import time
+import shutil
+import argparse
+from pathlib import Path
+
+from ipvc import IPVC
+import ipvc.common
+
+NAMESPACE = Path('/bench')
+REPO = Path('/tmp/ipvc_bench/repo')
+
+
+def make_repo(num_commits):
+    shutil.rmtree(REPO, ignore_errors=True)
+    REPO.mkdir(parents=True)
+    api = IPVC(REPO, NAMESPACE, delete_mfs=True, cache_size=0, quieter=True)
+    api.repo.init()
+    for i in range(num_commits):
+        if i == num_commits // 2:
+            api.branch.create('other', no_checkout=True)
+        with open(REPO / 'file.txt', 'w') as f:
+            f.write(f'commit number {i}\n')
+        api.stage.add()
+        api.stage.commit(f'commit {i}')
+    return api
+
+
+def measure(api, num_commits, label):
+    head = api.ipfs.files_stat(
+        api.branch.get_mfs_path(REPO, 'master', branch_info='head'))['Hash']
+    other_head = api.ipfs.files_stat(
+        api.branch.get_mfs_path(REPO, 'other', branch_info='head'))['Hash']
+
+    for name, fn, n in [
+            ('history', lambda: api.branch.history(), num_commits),
+            ('LCA', lambda: api.branch._find_LCA(head, other_head),
+             num_commits - num_commits // 2)]:
+        ipvc.common._COMMIT_METADATA_CACHE.clear()
+        api.tracer.reset()
+        t0 = time.time()
+        fn()
+        elapsed = time.time() - t0
+        calls = sum(api.tracer.call_counts.values())
+        print(f'format {label} {name:8} {1000 * elapsed / n:8.3f}ms per commit  '
+              f'{calls / n:6.2f} daemon calls per commit')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--commits', type=int, default=50)
+    args = parser.parse_args()
+
+    api = make_repo(args.commits)
+    measure(api, args.commits, 1)
+    api.repo.migrate(2)
+    measure(api, args.commits, 2)
+    shutil.rmtree(REPO, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
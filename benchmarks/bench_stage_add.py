@@ -0,0 +1,57 @@
+"""
+Compares bulk `stage add` with MFS mutations flushed on every call and with
+flushing deferred to the end of the command. Needs a running IPFS daemon.
+
+    python benchmarks/bench_stage_add.py --files 500
+"""
+import sys
+import time
+import shutil
+import argparse
+from pathlib import Path
+
+from ipvc import IPVC
+
+NAMESPACE = Path('/bench')
+REPO = Path('/tmp/ipvc_bench/repo')
+
+
+def run(num_files, depth, defer_flush):
+    shutil.rmtree(REPO, ignore_errors=True)
+    REPO.mkdir(parents=True)
+    ipvc = IPVC(REPO, NAMESPACE, delete_mfs=True, cache_size=0,
+                defer_flush=defer_flush, quieter=True)
+    ipvc.repo.init()
+
+    fs_dir = REPO.joinpath(*[f'dir{i}' for i in range(depth)])
+    fs_dir.mkdir(parents=True, exist_ok=True)
+    for i in range(num_files):
+        with open(fs_dir / f'file{i}.txt', 'w') as f:
+            f.write(f'file number {i}\n')
+
+    mutations_before = ipvc.mfs_mutation_count
+    t0 = time.time()
+    ipvc.stage.add(REPO)
+    elapsed = time.time() - t0
+    mutations = ipvc.mfs_mutation_count - mutations_before
+    shutil.rmtree(REPO, ignore_errors=True)
+    return elapsed, mutations
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--files', type=int, default=200)
+    parser.add_argument('--depth', type=int, default=5)
+    args = parser.parse_args()
+
+    print(f'stage add of {args.files} files at depth {args.depth}')
+    for defer_flush in [False, True]:
+        elapsed, mutations = run(args.files, args.depth, defer_flush)
+        per_mutation = 1000 * elapsed / max(mutations, 1)
+        label = 'deferred flush' if defer_flush else 'flush per call'
+        print(f'{label:15} {elapsed:8.3f}s  {mutations:6} mutations  '
+              f'{per_mutation:8.3f}ms per mutation')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
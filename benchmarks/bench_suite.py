@@ -0,0 +1,145 @@
+"""
+End-to-end benchmark of ipvc commands on a synthetic repo (see synthetic.py).
+Times repo init, stage add, commit, status, checkout, merge, replay, history
+and diff, and writes the results as JSON so they can be tracked over releases.
+Runs on the local store backend by default, so it needs no IPFS daemon or
+network.
+
+    python benchmarks/bench_suite.py --files 500 --commits 30 --output results.json
+"""
+import sys
+import json
+import time
+import shutil
+import tempfile
+import platform
+import argparse
+from pathlib import Path
+from collections import defaultdict
+
+import ipvc
+from ipvc import IPVC
+from synthetic import RepoSpec, SyntheticRepo
+
+NAMESPACE = Path('/bench')
+
+
+class Recorder:
+    """ Collects the wall time and the number of backend calls of each run of
+    the timed operations """
+    def __init__(self, api):
+        self.api = api
+        self.samples = defaultdict(list)
+
+    def time(self, name, fn, *args, **kwargs):
+        calls_before = sum(self.api.tracer.call_counts.values())
+        t0 = time.perf_counter()
+        ret = fn(*args, **kwargs)
+        elapsed = time.perf_counter() - t0
+        calls = sum(self.api.tracer.call_counts.values()) - calls_before
+        self.samples[name].append((elapsed, calls))
+        return ret
+
+    def results(self):
+        results = {}
+        for name, samples in self.samples.items():
+            times = sorted(t for t, _ in samples)
+            results[name] = {
+                'runs': len(samples),
+                'total_s': sum(times),
+                'mean_s': sum(times) / len(times),
+                'median_s': times[len(times) // 2],
+                'min_s': times[0],
+                'max_s': times[-1],
+                'mean_backend_calls': sum(c for _, c in samples) / len(samples),
+            }
+        return results
+
+
+def run(spec, fs_repo, backend, store_dir):
+    repo = SyntheticRepo(fs_repo, spec)
+    repo.generate()
+    api = IPVC(fs_repo, NAMESPACE, delete_mfs=True, cache_size=0, quieter=True,
+               backend=backend, store_dir=store_dir)
+    # Make sure a signing identity exists before anything is timed
+    api.ipfs.repo_stat()
+    rec = Recorder(api)
+
+    rec.time('repo init', api.repo.init)
+
+    def _commit(message, lane=0, lanes=1):
+        repo.edit(lane, lanes)
+        rec.time('stage add', api.stage.add)
+        rec.time('commit', api.stage.commit, message)
+
+    # Master gets the even lane and feature branches the odd lane, so that
+    # merges don't conflict
+    for i in range(spec.commits):
+        if spec.merge_every > 0 and i % spec.merge_every == spec.merge_every - 1:
+            feature = f'feature{i}'
+            api.branch.create(feature)
+            for j in range(spec.branch_commits):
+                _commit(f'{feature} commit {j}', 1, 2)
+            rec.time('checkout', api.branch.checkout, 'master')
+            _commit(f'commit {i}', 0, 2)
+            rec.time('merge', api.branch.merge, feature, message=f'merge {feature}')
+        else:
+            _commit(f'commit {i}', 0, 2)
+
+    # Replay a topic branch on top of new commits on master
+    api.branch.create('topic')
+    for j in range(max(spec.branch_commits, 1)):
+        _commit(f'topic commit {j}', 1, 2)
+    rec.time('checkout', api.branch.checkout, 'master')
+    _commit('master commit before replay', 0, 2)
+    rec.time('checkout', api.branch.checkout, 'topic')
+    rec.time('replay', api.branch.replay, 'master')
+    rec.time('checkout', api.branch.checkout, 'master')
+
+    repo.edit(0, 2)
+    rec.time('status', api.stage.status)
+    rec.time('diff', api.diff.run)
+    rec.time('diff', api.diff.run, Path('@workspace'), Path('@head'))
+    rec.time('history', api.branch.history)
+    return rec.results()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    defaults = RepoSpec()
+    for name, value in defaults.to_dict().items():
+        parser.add_argument(f'--{name.replace("_", "-")}', type=type(value), default=value)
+    parser.add_argument('--backend', default='local', choices=['local', 'daemon'])
+    parser.add_argument('--output', default=None, help='JSON output file, defaults to stdout')
+    args = parser.parse_args()
+    spec = RepoSpec(**{name: getattr(args, name) for name in defaults.to_dict()})
+
+    tmp_dir = Path(tempfile.mkdtemp(prefix='ipvc_bench_'))
+    try:
+        t0 = time.perf_counter()
+        results = run(spec, tmp_dir / 'repo', args.backend, tmp_dir / 'store')
+        total = time.perf_counter() - t0
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    report = {
+        'ipvc_version': ipvc.__version__,
+        'python_version': platform.python_version(),
+        'platform': platform.platform(),
+        'backend': args.backend,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'spec': spec.to_dict(),
+        'total_s': total,
+        'results': results,
+    }
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,80 @@
+"""
+Per-call latency of the daemon connection with different transports, against
+a local stand-in API server so that only the client and transport overhead is
+measured:
+
+- ipfsapi's default, which opens a new TCP connection for every request
+- a keep-alive session over TCP
+- a keep-alive session over a Unix domain socket
+- the asyncio client, sequentially and with concurrent requests
+
+    python benchmarks/bench_transport.py --calls 2000
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import tempfile
+
+import ipfsapi
+
+from ipvc.aioipfs import AsyncIPFSClient
+from ipvc.transport import keep_alive_session
+from standin_api import serve_tcp, serve_unix
+
+
+def bench_sync(client, calls):
+    t0 = time.time()
+    for i in range(calls):
+        client.files_stat(f'/ipvc/repos/{i}')
+    return time.time() - t0
+
+
+def bench_async(client, calls, concurrency):
+    async def _run():
+        semaphore = asyncio.Semaphore(concurrency)
+        async def _stat(i):
+            async with semaphore:
+                await client.files_stat(f'/ipvc/repos/{i}')
+        await asyncio.gather(*[_stat(i) for i in range(calls)])
+        await client.close()
+
+    t0 = time.time()
+    asyncio.run(_run())
+    return time.time() - t0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--calls', type=int, default=1000)
+    args = parser.parse_args()
+
+    tcp_server = serve_tcp()
+    port = tcp_server.server_address[1]
+    socket_path = os.path.join(tempfile.mkdtemp(), 'api.sock')
+    serve_unix(socket_path)
+
+    default_client = ipfsapi.Client('127.0.0.1', port)
+    tcp_client = ipfsapi.Client('127.0.0.1', port)
+    tcp_client._client._session = keep_alive_session()
+    unix_client = ipfsapi.Client('127.0.0.1', port)
+    unix_client._client._session = keep_alive_session(socket_path)
+
+    results = [
+        ('new connection per call', bench_sync(default_client, args.calls)),
+        ('keep-alive TCP', bench_sync(tcp_client, args.calls)),
+        ('keep-alive Unix socket', bench_sync(unix_client, args.calls)),
+        ('asyncio TCP', bench_async(
+            AsyncIPFSClient('127.0.0.1', port), args.calls, 1)),
+        ('asyncio Unix socket', bench_async(
+            AsyncIPFSClient(socket_path=socket_path), args.calls, 1)),
+        ('asyncio Unix socket x8', bench_async(
+            AsyncIPFSClient(socket_path=socket_path), args.calls, 8)),
+    ]
+    for label, elapsed in results:
+        print(f'{label:25} {1e6 * elapsed / args.calls:8.1f}us per call')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,70 @@
+"""
+A stand-in for the IPFS daemon HTTP API that answers every command with a
+small JSON object, like `files stat` does. Used for benchmarking the client
+side cost of talking to the daemon, without the cost of the daemon itself
+"""
+import os
+import json
+import threading
+import socketserver
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def address_string(self):
+        return 'standin'
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path.startswith('/api/v0/version'):
+            body = {'Version': '0.4.18', 'Commit': '', 'Repo': '7'}
+        else:
+            body = {'Hash': 'QmUNLLsPACCz1vLxQVkXqqLX5R1X345qqfHbsf67hvA3Nn',
+                    'Size': 0, 'CumulativeSize': 4, 'Blocks': 0,
+                    'Type': 'directory'}
+        body = json.dumps(body).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST
+
+
+class TCPStandInHandler(StandInHandler):
+    # Like the Go HTTP server of the daemon, otherwise Nagle's algorithm
+    # delays responses on keep-alive connections
+    disable_nagle_algorithm = True
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn,
+                              socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super().get_request()
+        return request, ('standin', 0)
+
+
+def serve_tcp():
+    """ Starts a server on a free localhost port and returns it """
+    server = ThreadingHTTPServer(('127.0.0.1', 0), TCPStandInHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def serve_unix(socket_path):
+    """ Starts a server on the Unix domain socket `socket_path` """
+    try:
+        os.remove(socket_path)
+    except FileNotFoundError:
+        pass
+    server = ThreadingUnixHTTPServer(socket_path, StandInHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
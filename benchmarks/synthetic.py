@@ -0,0 +1,140 @@
+"""
+Deterministic generator of synthetic repositories for benchmarks. The same
+spec always gives the same files, edits and history, so results can be
+compared between runs and releases.
+"""
+import os
+import math
+import zlib
+import random
+from pathlib import Path
+
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do '
+         'eiusmod tempor incididunt ut labore et dolore magna aliqua').split()
+# Timestamps of edited files are set explicitly and moved forward a second
+# per round of edits, since changes are detected by modification time
+START_TIME_NS = 1500000000 * 10**9
+
+
+class RepoSpec:
+    """ Shape of a synthetic repo: `files` files spread over a directory tree
+    `depth` levels deep with `fanout` subdirectories per directory. File sizes
+    are log-normally distributed around `median_size` bytes with `size_sigma`,
+    capped at `max_size`, and `binary_fraction` of the files are binary.
+    The history has `commits` commits on master, every `merge_every`-th of
+    which is a merge of a feature branch with `branch_commits` commits. Each
+    commit edits `change_fraction` of the files """
+    def __init__(self, files=200, depth=3, fanout=4, median_size=2048,
+                 size_sigma=1.5, max_size=4*1024*1024, binary_fraction=0.1,
+                 commits=20, merge_every=5, branch_commits=2,
+                 change_fraction=0.05, seed=0):
+        self.files = files
+        self.depth = depth
+        self.fanout = fanout
+        self.median_size = median_size
+        self.size_sigma = size_sigma
+        self.max_size = max_size
+        self.binary_fraction = binary_fraction
+        self.commits = commits
+        self.merge_every = merge_every
+        self.branch_commits = branch_commits
+        self.change_fraction = change_fraction
+        self.seed = seed
+
+    def to_dict(self):
+        return dict(vars(self))
+
+
+def text_content(rng, size):
+    lines, length = [], 0
+    while length < size:
+        line = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 12)))
+        lines.append(line)
+        length += len(line) + 1
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+def binary_content(rng, size):
+    return rng.getrandbits(8 * size).to_bytes(size, 'little') if size > 0 else b''
+
+
+class SyntheticRepo:
+    """ Writes and edits the files of a repo described by a RepoSpec under
+    `path`. Files are split into lanes by a hash of their path, so that edits
+    in different lanes touch different files and merge without conflicts """
+    def __init__(self, path, spec):
+        self.path = Path(path)
+        self.spec = spec
+        self.rng = random.Random(spec.seed)
+        self.clock = START_TIME_NS
+        self.num_created = 0
+
+    def _new_path(self):
+        parts = []
+        for _ in range(self.rng.randint(0, self.spec.depth)):
+            parts.append(f'dir{self.rng.randrange(self.spec.fanout)}')
+        self.num_created += 1
+        return str(Path(*parts, f'file{self.num_created}'))
+
+    def _size(self):
+        size = self.rng.lognormvariate(math.log(self.spec.median_size),
+                                       self.spec.size_sigma)
+        return min(int(size), self.spec.max_size)
+
+    def _write(self, rel_path, content):
+        fs_path = self.path / rel_path
+        fs_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(fs_path, 'wb') as f:
+            f.write(content)
+        os.utime(fs_path, ns=(self.clock, self.clock))
+
+    def _create(self):
+        rel_path = self._new_path()
+        binary = self.rng.random() < self.spec.binary_fraction
+        if binary:
+            rel_path += '.bin'
+            content = binary_content(self.rng, self._size())
+        else:
+            rel_path += '.txt'
+            content = text_content(self.rng, self._size())
+        self._write(rel_path, content)
+        return rel_path
+
+    def generate(self):
+        """ Writes the initial files """
+        self.path.mkdir(parents=True, exist_ok=True)
+        for _ in range(self.spec.files):
+            self._create()
+
+    def files(self):
+        """ Returns the paths of the files in the workspace, sorted """
+        return sorted(str(p.relative_to(self.path)) for p in self.path.glob('**/*')
+                      if p.is_file() and p.name.endswith(('.txt', '.bin')))
+
+    def edit(self, lane=0, lanes=1):
+        """ Edits change_fraction of the files in `lane` out of `lanes`, and
+        adds and removes a file. Text files get a line replaced and a line
+        appended, binary files are rewritten. Returns the changed paths """
+        self.clock += 10**9
+        files = [p for p in self.files()
+                 if zlib.crc32(p.encode('utf-8')) % lanes == lane]
+        num_edits = max(1, int(self.spec.change_fraction * len(files)))
+        changed = self.rng.sample(files, min(num_edits, len(files)))
+        for rel_path in changed:
+            if rel_path.endswith('.bin'):
+                self._write(rel_path, binary_content(self.rng, self._size()))
+                continue
+            with open(self.path / rel_path, 'rb') as f:
+                lines = f.read().decode('utf-8').split('\n')[:-1]
+            if len(lines) > 0:
+                lines[self.rng.randrange(len(lines))] = ' '.join(
+                    self.rng.choice(WORDS) for _ in range(5))
+            lines.append(' '.join(self.rng.choice(WORDS) for _ in range(5)))
+            self._write(rel_path, ('\n'.join(lines) + '\n').encode('utf-8'))
+
+        changed.append(self._create())
+        if len(files) > num_edits + 1:
+            removed = self.rng.choice([p for p in files if p not in changed])
+            os.remove(self.path / removed)
+            changed.append(removed)
+        return changed
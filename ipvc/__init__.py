@@ -1,5 +1,12 @@
 from .cli import main
-from .ipvc_api import IPVC
 
 __version__ = "0.1.3"
 
+
+def __getattr__(name):
+    # IPVC is imported on first use, so that importing ipvc for the CLI
+    # doesn't import the API and its dependencies up front
+    if name == 'IPVC':
+        from .ipvc_api import IPVC
+        return IPVC
+    raise AttributeError(f"module 'ipvc' has no attribute '{name}'")
@@ -0,0 +1,173 @@
+"""
+A small asyncio client for the IPFS daemon HTTP API, used to issue independent
+requests concurrently. Connections are kept alive and reused from a pool, so
+that concurrent requests don't each pay for setting up a new connection.
+Errors are raised as the same exception types as the ipfsapi client
+"""
+import json
+import asyncio
+from urllib.parse import urlencode, quote
+
+import ipfsapi
+
+
+class AsyncIPFSClient:
+    def __init__(self, host='localhost', port=5001, base='/api/v0',
+                 max_connections=8, socket_path=None):
+        self.host = host
+        self.port = port
+        self.base = base
+        # Connect over this Unix domain socket instead of TCP if set
+        self.socket_path = socket_path
+        self.max_connections = max_connections
+        self._idle = []
+        self._semaphore = None
+
+    async def _open_connection(self):
+        if self.socket_path is not None:
+            return await asyncio.open_unix_connection(self.socket_path)
+        return await asyncio.open_connection(self.host, self.port)
+
+    async def _acquire(self):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_connections)
+        await self._semaphore.acquire()
+        while len(self._idle) > 0:
+            reader, writer = self._idle.pop()
+            if not reader.at_eof() and not writer.is_closing():
+                return reader, writer
+            writer.close()
+        try:
+            return await self._open_connection()
+        except OSError as e:
+            self._semaphore.release()
+            raise ipfsapi.exceptions.ConnectionError(e)
+
+    def _release(self, conn, reusable):
+        if reusable:
+            self._idle.append(conn)
+        else:
+            conn[1].close()
+        self._semaphore.release()
+
+    async def close(self):
+        for _, writer in self._idle:
+            writer.close()
+        self._idle = []
+
+    async def request(self, path, args=(), opts=None, data=None, decoder='json'):
+        """ Sends a request for API command `path` (e.g. '/files/stat') and
+        returns the decoded response """
+        params = [('stream-channels', 'true')]
+        params += list((opts or {}).items())
+        params += [('arg', str(arg)) for arg in args]
+        url = f'{self.base}{path}?{urlencode(params, quote_via=quote)}'
+        body = data or b''
+        head = (f'POST {url} HTTP/1.1\r\n'
+                f'Host: {self.host}:{self.port}\r\n'
+                f'Content-Length: {len(body)}\r\n'
+                'Connection: keep-alive\r\n\r\n')
+
+        for attempt in range(2):
+            conn = await self._acquire()
+            reusable = False
+            try:
+                reader, writer = conn
+                writer.write(head.encode('latin-1') + body)
+                await writer.drain()
+                status, headers, content, reusable = await self._read_response(reader)
+                break
+            except (ConnectionError, asyncio.IncompleteReadError,
+                    ipfsapi.exceptions.ProtocolError):
+                # The daemon may have closed an idle connection, so try once
+                # more on a new one
+                if attempt == 1:
+                    raise
+            finally:
+                self._release(conn, reusable)
+
+        stream_error = headers.get('x-stream-error', None)
+        if status != 200 or stream_error:
+            message = stream_error or content.decode('utf-8', 'replace')
+            try:
+                message = json.loads(message)['Message']
+            except (ValueError, KeyError, TypeError):
+                pass
+            raise ipfsapi.exceptions.ErrorResponse(message, None)
+
+        if decoder != 'json':
+            return content
+        return _decode_json(content)
+
+    async def _read_response(self, reader):
+        status_line = await reader.readline()
+        if not status_line:
+            raise ipfsapi.exceptions.ProtocolError(None, 'Connection closed by daemon')
+        status = int(status_line.split()[1])
+        headers = await _read_headers(reader)
+
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            # Errors that happen after streaming started are sent as trailers
+            headers.update(await _read_headers(reader))
+            content = b''.join(chunks)
+        elif 'content-length' in headers:
+            content = await reader.readexactly(int(headers['content-length']))
+        else:
+            content = await reader.read()
+            return status, headers, content, False
+
+        reusable = headers.get('connection', '').lower() != 'close'
+        return status, headers, content, reusable
+
+    async def files_stat(self, path):
+        return await self.request('/files/stat', (path,))
+
+    async def files_read(self, path):
+        return await self.request('/files/read', (path,), decoder=None)
+
+    async def files_ls(self, path, long=False):
+        return await self.request('/files/ls', (path,), opts={'l': str(long).lower()})
+
+    async def cat(self, path):
+        return await self.request('/cat', (path,), decoder=None)
+
+    async def ls(self, path):
+        return await self.request('/ls', (path,))
+
+    async def object_diff(self, hash_a, hash_b):
+        return await self.request('/object/diff', (hash_a, hash_b))
+
+
+async def _read_headers(reader):
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            return headers
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+
+def _decode_json(content):
+    """ Decodes a response that can be several concatenated JSON objects, like
+    the ipfsapi client does """
+    decoder = json.JSONDecoder()
+    text = content.decode('utf-8')
+    objects, pos = [], 0
+    while True:
+        while pos < len(text) and text[pos].isspace():
+            pos += 1
+        if pos >= len(text):
+            break
+        obj, pos = decoder.raw_decode(text, pos)
+        objects.append(obj)
+    if len(objects) == 1:
+        return objects[0]
+    return objects
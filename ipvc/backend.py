@@ -0,0 +1,82 @@
+"""
+Storage backends for ipvc. All IPFS access goes through `IPVC.ipfs`, which is
+one of these backends:
+
+  daemon  the go-ipfs daemon through its HTTP API
+  local   an in-process content addressed store with an emulation of MFS,
+          see ipvc.localstore
+
+Both implement the subset of the ipfsapi client that ipvc uses, i.e. the
+files_* (MFS) methods, add, add_bytes, cat, ls, block_put, object_stat,
+object_links, object_diff, pin_add, repo_stat, key_list, key_gen, name_publish and
+name_resolve, and raise the ipfsapi exception types on errors
+"""
+BACKENDS = ['daemon', 'local']
+# MFS API calls that modify the tree, and that are sent without flushing
+# within atomic API calls
+MFS_MUTATIONS = ['/files/cp', '/files/mkdir', '/files/rm', '/files/write',
+                 '/files/mv']
+
+
+class HTTPBackend:
+    """ Wraps the ipfsapi client of the daemon. `is_deferred` is called to
+    check whether MFS mutations should be sent with flush=false, so that the
+    daemon doesn't rehash every directory up to the root on each call, in
+    which case files_flush() has to be called when done """
+    def __init__(self, host=None, port=None, socket_path=None,
+                 is_deferred=lambda: False):
+        # Imported here since requests is slow to import, and the CLI imports
+        # this module for BACKENDS
+        from ipvc.transport import connect
+        self.client = connect(host, port, socket_path)
+        self.is_deferred = is_deferred
+        self.mutation_count = 0
+
+        request = self.client._client.request
+        def _request(path, *args, **kwargs):
+            if path in MFS_MUTATIONS:
+                self.mutation_count += 1
+                if self.is_deferred():
+                    kwargs['opts'] = dict(kwargs.get('opts', {}), flush='false')
+            return request(path, *args, **kwargs)
+        self.client._client.request = _request
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def object_diff(self, hash_a, hash_b):
+        # NOTE: use ipfs.object_diff when it's released
+        return self.client._client.request(
+            '/object/diff', (hash_a, hash_b), decoder='json')
+
+    def files_flush(self, path='/'):
+        self.client._client.request('/files/flush', (str(path),))
+
+
+class AsyncBackend:
+    """ The async API of ipvc.aioipfs.AsyncIPFSClient for backends that don't
+    have one. Calls are made synchronously, which is fine for the local
+    backend where there is no latency to hide """
+    def __init__(self, backend):
+        self.backend = backend
+
+    async def close(self):
+        pass
+
+    async def files_stat(self, path):
+        return self.backend.files_stat(path)
+
+    async def files_read(self, path):
+        return self.backend.files_read(path)
+
+    async def files_ls(self, path, long=False):
+        return self.backend.files_ls(path, long=long)
+
+    async def cat(self, path):
+        return self.backend.cat(path)
+
+    async def ls(self, path):
+        return self.backend.ls(path)
+
+    async def object_diff(self, hash_a, hash_b):
+        return self.backend.object_diff(hash_a, hash_b)
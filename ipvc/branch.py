@@ -2,12 +2,28 @@ import io
 import os
 import sys
 import json
+import asyncio
 import difflib
-import webbrowser
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 import ipfsapi
-from ipvc.common import CommonAPI, expand_ref, make_len, atomic
+from ipvc.common import (
+    CommonAPI, expand_ref, make_len, atomic, normalize_sparse_pattern,
+    sparse_match, remove_workspace_file, MATERIALIZE_WORKERS, RENAMED, DIFF_TEXT_SIZE, THEIRS_SUFFIX)
+from ipvc.dag import directory_node
+from ipvc.signing import verify_commit
+from ipvc.trace import traced
+
+# Verify signatures in a process pool when there are at least this many commits
+VERIFY_PROCESS_MIN_COMMITS = 64
+
+
+def changed_paths(file_changes):
+    """ Returns the paths touched by file changes by path, which includes
+    the paths that files were renamed from """
+    return set(file_changes) | {c['FromPath'] for c in file_changes.values()
+                                if c['Type'] == RENAMED}
 
 class BranchAPI(CommonAPI):
     def __init__(self, *args, **kwargs):
@@ -31,31 +47,41 @@ class BranchAPI(CommonAPI):
 
 
         try:
-            self.ipfs.files_stat(self.get_mfs_path(self.fs_repo_root, name))
+            self.ipfs.files_stat(
+                self.get_mfs_path(self.fs_repo_root, name, branch_info='head'))
             self.print_err('Branch name already exists')
             raise RuntimeError()
         except ipfsapi.exceptions.StatusError:
             pass
 
+        mfs_head_path = self.get_mfs_path(
+            self.fs_repo_root, name, branch_info='head')
+        is_worktree = self.get_repo_main_root(self.fs_repo_root) != self.fs_repo_root
         if from_commit == "@head":
             # Simply copy the current branch to the new branch
             self.ipfs.files_cp(
                 self.get_mfs_path(self.fs_repo_root, self.active_branch),
                 self.get_mfs_path(self.fs_repo_root, name))
+            if is_worktree:
+                # The head lives with the main repo, so copy it separately
+                self.ipfs.files_mkdir(mfs_head_path.parent, parents=True)
+                self.ipfs.files_cp(
+                    self.get_mfs_path(
+                        self.fs_repo_root, self.active_branch, branch_info='head'),
+                    mfs_head_path)
             self.invalidate_cache(['branches'])
         else:
             # Create the branch directory along with an empty stage and workspace
             for ref in ['stage', 'workspace']:
                 mfs_ref = self.get_mfs_path(self.fs_repo_root, name, branch_info=f'{ref}/data/')
                 self.ipfs.files_mkdir(mfs_ref, parents=True)
+            self.ipfs.files_mkdir(mfs_head_path.parent, parents=True)
             self.invalidate_cache(['branches'])
 
             # Copy the commit to the new branch's head
             _, commit_path = expand_ref(from_commit)
             mfs_commit_path = self.get_mfs_path(
                 self.fs_repo_root, self.active_branch, branch_info=commit_path)
-            mfs_head_path = self.get_mfs_path(
-                self.fs_repo_root, name, branch_info='head')
 
             try:
                 self.ipfs.files_stat(mfs_commit_path)
@@ -83,36 +109,101 @@ class BranchAPI(CommonAPI):
         self.common()
 
         try:
-            self.ipfs.files_stat(self.get_mfs_path(self.fs_repo_root, name))
+            self.ipfs.files_stat(
+                self.get_mfs_path(self.fs_repo_root, name, branch_info='head'))
         except ipfsapi.exceptions.StatusError:
             self.print_err('No branch by that name exists')
             raise RuntimeError()
 
+        self._check_not_in_other_worktree(self.fs_repo_root, name)
+        self._ensure_branch_refs(self.fs_repo_root, name)
+
+        # The workspace on disk is in sync with the current branch after
+        # self.common(), so only the files that differ need to be rewritten
+        from_branch = self.active_branch
         self.set_active_branch(self.fs_repo_root, name)
-        self._load_ref_into_repo(
-            self.fs_repo_root, name, 'workspace', without_timestamps)
+        self._load_ref_changes_into_repo(
+            self.fs_repo_root, from_branch, name, 'workspace', without_timestamps)
+
+    def _check_not_in_other_worktree(self, fs_repo_root, branch):
+        for worktree in self.get_worktrees(fs_repo_root):
+            if worktree == fs_repo_root:
+                continue
+            if self.get_active_branch(worktree) == branch:
+                self.print_err(f'Branch "{branch}" is checked out in another '
+                               f'worktree at {worktree}')
+                raise RuntimeError()
+
+    @atomic
+    def sparse(self, patterns=None, clear=False):
+        """ Gets or sets the sparse checkout patterns for the current branch.
+        Only files included by the patterns are checked out to and scanned in
+        the workspace, while the rest stay in the branch untouched """
+        self.common()
+        old_patterns = self.sparse_patterns
+        if not patterns and not clear:
+            if len(old_patterns) == 0:
+                self.print('No sparse checkout patterns, everything is checked out')
+            else:
+                self.print('\n'.join(old_patterns))
+            return old_patterns
+
+        new_patterns = [] if clear else [
+            normalize_sparse_pattern(p) for p in patterns]
+        self.set_sparse_patterns(
+            self.fs_repo_root, self.active_branch, new_patterns)
+
+        # The workspace is in sync after self.common(), so we can remove files
+        # that are no longer included, and check out the newly included ones
+        files_metadata = self.read_files_metadata('workspace')
+        for path in files_metadata:
+            if (sparse_match(path, old_patterns) and
+                    not sparse_match(path, new_patterns)):
+                remove_workspace_file(self.fs_repo_root, path)
+
+        new_paths = set(path for path in files_metadata
+                        if sparse_match(path, new_patterns) and
+                        not sparse_match(path, old_patterns))
+        _, mfs_refpath, _ = self.refpath_to_mfs(Path('@workspace'))
+        self._materialize_files(
+            self.fs_repo_root, self.active_branch, mfs_refpath, new_paths,
+            files_metadata)
+        return new_patterns
 
     def _get_commit_parents(self, commit_hash):
         """ Returns hash and metadata of parent commit and merge parent (if present) """
         try:
-            parent_hash = self.ipfs.files_stat(f'/ipfs/{commit_hash}/data/parent')['Hash']
+            metadata = self.get_commit_metadata(commit_hash)
+        except ipfsapi.exceptions.StatusError:
+            metadata = {}
+
+        if metadata.get('format', 1) >= 2:
+            # The parents are in the metadata, no need to look at the links
+            parent_hash = metadata['parent']
+            merge_parent_hash = metadata.get('merge_parent', None)
+        else:
+            try:
+                parent_hash = self.ipfs.files_stat(f'/ipfs/{commit_hash}/data/parent')['Hash']
+            except ipfsapi.exceptions.StatusError:
+                # Reached the root of the graph
+                return None, None, None, None
+            try:
+                merge_parent_hash = self.ipfs.files_stat(f'/ipfs/{commit_hash}/data/merge_parent')['Hash']
+            except ipfsapi.exceptions.StatusError:
+                merge_parent_hash = None
+
+        try:
             parent_metadata = self.get_commit_metadata(parent_hash)
         except ipfsapi.exceptions.StatusError:
             # Reached the root of the graph
             return None, None, None, None
 
         try:
-            merge_parent_hash = self.ipfs.files_stat(f'/ipfs/{commit_hash}/data/merge_parent')['Hash']
             merge_parent_metadata = self.get_commit_metadata(merge_parent_hash)
             return parent_hash, parent_metadata, merge_parent_hash, merge_parent_metadata
         except:
             return parent_hash, parent_metadata, None, None
 
-    def get_commit_metadata(self, commit_hash):
-        # NOTE: the root commit doesn't have a commit_metadata file, so this
-        # might fail
-        return json.loads(self.ipfs.cat(f'/ipfs/{commit_hash}/data/commit_metadata').decode('utf-8'))
-
     @atomic
     def history(self, show_hash=False, show_peer=False):
         """ Shows the commit history for the current branch. Currently only
@@ -150,6 +241,129 @@ class BranchAPI(CommonAPI):
 
         return commits
 
+    def _fetch_commit_signatures(self, commit_hash):
+        """ Fetches what is needed to verify a commit: the hashes that are
+        signed, the signatures, the author and the parent commit hashes.
+        Returns None for the unsigned root of the graph """
+        def _links(h):
+            return {link['Name']: link['Hash']
+                    for link in self.ipfs.ls(h)['Objects'][0]['Links']}
+
+        def _cat(h):
+            return None if h is None else self.ipfs.cat(h).decode('utf-8')
+
+        commit_links = _links(commit_hash)
+        data_hash = commit_links['data']
+        # The raw links, since their sizes are needed to rebuild the node
+        raw_data_links = self.ipfs.object_links(data_hash)['Links']
+        data_links = {link['Name']: link['Hash'] for link in raw_data_links}
+        if 'commit_metadata' not in data_links:
+            return None
+
+        commit_metadata = json.loads(_cat(data_links['commit_metadata']))
+        legacy_data_hash = None
+        if 'format' not in commit_metadata:
+            # Commits used to be signed before commit_metadata was written to
+            # the data folder, so the signature may be of the folder without it
+            legacy_data_hash = directory_node([
+                (link['Name'], link['Hash'], link['Size'])
+                for link in raw_data_links
+                if link['Name'] != 'commit_metadata']).hash
+        return {
+            'author': commit_metadata.get('author', {}),
+            'data_hash': data_hash,
+            'legacy_data_hash': legacy_data_hash,
+            'bundle_hash': data_links['bundle'],
+            'data_signature': _cat(commit_links.get('data_signature', None)),
+            'bundle_signature': _cat(commit_links.get('bundle_signature', None)),
+            'parents': [data_links[p] for p in ['parent', 'merge_parent']
+                        if p in data_links],
+        }
+
+    def _resolve_commit(self, ref):
+        if not ref.startswith('@'):
+            # Assume it's a commit hash
+            return ref
+        _, commit_path = expand_ref(ref)
+        try:
+            return self.ipfs.files_stat(self.get_mfs_path(
+                self.fs_repo_root, self.active_branch, branch_info=commit_path))['Hash']
+        except ipfsapi.exceptions.StatusError:
+            self.print_err('No such commit')
+            raise RuntimeError()
+
+    @atomic
+    def verify(self, since=None):
+        """ Verifies the signatures of all commits in the history of the
+        current branch, or only the ones after the commit `since`. Commits
+        whose entire history has been verified before are remembered in a
+        local cache and not verified again """
+        self.common()
+        mfs_head = self.get_mfs_path(
+            self.fs_repo_root, self.active_branch, branch_info='head')
+        head_hash = self.ipfs.files_stat(mfs_head)['Hash']
+        since_hash = None if since is None else self._resolve_commit(since)
+
+        fs_verified_path = self.ipvc.cache_dir / 'verified_commits'
+        try:
+            with open(fs_verified_path) as f:
+                verified = set(f.read().split())
+        except FileNotFoundError:
+            verified = set()
+
+        # Walk the commit graph breadth first, fetching each generation of
+        # commits concurrently
+        commits = {}
+        complete = True
+        frontier = [] if head_hash in verified else [head_hash]
+        with ThreadPoolExecutor(max_workers=MATERIALIZE_WORKERS) as executor:
+            while len(frontier) > 0:
+                fetched = executor.map(self._fetch_commit_signatures, frontier)
+                next_frontier = []
+                for commit_hash, commit in zip(frontier, fetched):
+                    commits[commit_hash] = commit
+                    for parent_hash in (commit or {}).get('parents', []):
+                        if parent_hash == since_hash:
+                            complete = False
+                        elif (parent_hash not in commits and
+                                parent_hash not in verified and
+                                parent_hash not in next_frontier):
+                            next_frontier.append(parent_hash)
+                frontier = next_frontier
+
+        signed = [(h, c) for h, c in commits.items()
+                  if c is not None and h not in verified]
+        args = [[c[key] for _, c in signed] for key in
+                ['author', 'data_hash', 'bundle_hash', 'data_signature',
+                 'bundle_signature', 'legacy_data_hash']]
+        if len(signed) >= VERIFY_PROCESS_MIN_COMMITS:
+            # Signature verification is CPU bound, so spread it over processes
+            with ProcessPoolExecutor() as executor:
+                errors = list(executor.map(verify_commit, *args, chunksize=16))
+        else:
+            errors = list(map(verify_commit, *args))
+
+        failed = [(h, error) for (h, _), error in zip(signed, errors)
+                  if error is not None]
+        for commit_hash, error in failed:
+            self.print_err(f'{commit_hash}: {error}')
+
+        if len(failed) > 0:
+            self.print_err(f'Verification failed for {len(failed)} of {len(signed)} commits')
+            raise RuntimeError()
+
+        # Only remember commits if their entire history has been verified
+        if complete:
+            fs_verified_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(fs_verified_path, 'a') as f:
+                for commit_hash in commits:
+                    if commit_hash not in verified:
+                        f.write(commit_hash + '\n')
+
+        self.print(f'Verified {len(signed)} commits')
+        return [h for h, _ in signed]
+
+    @traced
     def _find_LCA(self, our_commit_hash, their_commit_hash):
         """
         Finds the Lowest Common Ancestor to `our_commit_hash` and `their_commit_hash`.
@@ -185,8 +399,16 @@ class BranchAPI(CommonAPI):
 
     def _get_file_changes(self, from_hash, to_hash):
         changes = self.ipfs.object_diff(from_hash, to_hash)['Changes']
+        return self._merge_file_changes(changes)
+
+    def _merge_file_changes(self, changes):
+        """ Returns the changes by file path, with renames paired up so that
+        changes to a renamed file can be merged into it """
+        changes = self._find_renames(
+            self._expand_file_changes(changes).values(), copies=False)
         return {change['Path']: change for change in changes}
 
+    @traced
     def _merge(self, our_file_changes, our_branch,
                their_file_changes, their_files_hash, their_branch):
         """
@@ -194,31 +416,71 @@ class BranchAPI(CommonAPI):
         and writes the merged files to disk, with conflict markers if there are conflicts,
         and then stage changes that are conflict free.
         Assumes that current fs repo has 'our_file_changes' in it already.
+        Changes to a file that was renamed on the other side are merged into
+        the renamed file.
         """
         def _fdiff(change):
             # NOTE: remove the last lines because text files always end with
             # a newline, so it would introduce a new empty line at the end
-            from_lines = (self.ipfs.cat(change['Before']['/']).decode('utf-8').split('\n')[:-1]
-                          if change['Before'] is not None else [])
-            to_lines = (self.ipfs.cat(change['After']['/']).decode('utf-8').split('\n')[:-1]
-                        if change['After'] is not None else [])
+            from_lines = self._read_text(
+                (change['Before'] or {}).get('/', None)).split('\n')[:-1]
+            to_lines = self._read_text(
+                (change['After'] or {}).get('/', None)).split('\n')[:-1]
             return difflib.ndiff(from_lines, to_lines)
 
+        our_renames = {c['FromPath']: c for c in our_file_changes.values()
+                       if c['Type'] == RENAMED}
         merged_files, conflict_files, pulled_files = set(), set(), set()
         for filename, their_change in their_file_changes.items():
             has_merge_conflict, has_merges = False, False
-            if filename not in our_file_changes:
-                # Write the file from their change
-                with open(self.fs_repo_root / filename, 'wb') as f:
-                    f.write(self.ipfs.cat(f'/ipfs/{their_files_hash}/{filename}'))
+            # The path that the merged file is written to, and the path it
+            # was renamed from in their branch
+            path, from_path = filename, None
+            our_change = our_file_changes.get(filename, None)
+            if their_change['Type'] == RENAMED:
+                from_path = their_change['FromPath']
+                our_from_change = our_file_changes.get(from_path, None)
+                if our_from_change is not None and our_from_change['Type'] == 2:
+                    # We modified the file that they renamed
+                    our_change = our_from_change
+            elif their_change['Type'] == 2 and filename in our_renames:
+                # They modified the file that we renamed
+                our_change = our_renames[filename]
+                path = our_change['Path']
+            if our_change is not None and our_change['Before'] != their_change['Before']:
+                # Both added a file at the same path, possibly by a rename
+                our_change = dict(our_change, Before=None)
+                their_change = dict(their_change, Before=None)
+
+            in_checkout = sparse_match(path, self.sparse_patterns)
+            fs_from_path = None if from_path is None else self.fs_repo_root / from_path
+            if our_change is None:
+                if in_checkout and their_change['After'] is None:
+                    # The file was removed in their branch
+                    try:
+                        os.remove(self.fs_repo_root / filename)
+                    except FileNotFoundError:
+                        pass
+                elif (in_checkout and their_change['Before'] == their_change['After']
+                      and fs_from_path.is_file()):
+                    # The file was renamed in their branch without changes,
+                    # so it's moved instead of fetched
+                    (self.fs_repo_root / path).parent.mkdir(parents=True, exist_ok=True)
+                    os.replace(fs_from_path, self.fs_repo_root / path)
+                elif in_checkout:
+                    # Write the file from their change
+                    self._materialize_file(f'/ipfs/{their_files_hash}/{filename}',
+                                           self.fs_repo_root / filename)
+            elif not self._is_line_mergeable(our_change, their_change):
+                has_merge_conflict = self._merge_whole_file(
+                    our_change, their_change, path)
             else:
-                our_change = our_file_changes[filename]
                 our_diff = list(_fdiff(our_change))
                 their_diff = list(_fdiff(their_change))
                 diff_diff = list(difflib.ndiff(our_diff, their_diff))
                 diff_diff = [l for l in diff_diff if not l.startswith('?')]
                 their_lines, our_lines, both_lines = [], [], []
-                f = open(self.fs_repo_root / filename, 'w')
+                merged_lines = []
 
                 # Add a sentinel value so that we spit out any conflicts that
                 # are left
@@ -248,14 +510,14 @@ class BranchAPI(CommonAPI):
                     if line.startswith('    '):
                         if  len(our_lines) > 0 and len(their_lines) > 0:
                             has_merge_conflict = True
-                            f.write(f'>>>>>>> {our_branch} (ours)\n')
-                            f.write('\n'.join(our_lines) + '\n')
-                            f.write(f'======= {their_branch} (theirs)\n')
-                            f.write('\n'.join(their_lines) + '\n')
-                            f.write('<<<<<<<\n')
+                            merged_lines.append(f'>>>>>>> {our_branch} (ours)\n')
+                            merged_lines.append('\n'.join(our_lines) + '\n')
+                            merged_lines.append(f'======= {their_branch} (theirs)\n')
+                            merged_lines.append('\n'.join(their_lines) + '\n')
+                            merged_lines.append('<<<<<<<\n')
                         else:
                             for l in their_lines + our_lines + both_lines:
-                                f.write(l + '\n')
+                                merged_lines.append(l + '\n')
                             has_merges = True
                         their_lines, our_lines, both_lines = [], [], []
 
@@ -263,7 +525,7 @@ class BranchAPI(CommonAPI):
                             # It's the sentinel value
                             break
                         else:
-                            f.write(line[4:] + '\n')
+                            merged_lines.append(line[4:] + '\n')
                     else:
                         if line.startswith('+ + ') or line.startswith('+   '):
                             # Difflines that start with + come in from their commit,
@@ -283,24 +545,88 @@ class BranchAPI(CommonAPI):
                             # so do nothing (don't keep them)
                             pass
 
-                f.close()
+                merged = ''.join(merged_lines)
+                if in_checkout:
+                    with open(self.fs_repo_root / path, 'w') as f:
+                        f.write(merged)
+                else:
+                    # Outside of the sparse checkout, so the merged file is
+                    # linked into the workspace without touching the filesystem
+                    h = self.ipfs.add_bytes(merged.encode('utf-8'))
+                    self.add_ipfs_path_to_ref(f'/ipfs/{h}', 'workspace', path)
+
+            if from_path is not None:
+                # Remove the file that they renamed
+                try:
+                    os.remove(fs_from_path)
+                except FileNotFoundError:
+                    pass
+                if sparse_match(from_path, self.sparse_patterns):
+                    self.add_fs_to_mfs(fs_from_path, 'workspace')
+                else:
+                    self.remove_path_from_ref('workspace', from_path)
+                self.add_ref_changes_to_ref('workspace', 'stage', from_path)
 
             if not has_merge_conflict:
                 # Add the file to workspace, and then to stage
-                self.add_fs_to_mfs(self.fs_repo_root / filename, 'workspace')
-                self.add_ref_changes_to_ref('workspace', 'stage', filename)
+                if in_checkout:
+                    self.add_fs_to_mfs(self.fs_repo_root / path, 'workspace')
+                elif our_change is not None:
+                    # Already merged into the workspace, outside of the sparse
+                    # checkout
+                    pass
+                elif their_change['After'] is None:
+                    # Removed in their branch, outside of the sparse checkout
+                    self.remove_path_from_ref('workspace', filename)
+                else:
+                    # Outside of the sparse checkout, so skip the filesystem
+                    self.add_ipfs_path_to_ref(
+                        f'/ipfs/{their_files_hash}/{filename}', 'workspace',
+                        filename)
+                self.add_ref_changes_to_ref('workspace', 'stage', path)
 
             if has_merge_conflict:
-                self.print(f'Merge conflict in {filename}')
-                conflict_files.add(filename)
+                self.print(f'Merge conflict in {path}')
+                conflict_files.add(path)
             elif has_merges:
-                self.print(f'Successfully merged {filename}')
-                merged_files.add(filename)
+                self.print(f'Successfully merged {path}')
+                merged_files.add(path)
             else:
-                pulled_files.add(filename)
+                pulled_files.add(path)
 
         return merged_files, conflict_files, pulled_files
 
+    def _is_line_mergeable(self, *changes):
+        """ Whether all versions of the file in `changes` are text files
+        small enough to be merged line by line, which is checked without
+        reading the whole files """
+        hashes = set((change[side] or {}).get('/', None)
+                     for change in changes for side in ['Before', 'After'])
+        for h in hashes - {None}:
+            kind, size = self._file_kind(h)
+            if kind == 'binary' or size > DIFF_TEXT_SIZE:
+                return False
+        return True
+
+    def _merge_whole_file(self, our_change, their_change, path):
+        """ Merges changes to a binary or large file at `path`. If both
+        sides ended up with the same content there is nothing to do, otherwise
+        our version is kept and theirs is written next to it with
+        THEIRS_SUFFIX, for the user to pick from. Returns whether there's a
+        conflict """
+        if our_change['After'] == their_change['After']:
+            return False
+        if their_change['After'] is None:
+            return True
+        their_path = f'/ipfs/{their_change["After"]["/"]}'
+        if sparse_match(path, self.sparse_patterns):
+            self._materialize_file(their_path, self.fs_repo_root / (path + THEIRS_SUFFIX))
+        else:
+            # Outside of the sparse checkout, so theirs is only linked into
+            # the workspace
+            self.add_ipfs_path_to_ref(their_path, 'workspace', path + THEIRS_SUFFIX)
+        return True
+
     def _resolve_conflicts(self, conflict_files_path, our_branch, their_branch,
                            merge_type):
             # Make sure the conflicts are resolved, and stage the changes
@@ -308,15 +634,33 @@ class BranchAPI(CommonAPI):
                 conflict_files_path).decode('utf-8')
             for filename in conflict_files.split('\n'):
                 full_path = self.fs_repo_root / filename
+                if not sparse_match(filename, self.sparse_patterns):
+                    # The conflicts were merged into the workspace without
+                    # writing them to disk, so they can only be resolved once
+                    # the file is checked out
+                    self.print_err(f'Conflicts in {filename} are outside of the sparse checkout')
+                    self.print_err((f'Please include it with `ipvc branch sparse` to resolve '
+                                    f'them, or abort by `ipvc branch {merge_type} --abort`'))
+                    raise RuntimeError
+                if (self.fs_repo_root / (filename + THEIRS_SUFFIX)).exists():
+                    self.print_err(f'Conflicts in {filename} have not been resolved')
+                    self.print_err((f'Please put the version to keep in {filename} and remove '
+                                    f'{filename}{THEIRS_SUFFIX}, or abort by '
+                                    f'`ipvc branch {merge_type} --abort`'))
+                    raise RuntimeError
+
                 start_idx, middle_idx, end_idx = -1, -1, -1
-                with open(full_path, 'r') as f:
-                    for i, line in enumerate(f.readlines()):
-                        if line == f'>>>>>>> {our_branch} (ours)\n':
-                            start_idx = i
-                        elif line == f'======= {their_branch} (theirs)\n':
-                            middle_idx = i
-                        elif line == '<<<<<<<\n':
-                            end_idx = i
+                lines = []
+                if full_path.exists():
+                    with open(full_path, 'r', errors='replace') as f:
+                        lines = f.readlines()
+                for i, line in enumerate(lines):
+                    if line == f'>>>>>>> {our_branch} (ours)\n':
+                        start_idx = i
+                    elif line == f'======= {their_branch} (theirs)\n':
+                        middle_idx = i
+                    elif line == '<<<<<<<\n':
+                        end_idx = i
 
                 # Make sure markers are in the right order
                 has_markers = start_idx < middle_idx < end_idx
@@ -333,9 +677,44 @@ class BranchAPI(CommonAPI):
     def _ref_files_hash(self, h):
         return self.ipfs.files_stat(f'/ipfs/{h}/data/bundle/files')['Hash']
 
+    async def _ref_files_hashes_async(self, hashes):
+        """ Async variant of _ref_files_hash for several commits at once """
+        stats = await asyncio.gather(*[
+            self.ipvc.aipfs.files_stat(f'/ipfs/{h}/data/bundle/files')
+            for h in hashes])
+        return [stat['Hash'] for stat in stats]
+
+    async def _get_file_changes_async(self, hash_pairs):
+        """ Async variant of _get_file_changes for several pairs of hashes """
+        diffs = await asyncio.gather(*[
+            self.ipvc.aipfs.object_diff(from_hash, to_hash)
+            for from_hash, to_hash in hash_pairs])
+        return [self._merge_file_changes(diff['Changes']) for diff in diffs]
+
+    async def _merge_changes_async(self, lca_commit_hash, their_hashes, our_hashes):
+        """ Gets the files hashes and changesets needed for merging their
+        head into our refs, with the independent requests made concurrently """
+        base_refs = ['head', 'stage', 'workspace']
+        files_hashes = await self._ref_files_hashes_async(
+            [lca_commit_hash, their_hashes['head']] +
+            [our_hashes[ref] for ref in base_refs])
+        lca_files_hash, their_files_hash = files_hashes[:2]
+        our_file_hashes = dict(zip(base_refs, files_hashes[2:]))
+
+        # Changes of our stage and workspace, their changes and our changes
+        # since the LCA
+        changes = await self._get_file_changes_async([
+            (our_file_hashes['head'], our_file_hashes['stage']),
+            (our_file_hashes['head'], our_file_hashes['workspace']),
+            (lca_files_hash, their_files_hash),
+            (lca_files_hash, our_file_hashes['head'])])
+        our_file_changes = {'stage': changes[0], 'workspace': changes[1]}
+        return (lca_files_hash, their_files_hash, our_file_hashes,
+                our_file_changes, changes[2], changes[3])
+
     @atomic
     def merge(self, their_branch=None, no_ff=False, abort=False,
-              resolve=None):
+              resolve=None, message=None):
         """
         Merges our branch with their branch and creates a new merge commit
         with two parents (parent and merge_parent).
@@ -353,9 +732,13 @@ class BranchAPI(CommonAPI):
            merge (since tree was not split) but just update the head pointer, unless
            the --no-ff (no fast-forward) option is supplied
 
+        `message` is the message of the merge commit, so that no editor is
+        opened when the merge succeeds without conflicts
+
         TODO: implement --use [ours/theirs] for resolving conflicts
         """
-        message = resolve if resolve is not True else None
+        if resolve is not None and resolve is not True:
+            message = resolve
         resolve = resolve is not None
 
         self.common()
@@ -417,36 +800,31 @@ class BranchAPI(CommonAPI):
                 self.ipfs.files_rm(mfs_merge_paths[ref], recursive=True)
             return
 
-        their_hashes = {ref: self.get_branch_info_hash(their_branch, ref) for ref in base_refs}
-        our_hashes = {ref: self.get_branch_info_hash(branch, ref) for ref in base_refs}
+        their_hashes, our_hashes = self.ipvc.run_async(
+            self.get_branch_info_hashes_async(their_branch, base_refs),
+            self.get_branch_info_hashes_async(branch, base_refs))
 
         # Find the Lowest Common Ancestor
         lca_commit_hash, our_lca_path, their_lca_path = self._find_LCA(
             our_hashes['head'], their_hashes['head'])
 
-        lca_files_hash = self._ref_files_hash(lca_commit_hash)
-        their_files_hash = self._ref_files_hash(their_hashes['head'])
-        our_file_hashes = {ref: self._ref_files_hash(our_hashes[ref]) for ref in base_refs}
-        # Check collisions with stage and workspace changes
-        # NOTE: Check staged changes first since workspace contains changes based
-        # on the staged changes
-        our_file_changes = {ref: self._get_file_changes(
-            our_file_hashes['head'], our_file_hashes[ref]) for ref in ['stage', 'workspace']}
-
-        their_file_changes = self._get_file_changes(lca_files_hash, their_files_hash)
+        (lca_files_hash, their_files_hash, our_file_hashes, our_file_changes,
+         their_file_changes, our_lca_changes) = self.ipvc.run_async(
+             self._merge_changes_async(lca_commit_hash, their_hashes, our_hashes))
         if not resolve:
-            stage_conflict_set = our_file_changes['stage'].keys() & their_file_changes.keys()
+            stage_conflict_set = (changed_paths(our_file_changes['stage']) &
+                                  changed_paths(their_file_changes))
             if len(stage_conflict_set) > 0:
                 self.print_err('Merge conflicts with local staged changes in:')
                 self.print_err('\n'.join(list(stage_conflict_set)))
                 raise RuntimeError()
-            workspace_conflict_set = our_file_changes['workspace'].keys() & their_file_changes.keys()
+            workspace_conflict_set = (changed_paths(our_file_changes['workspace']) &
+                                      changed_paths(their_file_changes))
             if len(workspace_conflict_set) > 0:
                 self.print_err('Merge conflicts with local workspace changes in:')
                 self.print_err('\n'.join(list(workspace_conflict_set)))
                 raise RuntimeError()
 
-        our_lca_changes = self._get_file_changes(lca_files_hash, our_file_hashes['head'])
         merged_files, conflict_files, pulled_files = self._merge(
             our_lca_changes, branch, their_file_changes, their_files_hash, their_branch)
 
@@ -594,30 +972,26 @@ class BranchAPI(CommonAPI):
             meta['is_replay'] = True
             self.ipvc.stage.commit(commit_metadata=meta)
 
-        their_hashes = {ref: self.get_branch_info_hash(their_branch, ref) for ref in base_refs}
-        our_hashes = {ref: self.get_branch_info_hash(branch, ref) for ref in base_refs}
+        their_hashes, our_hashes = self.ipvc.run_async(
+            self.get_branch_info_hashes_async(their_branch, base_refs),
+            self.get_branch_info_hashes_async(branch, base_refs))
 
         # Find the Lowest Common Ancestor
         lca_commit_hash, our_lca_path, their_lca_path = self._find_LCA(
             our_hashes['head'], their_hashes['head'])
 
-        lca_files_hash = self._ref_files_hash(lca_commit_hash)
-        their_files_hash = self._ref_files_hash(their_hashes['head'])
-        our_file_hashes = {ref: self._ref_files_hash(our_hashes[ref]) for ref in base_refs}
-        # Check collisions with stage and workspace changes
-        # NOTE: Check staged changes first since workspace contains changes based
-        # on the staged changes
-        our_file_changes = {ref: self._get_file_changes(
-            our_file_hashes['head'], our_file_hashes[ref]) for ref in ['stage', 'workspace']}
-
-        their_file_changes = self._get_file_changes(lca_files_hash, their_files_hash)
+        (lca_files_hash, their_files_hash, our_file_hashes, our_file_changes,
+         their_file_changes, _) = self.ipvc.run_async(
+             self._merge_changes_async(lca_commit_hash, their_hashes, our_hashes))
         if not resume:
-            stage_conflict_set = our_file_changes['stage'].keys() & their_file_changes.keys()
+            stage_conflict_set = (changed_paths(our_file_changes['stage']) &
+                                  changed_paths(their_file_changes))
             if len(stage_conflict_set) > 0:
                 self.print_err('Pull conflicts with local staged changes in:')
                 self.print_err('\n'.join(list(stage_conflict_set)))
                 raise RuntimeError()
-            workspace_conflict_set = our_file_changes['workspace'].keys() & their_file_changes.keys()
+            workspace_conflict_set = (changed_paths(our_file_changes['workspace']) &
+                                      changed_paths(their_file_changes))
             if len(workspace_conflict_set) > 0:
                 self.print_err('Pull conflicts with local workspace changes in:')
                 self.print_err('\n'.join(list(workspace_conflict_set)))
@@ -643,9 +1017,10 @@ class BranchAPI(CommonAPI):
         curr_lca_to_head_changes = their_file_changes
         curr_head_files_hash = their_files_hash
 
-        our_lca_files_hashes = [self._ref_files_hash(h) for h in our_lca_path]
-        our_changes = [self._get_file_changes(h1, h2) for h1, h2
-                       in zip(our_lca_files_hashes[:-1], our_lca_files_hashes[1:])]
+        our_lca_files_hashes = self.ipvc.run_async(
+            self._ref_files_hashes_async(our_lca_path))
+        our_changes = self.ipvc.run_async(self._get_file_changes_async(
+            list(zip(our_lca_files_hashes[:-1], our_lca_files_hashes[1:]))))
 
         # For each of our changeset, merge with the current head
         # We skip the first commit in the path (being the LCA)
@@ -714,6 +1089,7 @@ class BranchAPI(CommonAPI):
             # TODO: read IPFS node url from settings
             url = f'http://localhost:8080/ipfs/{commit_files_hash}'
             self.print(f'Opening {url}')
+            import webbrowser
             webbrowser.open(url)
         else:
             ret = self.ipfs.ls(f'/ipfs/{commit_files_hash}')
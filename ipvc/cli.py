@@ -1,53 +1,28 @@
+import io
 import os
 import sys
+import json
+import time
 import shlex
 import argparse
-import cProfile
+import contextlib
 import shutil
 from pathlib import Path
 
-from .ipvc_api import IPVC
+from .backend import BACKENDS
 import ipvc
 
-def main():
-    cwd = Path.cwd()
-    desc = 'Inter-Planetary Versioning Control (System)'
+def parse_size(size):
+    """ Parses a size in bytes with an optional K, M, G or T suffix """
+    units = {'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
+    size = size.strip().upper()
+    if len(size) > 0 and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
 
-    parser = argparse.ArgumentParser(description=desc)
-    parser.add_argument(
-        '-v', '--verbose', action='store_true', help='Verbose output')
-    parser.add_argument(
-        '-q', '--quiet', action='store_true', help='No printing to stdout')
-    parser.add_argument(
-        '-qr', '--quieter', action='store_true', help='No printing to stdout/stderr')
-    parser.add_argument(
-        '-p', '--profile', action='store_true', help='Profile the program')
-    parser.add_argument(
-        '-r', '--record', help='Record command as test, to output folder',
-        default=None)
-    parser.add_argument(
-        '-n', '--mfs-namespace', help='IPFS/MFS namespace for IPVC', default=None)
-    parser.add_argument(
-        '-i', '--ipfs-ip', help='IPFS node ip and port string, e.g. "127.0.0.1:5001"',
-        default=None)
-    parser.add_argument(
-        '-d', '--delete-mfs', action='store_true', help='Delete IPVC in IPFS/MFS before running command')
-    parser.add_argument(
-        '-c', '--cwd', help='Set the current working dir (cwd)')
-    parser.set_defaults(command='help', subcommand='')
-    subparsers = parser.add_subparsers()
 
-    # ------------- HELP --------------
-    help_parser = subparsers.add_parser('help', description='Display help')
-    help_parser.set_defaults(command='help', subcommand='')
-
-    version_parser = subparsers.add_parser('version', description='Display version')
-    version_parser.set_defaults(command='version', subcommand='')
-
-    # ------------- ID --------------
-    id_parser = subparsers.add_parser('id', description='Identity functions')
-    id_parser.set_defaults(command='id', subcommand='ls')
-    id_subparsers = id_parser.add_subparsers()
+def _add_id_parsers(parser, cwd):
+    id_subparsers = parser.add_subparsers()
 
     id_ls_parser = id_subparsers.add_parser(
         'ls', description='List all local and remote ids')
@@ -62,6 +37,9 @@ def main():
         'key', help='Key name')
     id_create_parser.add_argument(
         '-u', '--use', action="store_true", help='Use newly created key for this repo')
+    id_create_parser.add_argument(
+        '-t', '--type', dest='key_type', choices=['rsa', 'ed25519'], default='rsa',
+        help='Key type used for signing commits')
 
     id_get_parser = id_subparsers.add_parser(
         'get', description='Get identity used for repo or key')
@@ -99,10 +77,9 @@ def main():
     id_resolve_parser.add_argument('--name', help='Remote name')
     id_resolve_parser.add_argument('--peer_id', help='Remote peer id')
 
-    # ------------- REPO --------------
-    repo_parser = subparsers.add_parser('repo', description='Repository functions')
-    repo_parser.set_defaults(command='repo', subcommand='ls')
-    repo_subparsers = repo_parser.add_subparsers()
+
+def _add_repo_parsers(parser, cwd):
+    repo_subparsers = parser.add_subparsers()
 
     repo_ls_parser = repo_subparsers.add_parser(
         'ls', description='List all repos in IPFS node')
@@ -122,6 +99,22 @@ def main():
     repo_rm_parser.set_defaults(subcommand='rm')
     repo_rm_parser.add_argument('--path', help='Path to repo to remove', default=cwd)
 
+    repo_worktree_parser = repo_subparsers.add_parser(
+        'worktree', description='Create a linked worktree for the repo, or list worktrees')
+    repo_worktree_parser.set_defaults(subcommand='worktree')
+    repo_worktree_parser.add_argument(
+        'path', nargs='?', help='Path of the new worktree', default=None)
+    repo_worktree_parser.add_argument(
+        '-b', '--branch', help='Branch to check out, defaults to the current branch', default=None)
+
+    repo_migrate_parser = repo_subparsers.add_parser(
+        'migrate', description='Rewrite the commits of all branches to a commit format')
+    repo_migrate_parser.set_defaults(subcommand='migrate')
+    repo_migrate_parser.add_argument(
+        '-f', '--format', dest='commit_format', type=int, default=2,
+        help=('Commit format version. Version 2 stores parent hashes in the '
+              'commit metadata, making history traversal faster'))
+
     repo_id_parser = repo_subparsers.add_parser('id', description='Get/set ID for repo')
     repo_id_parser.set_defaults(subcommand='id')
     repo_id_parser.add_argument('key', nargs='?', help='Key name', default=None)
@@ -147,14 +140,15 @@ def main():
     repo_clone_parser.set_defaults(subcommand='clone')
     repo_clone_parser.add_argument(
         '--as-name', help='Clone repo as name')
+    repo_clone_parser.add_argument(
+        '--sparse', nargs='+', default=None,
+        help='Only check out paths matching these patterns')
     repo_clone_parser.add_argument(
         'remote', help='Remote to clone from on the format "{PeerID}/{repository}"')
 
-    # ------------- BRANCH --------------
-    branch_parser = subparsers.add_parser(
-        'branch', description='Handle branches')
-    branch_parser.set_defaults(command='branch', subcommand='status')
-    branch_subparsers = branch_parser.add_subparsers()
+
+def _add_branch_parsers(parser, cwd):
+    branch_subparsers = parser.add_subparsers()
 
     branch_status_parser = branch_subparsers.add_parser(
         'status', description='Show status of current branch')
@@ -176,12 +170,26 @@ def main():
     branch_checkout_parser.add_argument(
         '--without-timestamps', action='store_true', help='Checkout files without timestamps (note this will slow down ipvc in the subsequent commands')
 
+    branch_sparse_parser = branch_subparsers.add_parser(
+        'sparse', description='Get/set sparse checkout patterns for the current branch')
+    branch_sparse_parser.set_defaults(subcommand='sparse')
+    branch_sparse_parser.add_argument(
+        'patterns', nargs='*', help='Path patterns to check out, e.g. "data/train" or "*.csv"')
+    branch_sparse_parser.add_argument(
+        '--clear', action='store_true', help='Remove the patterns and check out everything')
+
     branch_history_parser = branch_subparsers.add_parser(
         'history', description='Show branch commit history')
     branch_history_parser.set_defaults(subcommand='history')
     branch_history_parser.add_argument(
         '-s', '--show-hash', action='store_true', help='Shows hashes to commit content')
 
+    branch_verify_parser = branch_subparsers.add_parser(
+        'verify', description='Verify the signatures of the commits in the branch history')
+    branch_verify_parser.set_defaults(subcommand='verify')
+    branch_verify_parser.add_argument(
+        '--since', help='Only verify commits after this commit (e.g. @head~~~ or a commit hash)', default=None)
+
     branch_rewrite = branch_subparsers.add_parser(
         'rewrite', description='Rewrite branch history up to the last merge')
     branch_rewrite.set_defaults(subcommand='history')
@@ -212,6 +220,8 @@ def main():
         '-a', '--abort', action='store_true', help='Aborts merge after a conflict')
     branch_merge_parser.add_argument(
         '-r', '--resolve', default=None, const=True, nargs='?', help='Resolve a merge conflict, with optional commit message')
+    branch_merge_parser.add_argument(
+        '-m', '--message', default=None, help='Commit message of the merge commit')
     branch_merge_parser.add_argument(
         'their_branch', nargs='?', help='the name of their branch to pull changes from')
 
@@ -244,11 +254,8 @@ def main():
         'branch', nargs='?', help='Branch to unpublish')
 
 
-    # ------------- STAGE --------------
-    stage_parser = subparsers.add_parser(
-        'stage', description='Add/remove changes to stage and handle commits')
-    stage_parser.set_defaults(command='stage', subcommand='status')
-    stage_subparsers = stage_parser.add_subparsers()
+def _add_stage_parsers(parser, cwd):
+    stage_subparsers = parser.add_subparsers()
 
     stage_add_parser = stage_subparsers.add_parser(
         'add', description='Stage changes in a folder or file')
@@ -277,14 +284,211 @@ def main():
         'diff', description='Display diff between head and stage')
     stage_diff_parser.set_defaults(subcommand='diff')
 
-    # ------------- DIFF --------------
-    diff_parser = subparsers.add_parser(
-        'diff', description='Display a diff between two ref paths, defaults to stage and workspace')
-    diff_parser.set_defaults(command='diff', subcommand='run')
-    diff_parser.add_argument(
+
+def _add_diff_arguments(parser, cwd):
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument(
         '-f', '--files', action='store_true', help='Shows a list of changed files only')
-    diff_parser.add_argument('to_refpath', nargs='?', help='to refpath', default='@workspace')
-    diff_parser.add_argument('from_refpath', nargs='?', help='from refpath', default='@stage')
+    mode.add_argument(
+        '--stat', action='store_true',
+        help='Shows the number of changed lines per file, with a summary')
+    mode.add_argument(
+        '--numstat', action='store_true',
+        help='Shows the numbers of added and removed lines per file, tab separated')
+    mode.add_argument(
+        '--dirstat', action='store_true',
+        help='Shows the share of changed bytes per directory')
+    parser.add_argument(
+        '-k', '--key', metavar='COLUMNS',
+        help='Diffs CSV and TSV files by rows, matched by the values of these '
+             'comma separated columns')
+    parser.add_argument(
+        '--delimiter', help='Delimiter of the tables diffed with --key, '
+                            'defaults to the one of the file extension')
+    parser.add_argument('to_refpath', nargs='?', help='to refpath', default='@workspace')
+    parser.add_argument('from_refpath', nargs='?', help='from refpath', default='@stage')
+
+
+# Commands with their description, default subcommand and a function that
+# adds their subcommands and arguments to the command's parser
+COMMANDS = [
+    ('id', 'Identity functions', 'ls', _add_id_parsers),
+    ('repo', 'Repository functions', 'ls', _add_repo_parsers),
+    ('branch', 'Handle branches', 'status', _add_branch_parsers),
+    ('stage', 'Add/remove changes to stage and handle commits', 'status',
+     _add_stage_parsers),
+    ('diff', 'Display a diff between two ref paths, defaults to stage and workspace',
+     'run', _add_diff_arguments),
+]
+
+
+def add_command_parsers(subparsers, cwd, argv=None):
+    """ Adds the parsers of COMMANDS, with the subcommands and arguments of
+    those named in `argv`, or of all commands if `argv` is None """
+    for name, description, subcommand, add_parsers in COMMANDS:
+        command_parser = subparsers.add_parser(name, description=description)
+        command_parser.set_defaults(command=name, subcommand=subcommand)
+        if argv is None or name in argv:
+            add_parsers(command_parser, cwd)
+
+
+def _json_default(obj):
+    if isinstance(obj, (set, frozenset)):
+        try:
+            return sorted(obj)
+        except TypeError:
+            return list(obj)
+    if isinstance(obj, bytes):
+        return obj.decode('utf-8', errors='replace')
+    return str(obj)
+
+
+def run_batch(api, lines, cwd, out=None, stop_on_error=False):
+    """ Runs the commands in `lines` against the IPVC instance `api`, so that
+    the connection and caches are shared between them, and writes a JSON line
+    for each command to `out` with its result and output. A line may start
+    with "-c <dir>" to run the command in another directory. Returns the number
+    of failed commands """
+    out = out or sys.stdout
+    # Parsers by working directory, since it's used for argument defaults
+    parsers = {}
+    def _get_parser(line_cwd):
+        if line_cwd not in parsers:
+            parser = argparse.ArgumentParser(prog='ipvc', add_help=False)
+            parser.add_argument('-c', '--cwd', default=None)
+            add_command_parsers(parser.add_subparsers(), line_cwd)
+            parsers[line_cwd] = parser
+        return parsers[line_cwd]
+
+    cwd_parser = argparse.ArgumentParser(add_help=False)
+    cwd_parser.add_argument('-c', '--cwd', default=None)
+
+    num_failed = 0
+    for line_num, line in enumerate(lines, 1):
+        try:
+            argv = shlex.split(line, comments=True)
+        except ValueError as e:
+            argv, error = None, str(e)
+        if argv == []:
+            continue
+
+        stdout, stderr = io.StringIO(), io.StringIO()
+        ok, ret, error = False, None, None
+        t0 = time.perf_counter()
+        with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+            try:
+                if argv is None:
+                    raise RuntimeError(error)
+                line_cwd = cwd_parser.parse_known_args(argv)[0].cwd
+                line_cwd = (cwd / line_cwd).resolve() if line_cwd else cwd
+                args = _get_parser(line_cwd).parse_args(argv)
+                if not hasattr(args, 'command'):
+                    raise RuntimeError('No command given')
+                kwargs = dict(args._get_kwargs())
+                command = kwargs.pop('command')
+                subcommand = kwargs.pop('subcommand')
+                kwargs.pop('cwd')
+                # Changing the working directory clears the cached properties,
+                # so it's only done when the directory changes
+                if api.cwd != line_cwd:
+                    api.set_cwd(line_cwd)
+                ret = getattr(getattr(api, command), subcommand)(**kwargs)
+                ok = True
+            except RuntimeError as e:
+                if str(e):
+                    print(e, file=sys.stderr)
+                    error = str(e)
+            except SystemExit:
+                # argparse exits on invalid arguments, after printing usage
+                pass
+            except Exception as e:
+                # Unexpected errors fail the command, not the whole batch
+                error = f'{type(e).__name__}: {e}'
+                print(error, file=sys.stderr)
+
+        out.write(json.dumps({
+            'line': line_num, 'command': line.strip(), 'ok': ok, 'error': error,
+            'seconds': time.perf_counter() - t0, 'result': ret,
+            'stdout': stdout.getvalue(), 'stderr': stderr.getvalue(),
+        }, default=_json_default) + '\n')
+        out.flush()
+        if not ok:
+            num_failed += 1
+            if stop_on_error:
+                break
+    return num_failed
+
+
+def main():
+    cwd = Path.cwd()
+    desc = 'Inter-Planetary Versioning Control (System)'
+
+    parser = argparse.ArgumentParser(description=desc)
+    parser.add_argument(
+        '-v', '--verbose', action='store_true', help='Verbose output')
+    parser.add_argument(
+        '-q', '--quiet', action='store_true', help='No printing to stdout')
+    parser.add_argument(
+        '-qr', '--quieter', action='store_true', help='No printing to stdout/stderr')
+    parser.add_argument(
+        '-p', '--profile', action='store_true', help='Profile the program')
+    parser.add_argument(
+        '-r', '--record', help='Record command as test, to output folder',
+        default=None)
+    parser.add_argument(
+        '-n', '--mfs-namespace', help='IPFS/MFS namespace for IPVC', default=None)
+    parser.add_argument(
+        '-i', '--ipfs-ip', help=('IPFS node ip and port string, e.g. "127.0.0.1:5001", '
+                                 'or a Unix domain socket of the API, e.g. "unix:/path/to/api.sock"'),
+        default=None)
+    parser.add_argument(
+        '-d', '--delete-mfs', action='store_true', help='Delete IPVC in IPFS/MFS before running command')
+    parser.add_argument(
+        '-c', '--cwd', help='Set the current working dir (cwd)')
+    parser.add_argument(
+        '--buffer-size', type=int, default=None,
+        help='Number of bytes to read from IPFS at a time when writing files to disk')
+    parser.add_argument(
+        '--cache-dir', default=None, help='Directory for local caches, defaults to ~/.cache/ipvc')
+    parser.add_argument(
+        '--cache-size', type=parse_size, default=None,
+        help='Max size of the local object cache, e.g. "500M" or "20G", 0 disables it')
+    parser.add_argument(
+        '--backend', choices=BACKENDS, default=os.environ.get('IPVC_BACKEND', 'daemon'),
+        help=('Storage backend, either the IPFS daemon or a local store that needs no '
+              'daemon, defaults to $IPVC_BACKEND or "daemon"'))
+    parser.add_argument(
+        '--store-dir', default=None,
+        help='Directory of the local store backend, defaults to ~/.local/share/ipvc/store')
+    parser.add_argument(
+        '--trace', default=None, metavar='FILE',
+        help=('Trace API calls and IPFS calls, and write the trace to FILE in the '
+              'Chrome trace event format, with a summary printed to stderr'))
+    parser.set_defaults(command='help', subcommand='')
+    subparsers = parser.add_subparsers()
+
+    # ------------- HELP --------------
+    help_parser = subparsers.add_parser('help', description='Display help')
+    help_parser.set_defaults(command='help', subcommand='')
+
+    version_parser = subparsers.add_parser('version', description='Display version')
+    version_parser.set_defaults(command='version', subcommand='')
+
+    # ------------- BATCH --------------
+    batch_parser = subparsers.add_parser(
+        'batch', description=('Run commands read from a file or stdin, one per line '
+                              '(e.g. "stage add data"), in a single process, and '
+                              'print the result of each as a JSON line'))
+    batch_parser.set_defaults(command='batch', subcommand='')
+    batch_parser.add_argument(
+        'script', nargs='?', default='-', help='File with commands, defaults to stdin')
+    batch_parser.add_argument(
+        '-x', '--stop-on-error', action='store_true', help='Stop at the first failing command')
+
+    # Only the commands named on the command line get their subcommands and
+    # arguments added, since building all the parsers is a noticeable part
+    # of the startup time
+    add_command_parsers(subparsers, cwd, sys.argv[1:])
 
     args = parser.parse_args()
     kwargs = dict(args._get_kwargs())
@@ -300,6 +504,12 @@ def main():
     mfs_namespace = kwargs.pop('mfs_namespace')
     cwd = kwargs.pop('cwd') or cwd # Overwrite cwd with supplied path
     record_dir = kwargs.pop('record')
+    buffer_size = kwargs.pop('buffer_size')
+    cache_dir = kwargs.pop('cache_dir')
+    cache_size = kwargs.pop('cache_size')
+    backend = kwargs.pop('backend')
+    store_dir = kwargs.pop('store_dir')
+    trace_file = kwargs.pop('trace')
 
     n_path = None
     stdout_file, stderr_file = None, None
@@ -335,11 +545,33 @@ def main():
         print(ipvc.__version__)
         exit(0)
 
+    # Imported here so that commands that don't need the API start quickly
+    from .ipvc_api import IPVC
     api = IPVC(quiet=quiet, quieter=quieter, verbose=verbose,
                mfs_namespace=mfs_namespace, ipfs_ip=ipfs_ip, cwd=cwd,
-               delete_mfs=delete_mfs, stdout=stdout_file, stderr=stderr_file)
-    route = getattr(getattr(api, args.command), args.subcommand)
+               delete_mfs=delete_mfs, stdout=stdout_file, stderr=stderr_file,
+               buffer_size=buffer_size, cache_dir=cache_dir,
+               cache_size=cache_size, backend=backend, store_dir=store_dir,
+               trace=trace_file is not None)
+    if args.command == 'batch':
+        def route(script, stop_on_error):
+            f = sys.stdin if script == '-' else open(script)
+            try:
+                num_failed = run_batch(api, f, Path(cwd), stop_on_error=stop_on_error)
+            finally:
+                if f is not sys.stdin:
+                    f.close()
+            if num_failed > 0:
+                raise RuntimeError()
+    else:
+        route = getattr(getattr(api, args.command), args.subcommand)
+
+    def _write_trace():
+        if trace_file is not None:
+            api.tracer.export_chrome(trace_file)
+            print(api.tracer.format_summary(), file=sys.stderr)
     if args.profile:
+        import cProfile
         cProfile.run('route(**kwargs)')
     else:
         def _clean_up():
@@ -356,6 +588,8 @@ def main():
         except:
             _clean_up()
             raise
+        finally:
+            _write_trace()
 
     if record_dir is not None:
         shutil.copytree(cwd, n_path / 'post')
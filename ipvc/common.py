@@ -2,28 +2,43 @@ import os
 import io
 import sys
 import json
+import asyncio
 import tempfile
 import hashlib
+import codecs
 import difflib
+import fnmatch
+import itertools
+from array import array
 from datetime import datetime
 from functools import wraps
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from subprocess import call
 
 import ipfsapi
 
-from Crypto.PublicKey import RSA
-from Crypto import Cipher
-
-import crypto_pb2
 import base64
 
+from ipvc.signing import RSASigner, Ed25519Signer
+from ipvc.trace import traced
+from ipvc.dag import MAX_LEAF_SIZE
+from ipvc import similarity, linediff
+
+# Parsed keys by key file path, together with the stat of the file when parsed
+_PEER_KEYS_CACHE = {}
+# Commit metadata by commit hash. Commits are immutable so this never has to be
+# invalidated
+_COMMIT_METADATA_CACHE = {}
+
 def deserialize_pk_protobuf(byte_message, proto_type):
     """
     This is a function to decode the PrivKey in the IPFS config, since it is
     in a protobuf format
     (see https://stackoverflow.com/questions/54270908/how-to-decode-ipfs-private-and-public-key-in-der-pem-format/54271911#54271911)
     """
+    import crypto_pb2
     module_, class_ = proto_type.rsplit('.', 1)
     class_ = getattr(crypto_pb2, class_) # crypto_pb2 is a name of module we recently created and imported
     rv = class_()
@@ -61,11 +76,170 @@ def separate_refpath(refpath: Path):
     return parts[0], Path(*parts[1:])
 
 
+def path_is_under(path, parent):
+    """ Checks whether the relative path string `path` is equal to or
+    under `parent`, where an empty `parent` is the root """
+    return parent == '' or path == parent or path.startswith(parent + '/')
+
+
+def normalize_sparse_pattern(pattern):
+    pattern = str(pattern).strip()
+    if pattern.startswith('./'):
+        pattern = pattern[2:]
+    return pattern.strip('/')
+
+
+def sparse_match(path, patterns):
+    """ Checks whether the relative path string `path` is included by the
+    sparse checkout `patterns`. A pattern (in fnmatch syntax) includes a path
+    if it matches the path itself or any of its parent directories. An empty
+    list of patterns includes everything """
+    if not patterns:
+        return True
+    parts = path.split('/')
+    for pattern in patterns:
+        for i in range(1, len(parts) + 1):
+            if fnmatch.fnmatchcase('/'.join(parts[:i]), pattern):
+                return True
+    return False
+
+
+def sparse_dir_may_match(dir_path, patterns):
+    """ Checks whether any path under the relative directory `dir_path` can
+    be included by the sparse checkout `patterns`, so that directories that
+    can't be are never traversed """
+    if not patterns or dir_path == '' or sparse_match(dir_path, patterns):
+        return True
+    dir_prefix = dir_path + '/'
+    for pattern in patterns:
+        # Compare against the literal part of the pattern before any wildcard
+        literal = pattern
+        for i, c in enumerate(pattern):
+            if c in '*?[':
+                literal = pattern[:i]
+                break
+        if literal.startswith(dir_prefix) or dir_prefix.startswith(literal):
+            return True
+    return False
+
+
+def remove_workspace_file(fs_repo_root, path):
+    """ Removes the file at `path` (relative to `fs_repo_root`) if it exists,
+    and any of its parent directories below the repo root that it leaves
+    empty """
+    try:
+        os.remove(fs_repo_root / path)
+    except FileNotFoundError:
+        pass
+    for parent in Path(path).parents:
+        if parent == Path('.'):
+            break
+        try:
+            os.rmdir(fs_repo_root / parent)
+        except OSError:
+            # Not empty, or already removed
+            break
+
+
 def make_len(string, num):
     string = string[:num]
     return string + ' '*(num-len(string))
 
 
+def is_binary(head: bytes):
+    """ Whether a file that starts with `head` is binary, which is when
+    there is a NUL byte or invalid UTF-8 in it """
+    if b'\0' in head:
+        return True
+    try:
+        # The head can end in the middle of a character, which the
+        # incremental decoder allows
+        codecs.getincrementaldecoder('utf-8')().decode(head)
+    except UnicodeDecodeError:
+        return True
+    return False
+
+
+def truncate_diff(lines, max_lines):
+    """ Returns the first `max_lines` lines of a diff, followed by a note of
+    how many lines were left out, if any """
+    lines = iter(lines)
+    out = list(itertools.islice(lines, max_lines))
+    num_left = sum(1 for _ in lines)
+    if num_left > 0:
+        out.append(f'... {num_left} more lines of diff not shown')
+    return out
+
+
+def format_hunk_range(start, stop):
+    """ Formats a range of lines for a hunk header like difflib does """
+    length = stop - start
+    if length == 1:
+        return f'{start + 1}'
+    return f'{start + 1 if length > 0 else start},{length}'
+
+
+# Number of files to fetch from IPFS concurrently when writing a ref to disk
+MATERIALIZE_WORKERS = 8
+# Default number of bytes to read from IPFS at a time when writing a file to
+# disk. Peak memory use is bounded by MATERIALIZE_WORKERS times this number
+MATERIALIZE_BUFFER_SIZE = 4 * 1024 * 1024
+# Suffix for files that are in the process of being written to disk
+PARTIAL_SUFFIX = '.ipvc_partial'
+# Default maximum size in bytes of the local object cache
+OBJECT_CACHE_SIZE = 10 * 1024**3
+# Number of files to fetch ahead of the one being diffed when showing a diff
+DIFF_PREFETCH = 8
+# Files are binary if there's a NUL byte or invalid UTF-8 in this many bytes
+# at the start, which are read before the rest of the file
+BINARY_SNIFF_SIZE = 8000
+# Text files up to this size are diffed and merged in memory. Bigger files
+# are diffed by the hashes of their lines, see CommonAPI._line_hash_diff, and
+# are not merged line by line
+DIFF_TEXT_SIZE = 1024 * 1024
+# Files bigger than this are not diffed, only their sizes are shown
+DIFF_MAX_SIZE = 256 * 1024**2
+# Maximum number of lines of diff shown for a file
+DIFF_MAX_LINES = 10000
+# Default maximum size in bytes of the local cache of diffs between files
+DIFF_CACHE_SIZE = 256 * 1024**2
+# Suffix of their version of a file that can't be merged line by line
+THEIRS_SUFFIX = '.theirs'
+# Added and removed files that are at least this similar are shown as renames
+RENAME_SIMILARITY = 0.5
+# Change types in addition to the ones of object_diff (0: added, 1: removed
+# and 2: modified), for changes paired up by CommonAPI._find_renames
+RENAMED, COPIED = 3, 4
+# Commit format version 2 stores the parent hashes in the commit metadata as
+# well as in the data/parent and data/merge_parent links, so that walking the
+# history only needs to fetch the metadata of each commit
+DEFAULT_COMMIT_FORMAT = 1
+LATEST_COMMIT_FORMAT = 2
+
+
+def default_cache_dir():
+    """ Directory for ipvc's local caches """
+    cache_home = os.environ.get('XDG_CACHE_HOME', None)
+    if cache_home is None:
+        return Path.home() / '.cache' / 'ipvc'
+    return Path(cache_home) / 'ipvc'
+
+
+def default_store_dir():
+    """ Directory for the blocks and MFS of the local storage backend """
+    data_home = os.environ.get('XDG_DATA_HOME', None)
+    if data_home is None:
+        return Path.home() / '.local' / 'share' / 'ipvc' / 'store'
+    return Path(data_home) / 'ipvc' / 'store'
+
+
+# Repo info that belongs to each worktree, all other info is shared by the
+# worktrees of a repo
+WORKTREE_REPO_INFO = ['active_branch_name', 'worktree_of']
+# Branch info that is shared by the worktrees of a repo
+SHARED_BRANCH_INFO = [('head',), ('remote',)]
+
+
 # NOTE: set this variable to True to test that cached properties
 #       are cached correctly
 TEST_CACHING = False
@@ -73,6 +247,7 @@ def cached_property(prop):
     @wraps(prop)
     def _impl(self, *args, **kwargs):
         name = prop.__name__
+        self.ipvc.load_property_cache()
         if name not in self.ipvc._property_cache:
             self.ipvc._property_cache[name] = prop(self, *args, **kwargs)
 
@@ -96,27 +271,50 @@ def atomic(api_method):
     fail
     """
 
-    @wraps(api_method)
-    def _impl(self, *args, **kwargs):
-        if self._in_atomic_operation:
-            return api_method(self, *args, **kwargs)
-
+    def _atomic_call(self, *args, **kwargs):
         self._in_atomic_operation = True
         timestamp = datetime.now().strftime("%Y%m%d-%H%M%S.%f") 
         snapshot_dir = self.namespace / f'ipvc_snapshots/{timestamp}'
         self.ipfs.files_cp(self.namespace / 'ipvc', snapshot_dir)
 
+        # Mutations within the method don't flush MFS up to the root, that is
+        # done once at the end instead. The snapshot above is always flushed
+        self.ipvc.mfs_batch_depth += 1
         try:
             ret = api_method(self, *args, **kwargs)
         except:
             self._in_atomic_operation = False
             self.ipfs.files_rm(self.namespace / 'ipvc', recursive=True)
             self.ipfs.files_cp(snapshot_dir, self.namespace / 'ipvc')
+            # Properties cached within the method may be from the state that
+            # was rolled back
+            self.invalidate_cache()
             raise
+        finally:
+            self.ipvc.mfs_batch_depth -= 1
+            if self.ipvc.mfs_batch_depth == 0:
+                try:
+                    self.ipvc.mfs_flush()
+                except:
+                    # The changes of the method were dropped, see
+                    # localstore.Store.flush
+                    self._in_atomic_operation = False
+                    self.invalidate_cache()
+                    raise
 
         self._in_atomic_operation = False
+        self.ipvc.save_property_cache()
         return ret
 
+    @wraps(api_method)
+    def _impl(self, *args, **kwargs):
+        if self._in_atomic_operation:
+            return api_method(self, *args, **kwargs)
+
+        self.ipvc.load_property_cache()
+        with self.ipvc.tracer.span(api_method.__qualname__, 'api'):
+            return _atomic_call(self, *args, **kwargs)
+
     return _impl
 
 
@@ -148,7 +346,7 @@ class CommonAPI:
             print(*args, **kwargs, file=self.stderr)
 
     def print_changes(self, changes):
-        self.print(self._format_changes(changes, files=True))
+        self._print_diff(changes, files=True)
 
     def invalidate_cache(self, props=None):
         if props is None:
@@ -200,11 +398,17 @@ class CommonAPI:
             return path / ipvc_info
         if fs_repo_root is None:
             return path
-        # Encode the repo path in hex so that we can store the path
-        # information in the directory name itself. Then there's no need to name
-        # it and store the path some other way
-        repo_hex = str(fs_repo_root).encode('utf-8').hex()
-        path = path / 'repos' / repo_hex
+
+        # Worktrees keep their own active branch, workspace and stage, but
+        # share everything else with the repo they were created from
+        is_shared = ((repo_info is not None and
+                      repo_info not in WORKTREE_REPO_INFO) or
+                     (branch_info is not None and
+                      Path(branch_info).parts[:1] in SHARED_BRANCH_INFO))
+        if is_shared:
+            fs_repo_root = self.get_repo_main_root(fs_repo_root)
+
+        path = self._get_mfs_repo_path(fs_repo_root)
         if repo_info is not None:
             return path / repo_info
         if branch is None:
@@ -217,6 +421,73 @@ class CommonAPI:
             return path / branch_info
         return path
 
+    def _get_mfs_repo_path(self, fs_repo_root):
+        # Encode the repo path in hex so that we can store the path
+        # information in the directory name itself. Then there's no need to name
+        # it and store the path some other way
+        repo_hex = str(fs_repo_root).encode('utf-8').hex()
+        return Path(self.namespace) / 'ipvc' / 'repos' / repo_hex
+
+    def get_repo_main_root(self, fs_repo_root):
+        """ Returns the root of the repo that the worktree at `fs_repo_root`
+        was created from, or `fs_repo_root` if it is not a worktree """
+        main_roots = self.ipvc._property_cache.setdefault('repo_main_roots', {})
+        if str(fs_repo_root) not in main_roots:
+            mfs_worktree_of = self._get_mfs_repo_path(fs_repo_root) / 'worktree_of'
+            try:
+                main_root = self.ipfs.files_read(mfs_worktree_of).decode('utf-8')
+            except ipfsapi.exceptions.StatusError:
+                main_root = str(fs_repo_root)
+            main_roots[str(fs_repo_root)] = main_root
+        return Path(main_roots[str(fs_repo_root)])
+
+    def get_worktrees(self, fs_repo_root):
+        """ Returns the worktree roots of the repo, including the main one """
+        main_root = self.get_repo_main_root(fs_repo_root)
+        mfs_worktrees = self.get_mfs_path(main_root, repo_info='worktrees')
+        return [main_root] + [Path(p) for p in self.mfs_read_json(mfs_worktrees) or []]
+
+    def set_worktrees(self, fs_repo_root, worktrees):
+        """ Sets the worktree roots of the repo, excluding the main one """
+        main_root = self.get_repo_main_root(fs_repo_root)
+        mfs_worktrees = self.get_mfs_path(main_root, repo_info='worktrees')
+        self.mfs_write_json([str(p) for p in worktrees], mfs_worktrees)
+
+    def _ensure_branch_refs(self, fs_repo_root, branch):
+        """ Makes sure that the stage and workspace of `branch` are in the
+        worktree at `fs_repo_root`, where it is being checked out. A branch
+        is only checked out in one worktree at a time, so they are moved here
+        from another worktree if needed, and the copies in other worktrees are
+        removed since they go stale as soon as the branch gets new commits.
+        They are created from the head if the branch has never been checked
+        out in the repo """
+        others = [w for w in self.get_worktrees(fs_repo_root) if w != fs_repo_root]
+        for ref in ['stage', 'workspace']:
+            mfs_ref = self.get_mfs_path(fs_repo_root, branch, branch_info=ref)
+            mfs_other_refs = []
+            for worktree in others:
+                mfs_other_ref = self.get_mfs_path(worktree, branch, branch_info=ref)
+                try:
+                    self.ipfs.files_stat(mfs_other_ref)
+                    mfs_other_refs.append(mfs_other_ref)
+                except ipfsapi.exceptions.StatusError:
+                    pass
+
+            try:
+                self.ipfs.files_stat(mfs_ref)
+            except ipfsapi.exceptions.StatusError:
+                self.ipfs.files_mkdir(mfs_ref.parent, parents=True)
+                if len(mfs_other_refs) > 0:
+                    self.ipfs.files_cp(mfs_other_refs[0], mfs_ref)
+                else:
+                    mfs_head_bundle = self.get_mfs_path(
+                        fs_repo_root, branch, branch_info='head/data/bundle')
+                    self.ipfs.files_mkdir(mfs_ref / 'data', parents=True)
+                    self.ipfs.files_cp(mfs_head_bundle, mfs_ref / 'data' / 'bundle')
+
+            for mfs_other_ref in mfs_other_refs:
+                self.ipfs.files_rm(mfs_other_ref, recursive=True)
+
     def get_active_branch(self, path):
         mfs_branch = self.get_mfs_path(
             path, repo_info='active_branch_name')
@@ -246,23 +517,76 @@ class CommonAPI:
     def branches(self):
         return self.repo_branches(self.fs_repo_root)
 
+    @property
+    @cached_property
+    def repo_registry(self):
+        """ The registered repos, by path, as kept in one MFS file so that
+        finding the repo of a path doesn't need a call per repo. Repos have
+        their name and id (key name), and worktrees the path of their repo
+        under 'worktree_of' """
+        mfs_registry = self.get_mfs_path(ipvc_info='repo_registry')
+        try:
+            return json.loads(self.ipfs.files_read(mfs_registry).decode('utf-8'))
+        except ipfsapi.exceptions.StatusError:
+            pass
+
+        # Repos created before the registry was added are registered from
+        # the repos dir
+        registry = {}
+        try:
+            entries = self.ipfs.files_ls(self.get_mfs_path(ipvc_info='repos'))['Entries']
+        except ipfsapi.exceptions.StatusError:
+            entries = []
+        for entry in entries or []:
+            fs_repo_path = bytes.fromhex(entry['Name']).decode('utf-8')
+            main_root = self.get_repo_main_root(fs_repo_path)
+            if str(main_root) != fs_repo_path:
+                registry[fs_repo_path] = {'worktree_of': str(main_root)}
+                continue
+            mfs_repo_id = self.get_mfs_path(fs_repo_path, repo_info='id')
+            try:
+                repo_id = self.ipfs.files_read(mfs_repo_id).decode('utf-8')
+            except ipfsapi.exceptions.StatusError:
+                repo_id = None
+            registry[fs_repo_path] = {
+                'name': self.get_repo_name(fs_repo_path), 'id': repo_id}
+        self.write_repo_registry(registry)
+        return registry
+
+    def write_repo_registry(self, registry):
+        self.mfs_write_json(registry, self.get_mfs_path(ipvc_info='repo_registry'))
+        self.invalidate_cache(['fs_repo_root'])
+        self.ipvc._property_cache['repo_registry'] = registry
+
+    def register_repo(self, fs_repo_root, worktree_of=None, **info):
+        """ Adds or updates the registry entry of a repo, with the `info`
+        items, or of a worktree of the repo at `worktree_of` """
+        registry = self.repo_registry
+        if worktree_of is not None:
+            registry[str(fs_repo_root)] = {'worktree_of': str(worktree_of)}
+        else:
+            registry.setdefault(str(fs_repo_root), {'name': None, 'id': None}).update(info)
+        self.write_repo_registry(registry)
+
+    def unregister_repo(self, fs_repo_root):
+        registry = self.repo_registry
+        registry.pop(str(fs_repo_root), None)
+        self.write_repo_registry(registry)
+
     @property
     def repos(self):
         """ Lists (name, hash, path) for all repos in IPVC """
+        registry = self.repo_registry
         repos = []
-        try:
-            mfs_repos_path = self.get_mfs_path(ipvc_info='repos')
-            ls = self.ipfs.files_ls(mfs_repos_path)
-            for entry in ls['Entries'] or []:
-                repo_hex = entry['Name']
-                fs_repo_path = bytes.fromhex(repo_hex).decode('utf-8')
-                mfs_repo_path = Path(mfs_repos_path) / repo_hex
-                repo_hash = self.ipfs.files_stat(mfs_repo_path)['Hash']
-                repo_name = self.get_repo_name(fs_repo_path)
-                repos.append((repo_name, repo_hash, fs_repo_path))
-            return repos
-        except ipfsapi.exceptions.StatusError:
-            return []
+        for fs_repo_path, entry in sorted(registry.items()):
+            main_entry = registry.get(entry.get('worktree_of', None), entry)
+            try:
+                repo_hash = self.ipfs.files_stat(
+                    self._get_mfs_repo_path(fs_repo_path))['Hash']
+            except ipfsapi.exceptions.StatusError:
+                continue
+            repos.append((main_entry.get('name', None), repo_hash, fs_repo_path))
+        return repos
 
     def set_cwd(self, cwd):
         self.fs_cwd = cwd
@@ -274,31 +598,43 @@ class CommonAPI:
         return self.get_repo_root()
 
     def get_repo_root(self, fs_cwd=None):
-        fs_cwd = fs_cwd or self.fs_cwd
-        for _, _, fs_repo_path in self.repos:
-            repo_parts = Path(fs_repo_path).parts
-            if fs_cwd.parts[:len(repo_parts)] == repo_parts:
-                return Path(fs_repo_path)
+        """ Returns the root of the repo that `fs_cwd` is in, by looking up
+        it and its parents in the registry """
+        fs_cwd = Path(fs_cwd or self.fs_cwd)
+        registry = self.repo_registry
+        for path in [fs_cwd, *fs_cwd.parents]:
+            if str(path) in registry:
+                return path
         return None
 
-    def workspace_changes(self, fs_add_path, fs_repo_root, metadata, update_meta=True):
+    @traced
+    def workspace_changes(self, fs_add_path, fs_repo_root, metadata,
+                          update_meta=True, patterns=None):
         """ Returns a list of updated, removed and modified file paths under
-        'fs_add_path' as compared to the stored metadata
+        'fs_add_path' as compared to the stored metadata. If sparse checkout
+        `patterns` are given, paths that are not included by them are neither
+        looked at on the filesystem nor in the metadata
         """
         fs_add_path_relative = Path(fs_add_path).relative_to(fs_repo_root)
         metadata_files = set()
         for path in metadata.keys():
             try:
                 Path(path).relative_to(fs_add_path_relative)
-                metadata_files.add(path)
+                if sparse_match(path, patterns):
+                    metadata_files.add(path)
             except:
                 pass
         if fs_add_path.is_file():
-            fs_add_files = set([str(fs_add_path_relative)])
+            fs_add_files = set()
+            if sparse_match(str(fs_add_path_relative), patterns):
+                fs_add_files.add(str(fs_add_path_relative))
+        elif patterns:
+            fs_add_files = set(self._sparse_walk(fs_add_path, fs_repo_root, patterns))
         else:
             fs_add_files = set(str(p.relative_to(fs_repo_root))
                                for p in fs_add_path.glob('**/*')
-                               if not p.is_dir())
+                               if not p.is_dir() and
+                               not p.name.endswith(PARTIAL_SUFFIX))
 
         added = fs_add_files - metadata_files
         removed = metadata_files - fs_add_files
@@ -315,6 +651,22 @@ class CommonAPI:
 
         return added, removed, modified
 
+    def _sparse_walk(self, fs_path, fs_repo_root, patterns):
+        """ Yields the relative paths of files under fs_path that are included
+        by the sparse checkout patterns, without descending into directories
+        that can't contain any included files """
+        for root, dirs, files in os.walk(fs_path):
+            root_relative = Path(root).relative_to(fs_repo_root)
+            root_relative = '' if str(root_relative) == '.' else str(root_relative)
+            dirs[:] = [d for d in dirs if sparse_dir_may_match(
+                f'{root_relative}/{d}' if root_relative else d, patterns)]
+            for name in files:
+                if name.endswith(PARTIAL_SUFFIX):
+                    continue
+                path = f'{root_relative}/{name}' if root_relative else name
+                if sparse_match(path, patterns):
+                    yield path
+
     def mfs_read_json(self, path):
         try:
             return json.loads(self.ipfs.files_read(path).decode('utf-8'))
@@ -335,6 +687,7 @@ class CommonAPI:
     def write_files_metadata(self, metadata, ref):
         self.mfs_write_json(metadata, self.get_metadata_file(ref))
 
+    @traced
     def add_fs_to_mfs(self, fs_add_path, mfs_ref):
         """ Adds the changes in a workspace under fs_add_path to a ref and
         returns the changes, and number of files that needed hashing
@@ -355,7 +708,17 @@ class CommonAPI:
         mfs_files_root = self.get_mfs_path(
             self.fs_repo_root, self.active_branch, branch_info=f'{mfs_ref}/data/bundle/files')
 
-        # Copy over the current ref root to a temporary
+        # Find the changes between the ref and the workspace. When there are
+        # none, which is common when running several commands in a row, the
+        # ref is left as it is
+        files_metadata = self.read_files_metadata(mfs_ref)
+        added, removed, modified = self.workspace_changes(
+            fs_add_path, self.fs_repo_root, files_metadata,
+            patterns=self.sparse_patterns)
+        if len(added) == len(removed) == len(modified) == 0:
+            return [], 0
+
+        # Copy over the current ref root to a temporary, and modify it
         mfs_new_files_root = Path(self.namespace) / 'ipvc' / 'tmp'
         try:
             self.ipfs.files_rm(mfs_new_files_root, recursive=True)
@@ -363,12 +726,6 @@ class CommonAPI:
             pass
         
         self.ipfs.files_cp(mfs_files_root, mfs_new_files_root)
-        add_path_relative = fs_add_path.relative_to(self.fs_repo_root)
-
-        # Find the changes between the ref and the workspace, and modify the tmp root
-        files_metadata = self.read_files_metadata(mfs_ref)
-        added, removed, modified = self.workspace_changes(
-            fs_add_path, self.fs_repo_root, files_metadata)
 
         for fs_path in removed | modified:
             self.ipfs.files_rm(mfs_new_files_root / fs_path, recursive=True)
@@ -505,30 +862,229 @@ class CommonAPI:
 
         return changes
 
+    def add_ipfs_path_to_ref(self, ipfs_path, ref, path):
+        """ Links `ipfs_path` into `ref` at `path` (relative to repo root)
+        directly in MFS, without going through the filesystem. This is used
+        for files that are outside of the sparse checkout """
+        mfs_path = self.get_mfs_path(
+            self.fs_repo_root, self.active_branch,
+            branch_info=f'{ref}/data/bundle/files/{path}')
+        try:
+            self.ipfs.files_rm(mfs_path, recursive=True)
+        except ipfsapi.exceptions.StatusError:
+            pass
+
+        try:
+            self.ipfs.files_mkdir(mfs_path.parent, parents=True)
+        except ipfsapi.exceptions.StatusError:
+            pass
+
+        self.ipfs.files_cp(ipfs_path, mfs_path)
+
+        # There's no file on disk to take the timestamp from
+        files_metadata = self.read_files_metadata(ref)
+        files_metadata[str(path)] = {'timestamp': None}
+        self.write_files_metadata(files_metadata, ref)
+
+    def remove_path_from_ref(self, ref, path):
+        """ Removes `path` (relative to repo root) from `ref` directly in MFS,
+        the counterpart of add_ipfs_path_to_ref """
+        mfs_path = self.get_mfs_path(
+            self.fs_repo_root, self.active_branch,
+            branch_info=f'{ref}/data/bundle/files/{path}')
+        try:
+            self.ipfs.files_rm(mfs_path, recursive=True)
+        except ipfsapi.exceptions.StatusError:
+            pass
+
+        files_metadata = self.read_files_metadata(ref)
+        files_metadata.pop(str(path), None)
+        self.write_files_metadata(files_metadata, ref)
+
+    @traced
     def _load_ref_into_repo(self, fs_repo_root, branch, ref,
                             without_timestamps=False):
         """ Syncs the fs workspace with the files in ref """
         files_metadata = self.read_files_metadata(ref)
         added, removed, modified = self.workspace_changes(
-            fs_repo_root, fs_repo_root, files_metadata, update_meta=False)
+            fs_repo_root, fs_repo_root, files_metadata, update_meta=False,
+            patterns=self.get_sparse_patterns(fs_repo_root, branch))
 
         _, mfs_refpath, _ = self.refpath_to_mfs(Path(f'@{ref}'))
 
         for path in added:
-            os.remove(fs_repo_root / path)
+            remove_workspace_file(fs_repo_root, path)
+
+        self._materialize_files(
+            fs_repo_root, branch, mfs_refpath, removed | modified,
+            files_metadata, without_timestamps)
+
+    @traced
+    def _load_ref_changes_into_repo(self, fs_repo_root, from_branch, to_branch,
+                                    ref, without_timestamps=False):
+        """ Syncs the fs workspace from `ref` in `from_branch` to `ref` in
+        `to_branch`, assuming that the fs workspace is already in sync with
+        the former. Unlike _load_ref_into_repo, this doesn't scan the
+        filesystem, but finds the changed paths by diffing the two file trees
+        by hash and only rewrites those
+        """
+        _, mfs_refpath, _ = self.refpath_to_mfs(Path(f'@{ref}'))
+        try:
+            from_hash = self.ipfs.files_stat(self.get_mfs_path(
+                fs_repo_root, from_branch, branch_info=mfs_refpath))['Hash']
+            to_hash = self.ipfs.files_stat(self.get_mfs_path(
+                fs_repo_root, to_branch, branch_info=mfs_refpath))['Hash']
+        except ipfsapi.exceptions.StatusError:
+            # One of the refs has no files, fall back to a full sync
+            self._load_ref_into_repo(
+                fs_repo_root, to_branch, ref, without_timestamps)
+            return
+
+        from_metadata = self.mfs_read_json(self.get_mfs_path(
+            fs_repo_root, from_branch,
+            branch_info=f'{ref}/data/bundle/files_metadata'))
+        to_metadata = self.mfs_read_json(self.get_mfs_path(
+            fs_repo_root, to_branch,
+            branch_info=f'{ref}/data/bundle/files_metadata'))
+
+        from_patterns = self.get_sparse_patterns(fs_repo_root, from_branch)
+        to_patterns = self.get_sparse_patterns(fs_repo_root, to_branch)
+
+        changes = []
+        if from_hash != to_hash:
+            changes = self.ipfs.object_diff(from_hash, to_hash)['Changes'] or []
+
+        # A change can be for a whole directory, so expand each changed path
+        # to the files under it in the metadata of either side
+        to_write, to_remove = set(), set()
+        for change in changes:
+            change_path = change['Path']
+            from_paths = set(p for p in from_metadata
+                             if path_is_under(p, change_path) and
+                             sparse_match(p, from_patterns))
+            to_paths = set(p for p in to_metadata
+                           if path_is_under(p, change_path) and
+                           sparse_match(p, to_patterns))
+            to_remove |= from_paths - to_paths
+            to_write |= to_paths
+
+        if from_patterns != to_patterns:
+            # Unchanged files can still move in or out of the sparse checkout
+            to_remove |= set(p for p in from_metadata
+                             if sparse_match(p, from_patterns) and
+                             not sparse_match(p, to_patterns))
+            to_write |= set(p for p in to_metadata
+                            if sparse_match(p, to_patterns) and
+                            not sparse_match(p, from_patterns))
+
+        for path in to_remove:
+            remove_workspace_file(fs_repo_root, path)
+
+        self._materialize_files(
+            fs_repo_root, to_branch, mfs_refpath, to_write, to_metadata,
+            without_timestamps)
+
+        if without_timestamps:
+            return
 
-        for path in removed | modified:
+        # Files with the same content may still have different timestamps
+        for path, meta in to_metadata.items():
+            if path in to_write or path not in from_metadata:
+                continue
+            if not sparse_match(path, to_patterns):
+                continue
+            timestamp = meta.get('timestamp', None)
+            if timestamp is not None and \
+                    from_metadata[path].get('timestamp', None) != timestamp:
+                os.utime(fs_repo_root / path, ns=(timestamp, timestamp))
+
+    @traced
+    def _materialize_files(self, fs_repo_root, branch, mfs_refpath, paths,
+                           files_metadata, without_timestamps=False):
+        """ Writes the files at `paths` (relative to the repo root) from
+        `mfs_refpath` in `branch` to the filesystem, fetching several files
+        from IPFS concurrently """
+        def _materialize(path):
             mfs_path = self.get_mfs_path(
-                fs_repo_root, branch,
-                branch_info=(mfs_refpath / path))
+                fs_repo_root, branch, branch_info=(mfs_refpath / path))
+            timestamp = None
+            if not without_timestamps:
+                timestamp = files_metadata.get(str(path), {}).get('timestamp', None)
+            self._materialize_file(mfs_path, fs_repo_root / path, timestamp)
 
-            timestamp = files_metadata[str(path)]['timestamp']
+        if len(paths) == 0:
+            return
 
-            with open(fs_repo_root / path, 'wb') as f:
-                f.write(self.ipfs.files_read(mfs_path))
+        with ThreadPoolExecutor(max_workers=MATERIALIZE_WORKERS) as executor:
+            # Consume the results so that any exception is re-raised here
+            list(executor.map(_materialize, paths))
+
+    def _materialize_file(self, mfs_path, fs_path, timestamp=None):
+        """ Copies the file at `mfs_path` (which can also be an /ipfs/ path)
+        to `fs_path`, reading at most `buffer_size` bytes at a time so that
+        memory use doesn't depend on the file size. If the content is in the
+        local object cache, it is cloned from there instead of read from IPFS.
+
+        The file is first written to a partial file next to `fs_path`, which
+        is then renamed in place, so `fs_path` never has partial content. The
+        partial file is named by the content hash, so if a previous
+        materialization of the same content was interrupted, it is resumed
+        from where it left off
+        """
+        stat = self.ipfs.files_stat(mfs_path)
+        size = stat['Size']
+        fs_path = Path(fs_path)
+        fs_path.parent.mkdir(parents=True, exist_ok=True)
+        partial_path = fs_path.parent / f'.{fs_path.name}.{stat["Hash"]}{PARTIAL_SUFFIX}'
+
+        object_cache = self.ipvc.object_cache
+        if object_cache is not None and object_cache.get(stat['Hash'], partial_path):
+            os.replace(partial_path, fs_path)
+            if timestamp is not None:
+                os.utime(fs_path, ns=(timestamp, timestamp))
+            return
 
-            os.utime(fs_repo_root / path, ns=(timestamp, timestamp))
+        offset = 0
+        if partial_path.exists():
+            offset = partial_path.stat().st_size
+            if offset > size:
+                offset = 0
+
+        with open(partial_path, 'r+b' if offset > 0 else 'wb') as f:
+            f.seek(offset)
+            f.truncate()
+            while offset < size:
+                chunk = self.ipfs.files_read(
+                    mfs_path, offset=offset, count=self.ipvc.buffer_size)
+                if len(chunk) == 0:
+                    self.print_err(f'Unexpected end of file reading {mfs_path}')
+                    raise RuntimeError()
+                f.write(chunk)
+                offset += len(chunk)
+
+        if object_cache is not None:
+            object_cache.put(stat['Hash'], partial_path)
+        os.replace(partial_path, fs_path)
+        if timestamp is not None:
+            os.utime(fs_path, ns=(timestamp, timestamp))
+
+    def get_sparse_patterns(self, fs_repo_root, branch):
+        mfs_patterns = self.get_mfs_path(
+            fs_repo_root, branch, branch_info='sparse_patterns')
+        return self.mfs_read_json(mfs_patterns) or []
+
+    def set_sparse_patterns(self, fs_repo_root, branch, patterns):
+        mfs_patterns = self.get_mfs_path(
+            fs_repo_root, branch, branch_info='sparse_patterns')
+        self.mfs_write_json(patterns, mfs_patterns)
+        self.invalidate_cache(['sparse_patterns'])
 
+    @property
+    @cached_property
+    def sparse_patterns(self):
+        return self.get_sparse_patterns(self.fs_repo_root, self.active_branch)
+
+    @traced
     def common(self):
         if self.fs_repo_root is None:
             self.print_err('No ipvc repository here')
@@ -558,6 +1114,21 @@ class CommonAPI:
 
         return commit_hash
 
+    async def get_branch_info_hashes_async(self, branch, infos):
+        """ Async variant of get_branch_info_hash that gets the hashes of
+        several infos concurrently, and returns them by info """
+        async def _hash(info):
+            mfs_path = self.get_mfs_path(
+                self.fs_repo_root, branch=branch, branch_info=info)
+            try:
+                return (await self.ipvc.aipfs.files_stat(str(mfs_path)))['Hash']
+            except ipfsapi.exceptions.StatusError:
+                self.print_err('No such ref')
+                raise RuntimeError()
+
+        hashes = await asyncio.gather(*[_hash(info) for info in infos])
+        return dict(zip(infos, hashes))
+
     def _diff_resolve_refs(self, to_refpath=None, from_refpath=None,
                            to_default="@workspace", from_default='@stage'):
         to_refpath, from_refpath  = Path(to_refpath), Path(from_refpath)
@@ -576,44 +1147,371 @@ class CommonAPI:
         return mfs_to_refpath, mfs_from_refpath
 
     def _format_changes(self, changes, files=False):
-        out = ''
+        out = '\n'.join(self._iter_diff_lines(changes, files=files)).strip()
+        if len(out) == 0:
+            out = '--------------------'
+        return out
+
+    def _print_diff(self, changes, files=False):
+        """ Prints the diff of `changes` line by line as it's produced, see
+        _iter_diff_lines """
+        empty = True
+        for line in self._iter_diff_lines(changes, files=files):
+            self.print(line)
+            empty = False
+        if empty:
+            self.print('--------------------')
+
+    def _iter_diff_lines(self, changes, files=False):
+        """ Yields the lines of the diff of `changes`, either one line per
+        change with the hashes of the files if `files`, or a unified diff of
+        the content of each file """
         if files:
-            for change in changes:
+            types = set(change['Type'] for change in changes)
+            if {0, 1} <= types:
+                # Files can have been renamed, into or out of directories
+                # that are added or removed as a whole
+                changes = self._expand_file_changes(changes).values()
+            for change in self._find_renames(changes):
                 type_ = change['Type']
                 before = (change['Before'] or {}).get('/', None)
                 after = (change['After'] or {}).get('/', None)
                 path = change['Path']
                 path = path + ' ' if path is not '' else ''
                 if type_ == 0:
-                    out += f'+ {path}{after}\n'
+                    yield f'+ {path}{after}'
                 elif type_ == 1:
-                    out += f'- {path}{before}\n'
+                    yield f'- {path}{before}'
                 elif type_ == 2:
-                    out += f'{path}{before} --> {after}\n'
-        else:
+                    yield f'{path}{before} --> {after}'
+                elif type_ in [RENAMED, COPIED]:
+                    sign = 'R' if type_ == RENAMED else 'C'
+                    yield (f'{sign} {change["FromPath"]} -> {path}{after} '
+                           f'({change["Similarity"]:.0%})')
+            return
+
+        changes = self._find_renames(self._expand_file_changes(changes).values())
+        for lines in self._iter_change_diffs(changes):
+            yield from lines
+
+    def _iter_change_diffs(self, changes, change_diff=None):
+        """ Yields the lines of the diff of each change, made by `change_diff`
+        which defaults to _change_diff. Up to DIFF_PREFETCH changes ahead are
+        diffed concurrently, so that files are fetched while the previous ones
+        are shown. Since the diff of a file is at most DIFF_MAX_LINES lines,
+        memory use doesn't depend on the size of the whole diff """
+        change_diff = change_diff or self._change_diff
+        with ThreadPoolExecutor(max_workers=DIFF_PREFETCH) as executor:
+            pending = deque()
             for change in changes:
-                from_lines = (self.ipfs.cat(change['Before']['/']).decode('utf-8').split('\n')
-                              if change['Before'] is not None else [])
-                to_lines = (self.ipfs.cat(change['After']['/']).decode('utf-8').split('\n')
-                            if change['After'] is not None else [])
-
-                if change['Type'] == 2: # modified
-                    from_file_path = change['Path']
-                    to_file_path = from_file_path
-                elif change['Type'] == 1: # deleted
-                    to_file_path = '/dev/null'
-                    from_file_path = change['Path']
-                elif change['Type'] == 0: # added
-                    to_file_path = change['Path']
-                    from_file_path = '/dev/null'
-                diff = difflib.unified_diff(from_lines, to_lines, lineterm='',
-                                            fromfile=from_file_path,
-                                            tofile=to_file_path)
-                out += '\n'.join(list(diff)[:-1]) + '\n'
-        out = out.strip()
-        if len(out) == 0:
-            out = '--------------------'
-        return out
+                pending.append(executor.submit(change_diff, change))
+                if len(pending) > DIFF_PREFETCH:
+                    yield pending.popleft().result()
+            while len(pending) > 0:
+                yield pending.popleft().result()
+
+    def _change_diff(self, change):
+        """ Returns the lines of a unified diff of the content of a file
+        change. Files are classified before they are read, binary files and
+        files bigger than DIFF_MAX_SIZE only get a summary """
+        lines = []
+        if change['Type'] in [RENAMED, COPIED]:
+            kind = 'rename' if change['Type'] == RENAMED else 'copy'
+            lines.append(f'{kind} {change["FromPath"]} -> {change["Path"]} '
+                         f'({change["Similarity"]:.0%})')
+            if change['Before'] == change['After']:
+                # The content is the same, so there's nothing to read
+                return lines
+
+        if change['Type'] == 2: # modified
+            from_file_path = change['Path']
+            to_file_path = from_file_path
+        elif change['Type'] == 1: # deleted
+            to_file_path = '/dev/null'
+            from_file_path = change['Path']
+        elif change['Type'] == 0: # added
+            to_file_path = change['Path']
+            from_file_path = '/dev/null'
+        else: # renamed or copied
+            to_file_path = change['Path']
+            from_file_path = change['FromPath']
+
+        kind, from_size, to_size, hunks = self._content_diff(
+            (change['Before'] or {}).get('/', None),
+            (change['After'] or {}).get('/', None))
+        sizes = f'size {from_size} -> {to_size}'
+        if kind == 'binary':
+            lines.append(f'Binary files {from_file_path} and {to_file_path} '
+                         f'differ ({sizes})')
+        elif kind == 'huge':
+            lines.append(f'Files {from_file_path} and {to_file_path} differ '
+                         f'({sizes}), too large to diff')
+        elif kind == 'complex':
+            lines.append(f'Files {from_file_path} and {to_file_path} differ '
+                         f'({sizes}), too many changes to diff')
+        elif len(hunks) > 0:
+            lines += [f'--- {from_file_path}', f'+++ {to_file_path}'] + hunks
+        return lines
+
+    def _cached_diff(self, key_parts, compute):
+        """ Returns the JSON serializable result of `compute`, which only
+        depends on `key_parts` (hashes of files and settings), from the diff
+        cache if it's there, and otherwise computes and caches it """
+        diff_cache = self.ipvc.diff_cache
+        if diff_cache is None:
+            return compute()
+        key = hashlib.sha1(json.dumps(key_parts).encode('utf-8')).hexdigest()
+        data = diff_cache.get_bytes(key)
+        if data is not None:
+            return json.loads(data.decode('utf-8'))
+        ret = compute()
+        diff_cache.put_bytes(key, json.dumps(ret).encode('utf-8'))
+        return ret
+
+    def _content_diff(self, from_hash, to_hash):
+        """ Returns the kind of diff of two files ('binary', 'huge', 'complex'
+        or 'text'), their sizes, and for text files the hunks of the unified diff.
+        Since the result only depends on the hashes, it's kept in the diff
+        cache """
+        return self._cached_diff(
+            ['diff', from_hash, to_hash, BINARY_SNIFF_SIZE, DIFF_TEXT_SIZE,
+             DIFF_MAX_SIZE, DIFF_MAX_LINES, linediff.MAX_DIFF_WORK],
+            lambda: self._compute_content_diff(from_hash, to_hash))
+
+    def _compute_content_diff(self, from_hash, to_hash):
+        from_kind, from_size = self._file_kind(from_hash)
+        to_kind, to_size = self._file_kind(to_hash)
+        hunks = []
+        if 'binary' in [from_kind, to_kind]:
+            kind = 'binary'
+        elif max(from_size, to_size) > DIFF_MAX_SIZE:
+            kind = 'huge'
+        elif max(from_size, to_size) > DIFF_TEXT_SIZE:
+            hunks = self._line_hash_diff(from_hash, to_hash)
+            kind = 'text' if hunks is not None else 'complex'
+            hunks = hunks or []
+        else:
+            kind = 'text'
+            from_lines, to_lines = [self._read_text(h).splitlines()
+                                    for h in [from_hash, to_hash]]
+            # Skip the file headers, which are added by _change_diff
+            hunks = truncate_diff(itertools.islice(difflib.unified_diff(
+                from_lines, to_lines, lineterm=''), 2, None), DIFF_MAX_LINES - 2)
+
+        return [kind, from_size, to_size, hunks]
+
+    def _file_kind(self, h):
+        """ Returns whether the file `h` is 'binary' or 'text', and its size,
+        reading only the first BINARY_SNIFF_SIZE bytes. A missing file (`h`
+        is None) is an empty text file """
+        if h is None:
+            return 'text', 0
+        size = self.ipfs.files_stat(f'/ipfs/{h}')['Size']
+        head = b''
+        if size > 0:
+            head = self.ipfs.files_read(
+                f'/ipfs/{h}', count=min(size, BINARY_SNIFF_SIZE))
+        return ('binary' if is_binary(head) else 'text'), size
+
+    def _read_text(self, h):
+        if h is None:
+            return ''
+        return self.ipfs.cat(h).decode('utf-8', errors='replace')
+
+    def _iter_file_lines(self, h):
+        """ Yields the lines of the file `h` as bytes, reading at most
+        `buffer_size` bytes at a time """
+        if h is None:
+            return
+        offset, rest = 0, b''
+        while True:
+            chunk = self.ipfs.files_read(
+                f'/ipfs/{h}', offset=offset, count=self.ipvc.buffer_size)
+            if len(chunk) == 0:
+                break
+            offset += len(chunk)
+            lines = (rest + chunk).split(b'\n')
+            rest = lines.pop()
+            yield from lines
+        if len(rest) > 0:
+            yield rest
+
+    def _line_hash_diff(self, from_hash, to_hash):
+        """ Returns the hunks of a unified diff of large text files, which
+        are streamed twice instead of being held in memory. The first time the
+        lines are hashed, and the hashes are compared to find the hunks, the
+        second time only the lines that are shown are kept, up to
+        DIFF_MAX_LINES including the file headers. Returns None if the files
+        have too many changes to diff, see linediff """
+        from_hashes = array('q', (hash(line) for line in self._iter_file_lines(from_hash)))
+        to_hashes = array('q', (hash(line) for line in self._iter_file_lines(to_hash)))
+        blocks = linediff.matching_blocks(from_hashes, to_hashes)
+        del from_hashes, to_hashes
+        if blocks is None:
+            return None
+        groups = linediff.grouped_opcodes(linediff.opcodes(blocks))
+
+        # Take the hunks that fit, with the lines they need from each file
+        shown, num_lines, num_left = [], 2, 0
+        from_needed, to_needed = set(), set()
+        for group in groups:
+            group_lines = 1 + sum(
+                (i2 - i1 if tag != 'insert' else 0) +
+                (j2 - j1 if tag in ['replace', 'insert'] else 0)
+                for tag, i1, i2, j1, j2 in group)
+            if num_left > 0 or num_lines + group_lines > DIFF_MAX_LINES:
+                num_left += group_lines
+                continue
+            num_lines += group_lines
+            shown.append(group)
+            for _, i1, i2, j1, j2 in group:
+                from_needed.update(range(i1, i2))
+                to_needed.update(range(j1, j2))
+
+        def _needed_lines(h, needed):
+            return {i: line.decode('utf-8', errors='replace')
+                    for i, line in enumerate(self._iter_file_lines(h))
+                    if i in needed}
+        from_lines = _needed_lines(from_hash, from_needed)
+        to_lines = _needed_lines(to_hash, to_needed)
+
+        lines = []
+        for group in shown:
+            _, i1, _, j1, _ = group[0]
+            _, _, i2, _, j2 = group[-1]
+            lines.append(f'@@ -{format_hunk_range(i1, i2)} '
+                         f'+{format_hunk_range(j1, j2)} @@')
+            for tag, i1, i2, j1, j2 in group:
+                if tag == 'equal':
+                    lines += [' ' + from_lines[i] for i in range(i1, i2)]
+                    continue
+                if tag in ['replace', 'delete']:
+                    lines += ['-' + from_lines[i] for i in range(i1, i2)]
+                if tag in ['replace', 'insert']:
+                    lines += ['+' + to_lines[j] for j in range(j1, j2)]
+        if num_left > 0:
+            lines.append(f'... {num_left} more lines of diff not shown')
+        return lines
+
+    def _expand_file_changes(self, changes):
+        """ Returns the changes by path, where added or removed directories,
+        which object_diff reports as a single change, are expanded to a change
+        for each file under them """
+        file_changes = {}
+        for change in changes:
+            side = {0: 'After', 1: 'Before'}.get(change['Type'], None)
+            if (side is None or self.ipfs.files_stat(
+                    f'/ipfs/{change[side]["/"]}')['Type'] != 'directory'):
+                file_changes[change['Path']] = change
+                continue
+            for path, h in self._dir_files(change[side]['/'], change['Path']):
+                file_changes[path] = dict(change, Path=path, **{side: {'/': h}})
+        return file_changes
+
+    def _dir_files(self, h, prefix):
+        """ Yields (path, hash) of all files under the directory `h` """
+        for link in self.ipfs.ls(h)['Objects'][0]['Links']:
+            path = f'{prefix}/{link["Name"]}'
+            if link['Type'] == 1:
+                yield from self._dir_files(link['Hash'], path)
+            else:
+                yield path, link['Hash']
+
+    def _find_renames(self, changes, copies=True):
+        """ Returns the changes with added files paired up with the removed
+        files they were renamed from (Type 3), and if `copies`, with files
+        they were copied from (Type 4). Paired changes have the source path
+        in 'FromPath' and the similarity of the files in 'Similarity'
+
+        Files with the same hash are paired first, without reading them.
+        The files that are left are compared by the content of small files
+        and the chunks of large files, see ipvc.similarity. Only removed or
+        modified files are considered as sources of copies, like
+        `git diff -C`, and modified files only when the content is the same
+        """
+        changes = list(changes)
+        added = [c for c in changes if c['Type'] == 0]
+        removed = {c['Path']: c for c in changes if c['Type'] == 1}
+        modified = [c for c in changes if c['Type'] == 2]
+        if len(added) == 0 or (len(removed) == 0 and
+                               (not copies or len(modified) == 0)):
+            return changes
+
+        def _pair(type_, change, source, similarity):
+            return dict(change, Type=type_, FromPath=source['Path'],
+                        Before=source['Before'], Similarity=similarity)
+
+        # Files with the same hash, preferring sources with the same name
+        sources_by_hash = defaultdict(list)
+        for source in list(removed.values()) + modified:
+            sources_by_hash[source['Before']['/']].append(source)
+        paired, renamed = {}, set()
+        for change in added:
+            sources = sorted(sources_by_hash.get(change['After']['/'], []),
+                             key=lambda source: (
+                                 source['Type'] != 1 or source['Path'] in renamed,
+                                 Path(source['Path']).name != Path(change['Path']).name))
+            if len(sources) == 0:
+                continue
+            if sources[0]['Type'] == 1 and sources[0]['Path'] not in renamed:
+                renamed.add(sources[0]['Path'])
+                paired[change['Path']] = _pair(RENAMED, change, sources[0], 1.0)
+            elif copies:
+                paired[change['Path']] = _pair(COPIED, change, sources[0], 1.0)
+
+        # Similar files among the ones that are left
+        added_left = {c['Path']: c for c in added if c['Path'] not in paired}
+        removed_left = {p: c for p, c in removed.items() if p not in renamed}
+        if len(added_left) > 0 and len(removed_left) > 0:
+            features = {}
+            def _features(changes, side):
+                ret = {}
+                for path, change in changes.items():
+                    h = change[side]['/']
+                    if h not in features:
+                        features[h] = self._similarity_features(h)
+                    if features[h] is not None:
+                        ret[path] = features[h]
+                return ret
+            pairs = similarity.similar_pairs(
+                _features(removed_left, 'Before'), _features(added_left, 'After'),
+                RENAME_SIMILARITY)
+            # Renames take precedence over copies of the same file
+            for similarity_, source_path, path in pairs:
+                if path not in paired and source_path not in renamed:
+                    renamed.add(source_path)
+                    paired[path] = _pair(RENAMED, added_left[path],
+                                         removed[source_path], similarity_)
+            if copies:
+                for similarity_, source_path, path in pairs:
+                    if path not in paired:
+                        paired[path] = _pair(COPIED, added_left[path],
+                                             removed[source_path], similarity_)
+
+        return [paired.get(c['Path'], c) for c in changes
+                if not (c['Type'] == 1 and c['Path'] in renamed)]
+
+    def _similarity_features(self, h):
+        """ Returns the features of `h` for ipvc.similarity, or None if it's
+        a directory. Files that fit in a single block are read, while large
+        files are described by the hashes of their chunks """
+        stat = self.ipfs.files_stat(f'/ipfs/{h}')
+        if stat['Type'] == 'directory':
+            return None
+        if stat['Blocks'] == 0:
+            return similarity.line_features(self.ipfs.cat(h))
+        return similarity.chunk_features(self._chunk_hashes(h))
+
+    def _chunk_hashes(self, h):
+        """ Yields the hashes of the chunks of a large file without reading
+        them, by following the links that are bigger than a chunk """
+        for link in self.ipfs.object_links(h).get('Links', []):
+            # A chunk is at most MAX_LEAF_SIZE bytes of data, plus some
+            # bytes for the protobuf wrapping
+            if link['Size'] > MAX_LEAF_SIZE + 1024:
+                yield from self._chunk_hashes(link['Hash'])
+            else:
+                yield link['Hash']
 
     def _diff_changes(self, to_refpath, from_refpath):
         to_refpath, from_refpath = self._diff_resolve_refs(to_refpath, from_refpath)
@@ -653,10 +1551,71 @@ class CommonAPI:
         short_desc, *rest = msg.split('\n')
         return short_desc, '\n'.join(l for l in rest if len(l.strip()) > 0)
 
+    def get_commit_format(self, repo_path):
+        mfs_format_path = self.get_mfs_path(repo_path, repo_info='commit_format')
+        try:
+            return int(self.ipfs.files_read(mfs_format_path).decode('utf-8'))
+        except ipfsapi.exceptions.StatusError:
+            return DEFAULT_COMMIT_FORMAT
+
+    def set_commit_format(self, repo_path, commit_format):
+        mfs_format_path = self.get_mfs_path(repo_path, repo_info='commit_format')
+        self.ipfs.files_write(
+            mfs_format_path, io.BytesIO(str(commit_format).encode('utf-8')),
+            create=True, truncate=True)
+        self.invalidate_cache(['commit_format'])
+
+    @property
+    @cached_property
+    def commit_format(self):
+        return self.get_commit_format(self.fs_repo_root)
+
+    def get_commit_metadata(self, commit_hash):
+        # NOTE: the root commit doesn't have a commit_metadata file, so this
+        # might fail
+        if commit_hash not in _COMMIT_METADATA_CACHE:
+            _COMMIT_METADATA_CACHE[commit_hash] = self.ipfs.cat(
+                f'/ipfs/{commit_hash}/data/commit_metadata').decode('utf-8')
+        return json.loads(_COMMIT_METADATA_CACHE[commit_hash])
+
+    @traced
+    def build_commit(self, builder, bundle_link, parent_link, merge_parent_link,
+                     commit_metadata, id_peer_keys, commit_format):
+        """ Adds the nodes of a new commit to the DagBuilder `builder`, signed
+        with `id_peer_keys`, and returns the link to the commit. The links are
+        (hash, cumulative size) tuples, `merge_parent_link` may be None """
+        commit_metadata = {k: v for k, v in commit_metadata.items()
+                           if k not in ['format', 'parent', 'merge_parent']}
+        if commit_format >= 2:
+            commit_metadata['format'] = commit_format
+            commit_metadata['parent'] = parent_link[0]
+            if merge_parent_link is not None:
+                commit_metadata['merge_parent'] = merge_parent_link[0]
+
+        data_entries = {'bundle': bundle_link, 'parent': parent_link}
+        if merge_parent_link is not None:
+            data_entries['merge_parent'] = merge_parent_link
+        data_entries['commit_metadata'] = builder.file(
+            json.dumps(commit_metadata).encode('utf-8'))
+        data_link = builder.directory(data_entries)
+
+        # Sign the commit bundle and data hash
+        bundle_hash = bundle_link[0].encode('utf-8')
+        data_hash = data_link[0].encode('utf-8')
+        data_signature = id_peer_keys['signer'].sign(data_hash)
+        bundle_signature = id_peer_keys['signer'].sign(bundle_hash)
+
+        return builder.directory({
+            'data': data_link,
+            'bundle_signature': builder.file(bundle_signature.encode('utf-8')),
+            'data_signature': builder.file(data_signature.encode('utf-8')),
+        })
+
     def set_repo_id(self, repo_path, key):
         mfs_id_path = self.get_mfs_path(repo_path, repo_info='id')
         self.ipfs.files_write(mfs_id_path, io.BytesIO(key.encode('utf-8')),
                               create=True, truncate=True)
+        self.register_repo(self.get_repo_main_root(repo_path), id=key)
         self.invalidate_cache(['repo_id', 'ids'])
 
     @property
@@ -688,20 +1647,42 @@ class CommonAPI:
     def ipfs_keys(self):
         return {k['Name']: k['Id'] for k in self.ipfs.key_list()['Keys']}
 
-    def id_peer_keys(self, key_name):
+    @property
+    @cached_property
+    def fs_ipfs_repo_path(self):
         mfs_ipfs_repo_path = self.get_mfs_path(self.fs_repo_root, repo_info='ipfs_repo_path')
-        fs_ipfs_repo_path = self.ipfs.files_read(mfs_ipfs_repo_path).decode('utf-8')
+        return Path(self.ipfs.files_read(mfs_ipfs_repo_path).decode('utf-8'))
+
+    def id_peer_keys(self, key_name):
+        """ Returns the peer id and the parsed key material for an IPFS key.
+        Parsing is cached for the lifetime of the process, and the key is
+        parsed again only if the file it was read from changes """
+        import crypto_pb2
+        if key_name == 'self':
+            fs_key_path = self.fs_ipfs_repo_path / 'config'
+        else:
+            fs_key_path = self.fs_ipfs_repo_path / 'keystore' / key_name
+
+        try:
+            stat = os.stat(fs_key_path)
+        except FileNotFoundError:
+            self.print_err(f'No key by the name "{key_name}" at {fs_key_path}')
+            raise RuntimeError()
+        stamp = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        cached = _PEER_KEYS_CACHE.get(str(fs_key_path), None)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
 
         priv_key_protobuf = None
         peer_id = None
         if key_name == 'self':
-            with open(Path(fs_ipfs_repo_path) / 'config') as f:
+            with open(fs_key_path) as f:
                 config = json.loads(f.read())
                 identity = config['Identity']
                 peer_id = identity ['PeerID']
                 priv_key_protobuf = base64.b64decode(identity['PrivKey'])
         else:
-            with open(Path(fs_ipfs_repo_path) / 'keystore' / key_name, 'rb') as f:
+            with open(fs_key_path, 'rb') as f:
                 priv_key_protobuf = f.read()
             for key in self.ipfs.key_list()['Keys']:
                 if key['Name'] == key_name:
@@ -709,22 +1690,31 @@ class CommonAPI:
                     break
 
         try:
-            private_key_pem = deserialize_pk_protobuf(
-                priv_key_protobuf, 'crypto.pb.PrivateKey').Data
-            rsa_priv_key = RSA.importKey(private_key_pem)
-            rsa_pub_key = rsa_priv_key.publickey()
-            public_key_pem = rsa_pub_key.exportKey('PEM').decode('utf-8')
+            priv_key = deserialize_pk_protobuf(
+                priv_key_protobuf, 'crypto.pb.PrivateKey')
+            if priv_key.Type == crypto_pb2.Ed25519:
+                signer = Ed25519Signer(priv_key.Data)
+            else:
+                signer = RSASigner(priv_key.Data)
+        except ImportError as e:
+            self.print_err(str(e))
+            raise RuntimeError()
         except:
-            self.print_err(f'Failure trying to use key "{key}" as an RSA key')
+            self.print_err(f'Failure trying to use key "{key_name}" as a signing key')
             raise RuntimeError()
 
-        return {
+        rsa = signer.key_type == 'rsa'
+        peer_keys = {
             'peer_id': peer_id,
-            'rsa_pub_key': rsa_pub_key,
-            'rsa_priv_key': rsa_priv_key,
-            'pub_key_pem': public_key_pem,
-            'priv_key_pem': private_key_pem
+            'key_type': signer.key_type,
+            'signer': signer,
+            'rsa_pub_key': signer.pub_key if rsa else None,
+            'rsa_priv_key': signer.priv_key if rsa else None,
+            'pub_key_pem': signer.pub_key_pem,
+            'priv_key_pem': signer.priv_key_pem
         }
+        _PEER_KEYS_CACHE[str(fs_key_path)] = (stamp, peer_keys)
+        return peer_keys
 
     def print_id(self, peer_id, data, lead=''):
         self.print(f'{lead}PeerID: {peer_id}')
@@ -789,6 +1779,7 @@ class CommonAPI:
         mfs_repo_name = self.get_mfs_path(repo_path, repo_info='name')
         self.ipfs.files_write(mfs_repo_name, io.BytesIO(name.encode('utf-8')),
                               create=True, truncate=True)
+        self.register_repo(self.get_repo_main_root(repo_path), name=name)
         self.invalidate_cache(['repo_name'])
 
     @property
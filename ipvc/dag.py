@@ -0,0 +1,272 @@
+"""
+Minimal encoding of IPFS merkledag (dag-pb) and unixfs nodes, so that small
+directory trees such as commits can be assembled and hashed locally and then
+written to IPFS as raw blocks, instead of being built up one MFS operation at
+a time. Also decodes nodes and lays out files like `ipfs add`, for the local
+store in ipvc.localstore
+"""
+import io
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+B58_ALPHABET = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
+# Multihash prefix for sha2-256 with a 32 byte digest
+SHA256_PREFIX = b'\x12\x20'
+# unixfs data types
+UNIXFS_DIRECTORY = 1
+UNIXFS_FILE = 2
+# Same as the default chunk size of go-ipfs, larger files are added normally
+MAX_LEAF_SIZE = 256 * 1024
+# Max number of links of internal file nodes in the go-ipfs balanced layout
+MAX_FILE_LINKS = 174
+
+
+def b58encode(data: bytes):
+    num = int.from_bytes(data, 'big')
+    chars = []
+    while num > 0:
+        num, rem = divmod(num, 58)
+        chars.append(B58_ALPHABET[rem])
+    pad = len(data) - len(data.lstrip(b'\x00'))
+    return '1' * pad + ''.join(reversed(chars))
+
+
+def b58decode(string: str):
+    num = 0
+    for char in string:
+        num = num * 58 + B58_ALPHABET.index(char)
+    pad = len(string) - len(string.lstrip('1'))
+    body = num.to_bytes((num.bit_length() + 7) // 8, 'big')
+    return b'\x00' * pad + body
+
+
+def _varint(num):
+    out = bytearray()
+    while True:
+        byte = num & 0x7f
+        num >>= 7
+        if num:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def _field_varint(field, num):
+    return _varint(field << 3) + _varint(num)
+
+
+def _field_bytes(field, data):
+    return _varint((field << 3) | 2) + _varint(len(data)) + data
+
+
+def _read_varint(buf, pos):
+    num, shift = 0, 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        num |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return num, pos
+        shift += 7
+
+
+def _decode_fields(buf):
+    """ Yields (field, value) of a protobuf message, where the value is an int
+    for varints and bytes for length delimited fields """
+    pos = 0
+    while pos < len(buf):
+        key, pos = _read_varint(buf, pos)
+        field, wire_type = key >> 3, key & 0x7
+        if wire_type == 0:
+            value, pos = _read_varint(buf, pos)
+        elif wire_type == 2:
+            length, pos = _read_varint(buf, pos)
+            value, pos = buf[pos:pos + length], pos + length
+        else:
+            raise ValueError(f'Unsupported protobuf wire type {wire_type}')
+        yield field, value
+
+
+def unixfs_data(data_type, data=None, blocksizes=None):
+    """ Encodes the unixfs Data protobuf message of a node. Internal file
+    nodes have the sizes of their children in `blocksizes` """
+    out = _field_varint(1, data_type)
+    if data is not None and len(data) > 0:
+        out += _field_bytes(2, data)
+    if blocksizes is not None:
+        out += _field_varint(3, len(data or b'') + sum(blocksizes))
+        for size in blocksizes:
+            out += _field_varint(4, size)
+    elif data is not None:
+        out += _field_varint(3, len(data))
+    return out
+
+
+def decode_unixfs(buf):
+    """ Decodes the unixfs Data protobuf message of a node into a dict """
+    ret = {'Type': None, 'Data': b'', 'filesize': 0, 'blocksizes': []}
+    for field, value in _decode_fields(buf):
+        if field == 1:
+            ret['Type'] = value
+        elif field == 2:
+            ret['Data'] = value
+        elif field == 3:
+            ret['filesize'] = value
+        elif field == 4:
+            if isinstance(value, bytes):
+                # Packed encoding
+                pos = 0
+                while pos < len(value):
+                    size, pos = _read_varint(value, pos)
+                    ret['blocksizes'].append(size)
+            else:
+                ret['blocksizes'].append(value)
+    return ret
+
+
+def block_hash(block: bytes):
+    """ The CIDv0 of a block """
+    return b58encode(SHA256_PREFIX + hashlib.sha256(block).digest())
+
+
+class DagNode:
+    """ A dag-pb node with unixfs `data` and `links`, a list of
+    (name, hash, cumulative size) tuples pointing to other nodes """
+    def __init__(self, data, links=None):
+        self.data = data
+        self.links = sorted(links or [], key=lambda link: link[0])
+
+    def encode(self):
+        # Links are serialized before Data, like go-ipfs does
+        out = b''
+        for name, h, size in self.links:
+            link = (_field_bytes(1, b58decode(h)) +
+                    _field_bytes(2, name.encode('utf-8')) +
+                    _field_varint(3, size))
+            out += _field_bytes(2, link)
+        return out + _field_bytes(1, self.data)
+
+    @property
+    def block(self):
+        return self.encode()
+
+    @property
+    def hash(self):
+        return block_hash(self.block)
+
+    @property
+    def cumulative_size(self):
+        return len(self.block) + sum(size for _, _, size in self.links)
+
+
+def decode_node(block: bytes):
+    """ Decodes a dag-pb block into a DagNode """
+    data, links = b'', []
+    for field, value in _decode_fields(block):
+        if field == 1:
+            data = value
+        elif field == 2:
+            h, name, size = None, '', 0
+            for link_field, link_value in _decode_fields(value):
+                if link_field == 1:
+                    h = b58encode(link_value)
+                elif link_field == 2:
+                    name = link_value.decode('utf-8')
+                elif link_field == 3:
+                    size = link_value
+            links.append((name, h, size))
+    return DagNode(data, links)
+
+
+def file_node(data: bytes):
+    return DagNode(unixfs_data(UNIXFS_FILE, data))
+
+
+def directory_node(links):
+    return DagNode(unixfs_data(UNIXFS_DIRECTORY), links)
+
+
+def balanced_file(chunks, put):
+    """ Builds the dag of a file from an iterable of data chunks the same way
+    as `ipfs add` with the default balanced layout, so that the hashes match.
+    Calls `put` with every node and returns (hash, cumulative size) of the
+    root """
+    # levels[k] holds (hash, cumulative size, file size) of nodes at height k
+    # that haven't been linked to a parent yet
+    levels = [[]]
+
+    def _parent(children):
+        node = DagNode(
+            unixfs_data(UNIXFS_FILE, blocksizes=[c[2] for c in children]),
+            [('', h, size) for h, size, _ in children])
+        put(node)
+        return node.hash, node.cumulative_size, sum(c[2] for c in children)
+
+    def _push(level, entry):
+        if level == len(levels):
+            levels.append([])
+        levels[level].append(entry)
+        if len(levels[level]) == MAX_FILE_LINKS:
+            children, levels[level] = levels[level], []
+            _push(level + 1, _parent(children))
+
+    num_leaves = 0
+    for chunk in chunks:
+        node = file_node(chunk)
+        put(node)
+        _push(0, (node.hash, node.cumulative_size, len(chunk)))
+        num_leaves += 1
+
+    if num_leaves == 0:
+        node = file_node(b'')
+        put(node)
+        return node.hash, node.cumulative_size
+    if num_leaves == 1:
+        return levels[0][0][:2]
+
+    # Link up the partially filled levels from the bottom
+    carry = None
+    for level, entries in enumerate(levels):
+        entries = entries + ([carry] if carry is not None else [])
+        top = all(len(higher) == 0 for higher in levels[level+1:])
+        if top and len(entries) == 1:
+            return entries[0][:2]
+        carry = _parent(entries) if len(entries) > 0 else None
+    return carry[:2]
+
+
+class DagBuilder:
+    """ Collects new nodes and writes them to IPFS as blocks in one go. Links
+    to data that is already in IPFS are added by hash and don't need to be
+    written again """
+    def __init__(self, ipfs):
+        self.ipfs = ipfs
+        self.nodes = []
+
+    def file(self, data: bytes):
+        """ Returns a link target (hash, cumulative size) for a file """
+        if len(data) > MAX_LEAF_SIZE:
+            h = self.ipfs.add_bytes(data)
+            return h, self.ipfs.object_stat(h)['CumulativeSize']
+        return self.add(file_node(data))
+
+    def directory(self, entries):
+        """ Returns a link target for a directory where `entries` maps names
+        to link targets """
+        links = [(name, h, size) for name, (h, size) in entries.items()]
+        return self.add(directory_node(links))
+
+    def add(self, node):
+        self.nodes.append(node)
+        return node.hash, node.cumulative_size
+
+    def write(self):
+        """ Writes all collected blocks concurrently, since they don't depend
+        on each other being present in the blockstore """
+        def _put(node):
+            key = self.ipfs.block_put(io.BytesIO(node.block))['Key']
+            assert key == node.hash
+        with ThreadPoolExecutor(max_workers=len(self.nodes) or 1) as executor:
+            list(executor.map(_put, self.nodes))
+        self.nodes = []
@@ -1,12 +1,257 @@
+import multiprocessing
+from array import array
 from pathlib import Path
-from ipvc.common import CommonAPI
+from functools import partial
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from ipvc import tabular, linediff
+from ipvc.common import (
+    CommonAPI, RENAMED, DIFF_PREFETCH, DIFF_MAX_SIZE, DIFF_MAX_LINES,
+    BINARY_SNIFF_SIZE, truncate_diff)
+
+# Width of the bars of +'s and -'s in --stat
+STAT_GRAPH_WIDTH = 40
+# Directories with less than this share of the changes are left out of --dirstat
+DIRSTAT_MIN_PERCENT = 3
+# Changed lines of modified files of at least this size are counted in a
+# process pool, since counting is CPU bound
+STAT_PROCESS_MIN_SIZE = 1024 * 1024
+
+
+def _stat_process_pool():
+    """ Returns a process pool for counting changed lines. Processes are
+    started from the threads that fetch the files, which isn't safe when
+    forking, so they're forked from a server process where it's available.
+    No processes are started until the pool is used """
+    methods = multiprocessing.get_all_start_methods()
+    context = 'forkserver' if 'forkserver' in methods else 'spawn'
+    return ProcessPoolExecutor(mp_context=multiprocessing.get_context(context))
+
 
 class DiffAPI(CommonAPI):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
-    def run(self, to_refpath=Path("@workspace"), from_refpath=Path("@stage"), files=False):
+    def run(self, to_refpath=Path("@workspace"), from_refpath=Path("@stage"),
+            files=False, stat=False, numstat=False, dirstat=False, key=None,
+            delimiter=None):
         self.common()
         changes = self._diff_changes(to_refpath, from_refpath)
-        self.print(self._format_changes(changes, files=files))
+        if key is not None and not files:
+            key_columns = key.split(',') if isinstance(key, str) else list(key)
+            self._print_table_diff(changes, key_columns, delimiter)
+            return changes
+        if dirstat:
+            dir_stats = self._dir_stats(changes)
+            self.print(self._format_dirstat(dir_stats))
+            return dir_stats
+        if stat or numstat:
+            file_stats = self._file_stats(changes)
+            self.print(self._format_numstat(file_stats) if numstat else
+                       self._format_stat(file_stats))
+            return file_stats
+        self._print_diff(changes, files=files)
         return changes
+
+    def _print_table_diff(self, changes, key_columns, delimiter=None):
+        """ Prints a diff where modified tables (CSV and TSV files) are
+        diffed by rows with the same values in `key_columns`, and other files
+        line by line """
+        changes = self._find_renames(
+            self._expand_file_changes(changes).values(), copies=False)
+        table_diff = partial(self._table_change_diff, key_columns=key_columns,
+                             delimiter=delimiter)
+        empty = True
+        for lines in self._iter_change_diffs(changes, table_diff):
+            for line in lines:
+                self.print(line)
+                empty = False
+        if empty:
+            self.print('--------------------')
+
+    def _table_change_diff(self, change, key_columns, delimiter=None):
+        """ Returns the lines of a keyed diff of a modified or renamed table,
+        or the unified diff of other changes, see tabular.diff_tables """
+        path = Path(change['Path'])
+        if (change['Type'] not in [2, RENAMED] or change['Before'] == change['After']
+                or path.suffix.lower() not in tabular.DELIMITERS):
+            return self._change_diff(change)
+        from_hash, to_hash = change['Before']['/'], change['After']['/']
+        from_kind, from_size = self._file_kind(from_hash)
+        to_kind, to_size = self._file_kind(to_hash)
+        if 'binary' in [from_kind, to_kind]:
+            return self._change_diff(change)
+
+        delimiter = delimiter or tabular.DELIMITERS[path.suffix.lower()]
+        def _compute():
+            stats = {}
+            try:
+                lines = truncate_diff(tabular.diff_tables(
+                    self._iter_file_lines(from_hash), self._iter_file_lines(to_hash),
+                    key_columns, delimiter,
+                    tabular.num_partitions(max(from_size, to_size)), stats),
+                    DIFF_MAX_LINES - 3)
+            except ValueError as e:
+                self.print_err(f'Cannot diff {path} by {", ".join(key_columns)}: {e}')
+                raise RuntimeError()
+            return [tabular.format_summary(key_columns, stats)] + lines
+
+        lines = []
+        from_path = change.get('FromPath', change['Path'])
+        if change['Type'] == RENAMED:
+            lines.append(f'rename {from_path} -> {change["Path"]} '
+                         f'({change["Similarity"]:.0%})')
+        lines += [f'--- {from_path}', f'+++ {change["Path"]}']
+        return lines + self._cached_diff(
+            ['table', from_hash, to_hash, key_columns, delimiter, DIFF_MAX_LINES],
+            _compute)
+
+    def _file_stats(self, changes):
+        """ Returns a dict for each changed file with its path, and the
+        numbers of lines added and removed, or None for binary files, along
+        with the sizes before and after. Files are fetched concurrently, and
+        big files are counted in other processes """
+        changes = self._find_renames(
+            self._expand_file_changes(changes).values(), copies=False)
+
+        with ThreadPoolExecutor(max_workers=DIFF_PREFETCH) as executor, \
+                _stat_process_pool() as processes:
+            def _stat(change):
+                from_hash = (change['Before'] or {}).get('/', None)
+                to_hash = (change['After'] or {}).get('/', None)
+                path = change['Path']
+                if change['Type'] == RENAMED:
+                    path = f'{change["FromPath"]} -> {path}'
+                return dict(self._line_stat(from_hash, to_hash, processes), path=path)
+
+            return list(executor.map(_stat, changes))
+
+    def _line_stat(self, from_hash, to_hash, processes=None):
+        """ Returns the numbers of lines and bytes added and removed between
+        two files, which are streamed rather than read into memory. Binary
+        files, modified files bigger than DIFF_MAX_SIZE, and files with too
+        many changes to diff (see linediff) have no line counts, and all their
+        bytes count as changed. Files of STAT_PROCESS_MIN_SIZE or more are
+        counted in `processes` if given. A file that is the same on both sides
+        (renamed without changes) isn't read, and its sizes are None """
+        if from_hash == to_hash:
+            return {'from_size': None, 'to_size': None, 'added': 0, 'removed': 0,
+                    'added_bytes': 0, 'removed_bytes': 0}
+
+        def _line_hashes(h):
+            hashes, sizes = array('q'), array('q')
+            for line in self._iter_file_lines(h):
+                hashes.append(hash(line))
+                sizes.append(len(line) + 1)
+            return hashes, sizes
+
+        def _compute():
+            from_kind, from_size = self._file_kind(from_hash)
+            to_kind, to_size = self._file_kind(to_hash)
+            stat = {'from_size': from_size, 'to_size': to_size,
+                    'added': None, 'removed': None,
+                    'added_bytes': to_size, 'removed_bytes': from_size}
+            if 'binary' in [from_kind, to_kind]:
+                return stat
+            if from_hash is None or to_hash is None:
+                # Added or removed, so every line counts
+                num_lines = sum(1 for _ in self._iter_file_lines(from_hash or to_hash))
+                stat['added' if from_hash is None else 'removed'] = num_lines
+                stat['removed' if from_hash is None else 'added'] = 0
+                return stat
+            if max(from_size, to_size) > DIFF_MAX_SIZE:
+                return stat
+
+            args = (*_line_hashes(from_hash), *_line_hashes(to_hash))
+            if processes is not None and max(from_size, to_size) >= STAT_PROCESS_MIN_SIZE:
+                counts = processes.submit(linediff.count_changes, *args).result()
+            else:
+                counts = linediff.count_changes(*args)
+            if counts is not None:
+                stat.update(zip(['added', 'removed', 'added_bytes', 'removed_bytes'],
+                                counts))
+            return stat
+
+        return self._cached_diff(
+            ['stat', from_hash, to_hash, BINARY_SNIFF_SIZE, DIFF_MAX_SIZE,
+             linediff.MAX_DIFF_WORK],
+            _compute)
+
+    def _dir_stats(self, changes):
+        """ Returns the number of changed bytes under each directory with
+        changes, including its subdirectories, and the total. Added and
+        removed directories count with the cumulative size of their node, so
+        they are neither expanded nor read, and modified files count with the
+        bytes of the lines that changed """
+        def _changed_bytes(change):
+            """ Returns the number of changed bytes, and whether it's a directory """
+            if change['Type'] == 2:
+                stat = self._line_stat(
+                    change['Before']['/'], change['After']['/'], processes)
+                return stat['added_bytes'] + stat['removed_bytes'], False
+            side = 'After' if change['Type'] == 0 else 'Before'
+            stat = self.ipfs.files_stat(f'/ipfs/{change[side]["/"]}')
+            if stat['Type'] == 'directory':
+                return stat['CumulativeSize'], True
+            return stat['Size'], False
+
+        with ThreadPoolExecutor(max_workers=DIFF_PREFETCH) as executor, \
+                _stat_process_pool() as processes:
+            sizes = list(executor.map(_changed_bytes, changes))
+
+        dir_bytes = defaultdict(int)
+        for change, (num_bytes, is_dir) in zip(changes, sizes):
+            path = Path(change['Path'])
+            for d in ([path] if is_dir else []) + list(path.parents):
+                dir_bytes[str(d)] += num_bytes
+        # All changes are under the repo root
+        total = dir_bytes.pop('.', 0)
+        return {'total': total, 'dirs': dict(dir_bytes)}
+
+    def _format_stat(self, file_stats):
+        if len(file_stats) == 0:
+            return '--------------------'
+        path_width = max(len(s['path']) for s in file_stats)
+        num_changed = [(s['added'] or 0) + (s['removed'] or 0) for s in file_stats]
+        count_width = len(str(max(num_changed)))
+        scale = min(1, STAT_GRAPH_WIDTH / max(max(num_changed), 1))
+        lines = []
+        for stat, num in zip(file_stats, num_changed):
+            path = stat['path'].ljust(path_width)
+            if stat['added'] is None:
+                lines.append(f' {path} | Bin {stat["from_size"]} -> '
+                             f'{stat["to_size"]} bytes')
+                continue
+            added, removed = stat['added'], stat['removed']
+            if scale < 1:
+                # Scale down, but keep at least one sign for any change
+                added = max(int(added * scale), 1 if added > 0 else 0)
+                removed = max(int(removed * scale), 1 if removed > 0 else 0)
+            lines.append(f' {path} | {str(num).rjust(count_width)} '
+                         f'{"+" * added}{"-" * removed}')
+
+        insertions = sum(s['added'] or 0 for s in file_stats)
+        deletions = sum(s['removed'] or 0 for s in file_stats)
+        num_files = len(file_stats)
+        lines.append(f' {num_files} file{"s" if num_files != 1 else ""} changed, '
+                     f'{insertions} insertions(+), {deletions} deletions(-)')
+        return '\n'.join(lines)
+
+    def _format_numstat(self, file_stats):
+        lines = []
+        for stat in file_stats:
+            if stat['added'] is None:
+                lines.append(f'-\t-\t{stat["path"]}')
+            else:
+                lines.append(f'{stat["added"]}\t{stat["removed"]}\t{stat["path"]}')
+        return '\n'.join(lines) if len(lines) > 0 else '--------------------'
+
+    def _format_dirstat(self, dir_stats):
+        total = dir_stats['total']
+        lines = []
+        for path, num_bytes in sorted(dir_stats['dirs'].items()):
+            percent = 100 * num_bytes / total if total > 0 else 0
+            if percent >= DIRSTAT_MIN_PERCENT:
+                lines.append(f'{percent:6.1f}% {path}/')
+        return '\n'.join(lines) if len(lines) > 0 else '--------------------'
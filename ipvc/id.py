@@ -34,9 +34,11 @@ class IdAPI(CommonAPI):
             self.print_id(peer_id, data, '  ')
 
     @atomic
-    def create(self, key, use=False):
+    def create(self, key, use=False, key_type='rsa'):
         """
-        Creates new IPFS key for a IPVC id
+        Creates new IPFS key for a IPVC id. Commits are signed with the key,
+        `key_type` can be 'rsa' or 'ed25519' (faster, but verifying commits
+        signed with it needs the `cryptography` package)
         """
         self.common()
         self.print(f'Generating key with name "{key}"')
@@ -49,7 +51,7 @@ class IdAPI(CommonAPI):
             return ipfs_keys[key]
 
         try:
-            ret = self.ipfs.key_gen(key, 'rsa', 2048)
+            ret = self.ipfs.key_gen(key, key_type, 2048)
             self.print(f'Generated id with PeerID {ret["Id"]}')
             self.print((f'To set parameters for the id, run '
                         '`ipvc set [--name ...] [--email ...] [--desc ...] '
@@ -1,53 +1,78 @@
 import os
 import sys
-import time
+import pickle
+import asyncio
+import hashlib
+import importlib
 from pathlib import Path
-from collections import defaultdict
-from functools import wraps
-from ipvc.repo import RepoAPI
-from ipvc.stage import StageAPI
-from ipvc.branch import BranchAPI
-from ipvc.diff import DiffAPI
-from ipvc.id import IdAPI
+from ipvc.common import (
+    MATERIALIZE_BUFFER_SIZE, OBJECT_CACHE_SIZE, DIFF_CACHE_SIZE,
+    default_cache_dir, default_store_dir)
+from ipvc.object_cache import ObjectCache
+from ipvc.backend import BACKENDS, AsyncBackend, HTTPBackend
+from ipvc.transport import parse_ipfs_ip
+from ipvc.trace import Tracer, traced_call
 
 import ipfsapi
 
+# The API modules are imported when first used, so that a command only
+# imports the modules it needs
+APIS = {
+    'repo': ('ipvc.repo', 'RepoAPI'),
+    'stage': ('ipvc.stage', 'StageAPI'),
+    'branch': ('ipvc.branch', 'BranchAPI'),
+    'diff': ('ipvc.diff', 'DiffAPI'),
+    'id': ('ipvc.id', 'IdAPI'),
+}
+
+TRACED_METHODS = [
+    'files_rm', 'files_cp', 'files_mv', 'files_write', 'files_mkdir',
+    'files_stat', 'files_ls', 'files_read', 'files_flush', 'ls', 'cat',
+    'object_diff', 'object_stat', 'add', 'add_bytes', 'block_put'
+]
+TRACED_ASYNC_METHODS = [
+    'files_stat', 'files_read', 'files_ls', 'cat', 'ls', 'object_diff'
+]
+
 
 class IPVC:
     def __init__(self, cwd:Path=None, mfs_namespace=None, ipfs_ip=None,
                  delete_mfs=False, init_mfs=True, quiet=False, quieter=False,
-                 verbose=False, stdout=None, stderr=None):
+                 verbose=False, stdout=None, stderr=None, buffer_size=None,
+                 cache_dir=None, cache_size=None, defer_flush=True,
+                 backend='daemon', store_dir=None, trace=False,
+                 persist_properties=True):
         cwd = cwd or Path.cwd()
         mfs_namespace = mfs_namespace or '/'
         assert isinstance(cwd, Path)
+        self.tracer = Tracer(trace)
+        self.buffer_size = buffer_size or MATERIALIZE_BUFFER_SIZE
+        self.cache_dir = Path(cache_dir) if cache_dir else default_cache_dir()
+        cache_size = OBJECT_CACHE_SIZE if cache_size is None else cache_size
+        # A cache size of 0 disables the object cache, and the diff cache
+        self.object_cache, self.diff_cache = None, None
+        if cache_size > 0:
+            self.object_cache = ObjectCache(self.cache_dir / 'objects', cache_size)
+            self.diff_cache = ObjectCache(self.cache_dir / 'diffs', DIFF_CACHE_SIZE)
 
-        ip_port_args = []
-        if ipfs_ip is not None:
-            try:
-                ip, port = ipfs_ip.split(':')
-                ip_port_args.append(ip)
-                if len(port) > 0:
-                    ip_port_args.append(int(port))
-            except:
-                print("IPFS ip/port '{ipfs_ip}' is not on the right format, e.g. '127.0.0.1:5000'",
-                      file=sys.stderr)
-                raise RuntimeError
-            if ip not in ['localhost', '127.0.0.1']:
-                # NOTE: since we cannot get a peer_id's public/private key
-                # through the go-ipfs HTTP API as of writing, we have to get
-                # the keys by first calling repo_stat() to get the location of
-                # the ipfs repo, and then read the keys from the filesystem,
-                # therefore, the node we're connecting to has to be local
-                print('Currently only localhost ipfs nodes are supported',
-                      file=sys.stderr)
-                raise RuntimeError
+        # Within atomic API calls, MFS mutations are not flushed up to the
+        # root on each call, mfs_flush() is called once at the end instead
+        self.defer_flush = defer_flush
+        self.mfs_batch_depth = 0
+        def _is_deferred():
+            return self.defer_flush and self.mfs_batch_depth > 0
 
-
-        try:
-            self.ipfs = ipfsapi.connect(*ip_port_args)
-        except ipfsapi.exceptions.ConnectionError:
-            print("Couldn't connect to IPFS, is it running?", file=sys.stderr)
-            exit(1)
+        if backend == 'local':
+            from ipvc.localstore import LocalBackend
+            self.ipfs = LocalBackend(store_dir or default_store_dir(), _is_deferred)
+            self.aipfs = AsyncBackend(self.ipfs)
+        elif backend == 'daemon':
+            self._connect_daemon(ipfs_ip, _is_deferred)
+        else:
+            print(f"Unknown backend '{backend}', use one of {', '.join(BACKENDS)}",
+                  file=sys.stderr)
+            raise RuntimeError
+        self._loop = None
 
         if delete_mfs:
             try:
@@ -68,56 +93,148 @@ class IPVC:
             except:
                 pass
 
-        def object_diff(hash_a, hash_b):
-            # NOTE: use ipfs.object_diff when it's released
-            return self.ipfs._client.request(
-                '/object/diff', (hash_a, hash_b), decoder='json')
-        setattr(self.ipfs, 'object_diff', object_diff)
-
-        self._timings = defaultdict(lambda: 0)
-        self._call_count = defaultdict(lambda: 0)
-        self.print_calls = False
-        def _profile(method):
-            @wraps(method)
-            def _impl(*args, **kwargs):
-                t0 = time.time()
-                ret = method(*args, **kwargs)
-                t1 = time.time()
-                self._call_count[method.__name__] += 1
-                self._timings[method.__name__] += t1 - t0
-                if self.print_calls:
-                    print(f'{(t1-t0):.3} {method.__name__}', *args)
-                return ret
-            return _impl
-
-        profile_methods = [
-            'files_rm', 'files_cp', 'files_write', 'files_mkdir', 'files_stat',
-            'files_ls', 'files_read', 'ls', 'cat', 'object_diff'
-        ]
-        for m in profile_methods:
-            setattr(self.ipfs, m, _profile(getattr(self.ipfs, m)))
-
-        args = (self, self.ipfs, cwd, mfs_namespace, quiet, quieter, verbose,
-                stdout, stderr)
-        self.repo = RepoAPI(*args)
-        self.stage = StageAPI(*args)
-        self.branch = BranchAPI(*args)
-        self.diff = DiffAPI(*args)
-        self.id = IdAPI(*args)
+        # Backend calls are always counted and timed, and recorded as spans
+        # when tracing. The async adapter of the local backend calls the
+        # traced methods of self.ipfs, so only the daemon client is wrapped
+        for m in TRACED_METHODS:
+            setattr(self.ipfs, m, traced_call(self.tracer, m, getattr(self.ipfs, m)))
+        if not isinstance(self.aipfs, AsyncBackend):
+            for m in TRACED_ASYNC_METHODS:
+                setattr(self.aipfs, m,
+                        traced_call(self.tracer, m, getattr(self.aipfs, m)))
+
+        self.cwd = cwd
+        self.mfs_namespace = Path(mfs_namespace)
+        self._api_args = (self, self.ipfs, cwd, mfs_namespace, quiet, quieter,
+                          verbose, stdout, stderr)
         self._property_cache = {}
+        # Cached properties are saved in the cache dir between processes,
+        # see load_property_cache
+        self.persist_properties = persist_properties
+        self._property_cache_loaded = False
+        self._saved_property_cache = None
+
+    def __getattr__(self, name):
+        # Creates the API objects (self.repo, self.stage etc.) on first use
+        if name not in APIS or '_api_args' not in self.__dict__:
+            raise AttributeError(name)
+        module, class_ = APIS[name]
+        api = getattr(importlib.import_module(module), class_)(*self._api_args)
+        setattr(self, name, api)
+        return api
+
+    def _connect_daemon(self, ipfs_ip, is_deferred):
+        try:
+            ip, port, socket_path = parse_ipfs_ip(ipfs_ip)
+        except ValueError:
+            print(f"IPFS ip/port '{ipfs_ip}' is not on the right format, e.g. "
+                  "'127.0.0.1:5000' or 'unix:/path/to/api.sock'", file=sys.stderr)
+            raise RuntimeError
+        if ip is not None and ip not in ['localhost', '127.0.0.1']:
+            # NOTE: since we cannot get a peer_id's public/private key
+            # through the go-ipfs HTTP API as of writing, we have to get
+            # the keys by first calling repo_stat() to get the location of
+            # the ipfs repo, and then read the keys from the filesystem,
+            # therefore, the node we're connecting to has to be local
+            print('Currently only localhost ipfs nodes are supported',
+                  file=sys.stderr)
+            raise RuntimeError
+
+        from ipvc.aioipfs import AsyncIPFSClient
+        try:
+            self.ipfs = HTTPBackend(ip, port, socket_path, is_deferred)
+        except ipfsapi.exceptions.ConnectionError:
+            print("Couldn't connect to IPFS, is it running?", file=sys.stderr)
+            exit(1)
+
+        # Used for making independent requests concurrently, see run_async
+        self.aipfs = AsyncIPFSClient(
+            ip or ipfsapi.DEFAULT_HOST, port or ipfsapi.DEFAULT_PORT,
+            socket_path=socket_path)
+
+    @property
+    def mfs_mutation_count(self):
+        return self.ipfs.mutation_count
 
     def set_cwd(self, cwd):
         assert isinstance(cwd, Path)
-        self.repo.set_cwd(cwd)
-        self.stage.set_cwd(cwd)
-        self.branch.set_cwd(cwd)
-        self.diff.set_cwd(cwd)
-        self.id.set_cwd(cwd)
+        self.cwd = cwd
+        self._api_args = self._api_args[:2] + (cwd,) + self._api_args[3:]
+        self._property_cache = {}
+        self._property_cache_loaded = False
+        for name in APIS:
+            if name in self.__dict__:
+                self.__dict__[name].set_cwd(cwd)
+
+    def run_async(self, *coros):
+        """ Runs coroutines of the async API concurrently to completion, and
+        returns their results (or the result if given a single coroutine). The
+        same event loop is used for all calls so that connections are kept
+        alive between them """
+        async def _gather():
+            return await asyncio.gather(*coros)
+
+        if self._loop is None:
+            self._loop = asyncio.new_event_loop()
+        with self.tracer.span('run_async', count=len(coros)):
+            ret = self._loop.run_until_complete(_gather())
+        return ret[0] if len(coros) == 1 else ret
+
+    def mfs_flush(self, path='/'):
+        self.ipfs.files_flush(path)
+
+    def _property_cache_file(self):
+        key = f'{self.mfs_namespace}\0{self.cwd}'.encode('utf-8')
+        return self.cache_dir / 'properties' / f'{hashlib.sha1(key).hexdigest()}.pickle'
+
+    def _mfs_root_hash(self):
+        return self.ipfs.files_stat(self.mfs_namespace / 'ipvc')['Hash']
+
+    def load_property_cache(self):
+        """ Loads the cached properties saved by an earlier process for the
+        same namespace and working directory. The properties only depend on
+        what's in MFS under the ipvc root, so they are valid if its hash is
+        the same as when they were saved. Loading is only done once, and
+        only outside of atomic calls, where MFS is flushed and the root hash
+        is up to date """
+        if (self._property_cache_loaded or not self.persist_properties or
+                self.mfs_batch_depth > 0):
+            return
+        self._property_cache_loaded = True
+        try:
+            with open(self._property_cache_file(), 'rb') as f:
+                data = f.read()
+            root_hash, properties = pickle.loads(data)
+        except Exception:
+            return
+        if root_hash == self._mfs_root_hash():
+            for name, value in properties.items():
+                self._property_cache.setdefault(name, value)
+            self._saved_property_cache = data
+
+    def save_property_cache(self):
+        """ Saves the cached properties together with the current hash of
+        the ipvc root in MFS, see load_property_cache """
+        if not self.persist_properties or self.mfs_batch_depth > 0:
+            return
+        data = pickle.dumps((self._mfs_root_hash(), self._property_cache))
+        if data == self._saved_property_cache:
+            return
+        path = self._property_cache_file()
+        tmp_path = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+            self._saved_property_cache = data
+        except OSError:
+            pass
 
     def print_ipfs_profile_info(self):
         print('Call counts:')
-        for name, count in self._call_count.items():
+        for name, count in self.tracer.call_counts.items():
             print(f'{name}: {count}')
         print('Timings:')
-        for name, timing in self._timings.items():
+        for name, timing in self.tracer.call_seconds.items():
             print(f'{name}: {timing}')
@@ -0,0 +1,218 @@
+"""
+Diffs of long sequences of lines, given as hashes of the lines, in about
+linear time for the usual case of files with a few scattered changes.
+difflib's SequenceMatcher compares every line with the lines it could match,
+which takes minutes for files with millions of lines.
+
+The common prefix and suffix are skipped first. Then lines that occur exactly
+once on both sides are matched up in order by their longest increasing
+subsequence (patience diff), and the ranges between these anchors are diffed
+the same way. Ranges without unique lines are diffed with Myers' algorithm,
+which takes time proportional to the square of the number of differences, so
+it gives up and the whole diff returns None when the work exceeds a budget
+"""
+import bisect
+import operator
+from collections import Counter
+
+# Budget of steps for Myers' algorithm for a whole diff, roughly a second
+MAX_DIFF_WORK = 2 * 10**6
+
+
+class _BudgetExceeded(Exception):
+    pass
+
+
+def _unique_anchors(a, alo, ahi, b, blo, bhi):
+    """ Returns the pairs (i, j) of lines that occur once in a[alo:ahi] and
+    once in b[blo:bhi], which are in the same order on both sides """
+    a_lines, b_lines = a[alo:ahi], b[blo:bhi]
+    a_counts, b_counts = Counter(a_lines), Counter(b_lines)
+    a_index = {line: i for i, line in enumerate(a_lines, alo)}
+    pairs = [(a_index[line], j) for j, line in enumerate(b_lines, blo)
+             if b_counts[line] == 1 and a_counts[line] == 1]
+    if all(map(operator.lt, pairs, pairs[1:])):
+        # Nothing was moved, so all pairs are in order
+        return pairs
+
+    # Longest increasing subsequence of i by patience sorting
+    tails, tail_indices, previous = [], [], []
+    for n, (i, _) in enumerate(pairs):
+        pile = bisect.bisect_left(tails, i)
+        previous.append(tail_indices[pile - 1] if pile > 0 else -1)
+        if pile == len(tails):
+            tails.append(i)
+            tail_indices.append(n)
+        else:
+            tails[pile] = i
+            tail_indices[pile] = n
+    anchors = []
+    n = tail_indices[-1] if len(tail_indices) > 0 else -1
+    while n >= 0:
+        anchors.append(pairs[n])
+        n = previous[n]
+    return anchors[::-1]
+
+
+def _myers(a, alo, ahi, b, blo, bhi, budget):
+    """ Returns the matching blocks of a[alo:ahi] and b[blo:bhi] of a
+    shortest edit script, using up `budget` (a list with the number of steps
+    left) """
+    n, m = ahi - alo, bhi - blo
+    v, trace = {1: 0}, []
+    for d in range(n + m + 1):
+        trace.append(v.copy())
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and v[k - 1] < v[k + 1]):
+                x = v[k + 1]
+            else:
+                x = v[k - 1] + 1
+            y, x_start = x - k, x
+            while x < n and y < m and a[alo + x] == b[blo + y]:
+                x += 1
+                y += 1
+            v[k] = x
+            budget[0] -= 1 + x - x_start
+            if x >= n and y >= m:
+                return _myers_blocks(trace, n, m, alo, blo)
+        if budget[0] < 0:
+            raise _BudgetExceeded()
+
+
+def _myers_blocks(trace, x, y, alo, blo):
+    """ Walks back from the end through the steps in `trace`, and returns the
+    diagonals (matching lines) between the edits """
+    blocks = []
+    for d in range(len(trace) - 1, -1, -1):
+        v, k = trace[d], x - y
+        if k == -d or (k != d and v[k - 1] < v[k + 1]):
+            prev_k = k + 1
+        else:
+            prev_k = k - 1
+        prev_x = v[prev_k]
+        prev_y = prev_x - prev_k
+        size = min(x - prev_x, y - prev_y)
+        if size > 0:
+            blocks.append((alo + x - size, blo + y - size, size))
+        x, y = prev_x, prev_y
+    return blocks
+
+
+def matching_blocks(a, b, budget=None):
+    """ Returns the matching blocks (i, j, size) of the sequences `a` and `b`
+    like SequenceMatcher.get_matching_blocks, ending with (len(a), len(b), 0),
+    or None if diffing them takes more than `budget` steps, which defaults to
+    MAX_DIFF_WORK """
+    budget = [MAX_DIFF_WORK if budget is None else budget]
+    blocks = []
+    ranges = [(0, len(a), 0, len(b))]
+    try:
+        while len(ranges) > 0:
+            alo, ahi, blo, bhi = ranges.pop()
+            start = alo
+            while alo < ahi and blo < bhi and a[alo] == b[blo]:
+                alo, blo = alo + 1, blo + 1
+            if alo > start:
+                blocks.append((start, blo - (alo - start), alo - start))
+            end = ahi
+            while alo < ahi and blo < bhi and a[ahi - 1] == b[bhi - 1]:
+                ahi, bhi = ahi - 1, bhi - 1
+            if ahi < end:
+                blocks.append((ahi, bhi, end - ahi))
+            if alo == ahi or blo == bhi:
+                continue
+
+            anchors = _unique_anchors(a, alo, ahi, b, blo, bhi)
+            if len(anchors) == 0:
+                blocks += _myers(a, alo, ahi, b, blo, bhi, budget)
+                continue
+            for i, j in anchors:
+                if i == alo and j == blo and len(blocks) > 0 and \
+                        blocks[-1][0] + blocks[-1][2] == i and \
+                        blocks[-1][1] + blocks[-1][2] == j:
+                    # Extend the run of consecutive anchors
+                    blocks[-1] = (blocks[-1][0], blocks[-1][1], blocks[-1][2] + 1)
+                else:
+                    blocks.append((i, j, 1))
+                    if i > alo or j > blo:
+                        ranges.append((alo, i, blo, j))
+                alo, blo = i + 1, j + 1
+            if alo < ahi or blo < bhi:
+                ranges.append((alo, ahi, blo, bhi))
+    except _BudgetExceeded:
+        return None
+
+    # Join adjacent blocks
+    joined = []
+    for i, j, size in sorted(blocks):
+        if len(joined) > 0 and joined[-1][0] + joined[-1][2] == i and \
+                joined[-1][1] + joined[-1][2] == j:
+            joined[-1] = (joined[-1][0], joined[-1][1], joined[-1][2] + size)
+        else:
+            joined.append((i, j, size))
+    return joined + [(len(a), len(b), 0)]
+
+
+def opcodes(blocks):
+    """ Returns the opcodes for matching blocks, like SequenceMatcher.get_opcodes """
+    codes, i, j = [], 0, 0
+    for ai, bj, size in blocks:
+        tag = ''
+        if i < ai and j < bj:
+            tag = 'replace'
+        elif i < ai:
+            tag = 'delete'
+        elif j < bj:
+            tag = 'insert'
+        if tag:
+            codes.append((tag, i, ai, j, bj))
+        i, j = ai + size, bj + size
+        if size > 0:
+            codes.append(('equal', ai, i, bj, j))
+    return codes
+
+
+def grouped_opcodes(codes, n=3):
+    """ Groups opcodes into hunks with up to `n` lines of context, like
+    SequenceMatcher.get_grouped_opcodes """
+    if len(codes) == 0:
+        codes = [('equal', 0, 1, 0, 1)]
+    codes = list(codes)
+    # Fix up the leading and trailing unchanged ranges, they have at most n lines
+    if codes[0][0] == 'equal':
+        tag, i1, i2, j1, j2 = codes[0]
+        codes[0] = tag, max(i1, i2 - n), i2, max(j1, j2 - n), j2
+    if codes[-1][0] == 'equal':
+        tag, i1, i2, j1, j2 = codes[-1]
+        codes[-1] = tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n)
+
+    groups, group = [], []
+    for tag, i1, i2, j1, j2 in codes:
+        # End the current group and start a new one at long unchanged ranges
+        if tag == 'equal' and i2 - i1 > n * 2:
+            group.append((tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n)))
+            groups.append(group)
+            group = []
+            i1, j1 = max(i1, i2 - n), max(j1, j2 - n)
+        group.append((tag, i1, i2, j1, j2))
+    if len(group) > 0 and not (len(group) == 1 and group[0][0] == 'equal'):
+        groups.append(group)
+    return groups
+
+
+def count_changes(a, a_sizes, b, b_sizes, budget=None):
+    """ Returns the numbers of added and removed items of `b` and `a`, and
+    their total sizes, or None if diffing them takes more than `budget` steps.
+    This is a module function so that it can run in a process pool """
+    blocks = matching_blocks(a, b, budget)
+    if blocks is None:
+        return None
+    added, removed, added_size, removed_size = 0, 0, 0, 0
+    for tag, i1, i2, j1, j2 in opcodes(blocks):
+        if tag in ['replace', 'delete']:
+            removed += i2 - i1
+            removed_size += sum(a_sizes[i1:i2])
+        if tag in ['replace', 'insert']:
+            added += j2 - j1
+            added_size += sum(b_sizes[j1:j2])
+    return added, removed, added_size, removed_size
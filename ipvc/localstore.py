@@ -0,0 +1,639 @@
+"""
+An in-process content addressed store with an emulation of the IPFS mutable
+file system (MFS), so that ipvc can run without an IPFS daemon. Files and
+directories are laid out the same way as by `ipfs add` and MFS, so added files
+and directories have the same hashes as with the daemon. Files written with
+files_write are chunked with the balanced layout like added files, while the
+daemon uses the trickle layout for them, so their hashes differ from the
+daemon's when they are bigger than one chunk (256 KiB).
+
+Blocks are stored one per file under the store directory. MFS is kept in
+memory as a tree of directories that are loaded from blocks when first
+visited, and hashed only when their hash is needed, so a series of mutations
+rehashes each directory once. The MFS root hash is written to disk on
+files_flush, or after every mutation when flushing isn't deferred.
+
+Several processes can use the same store. A process picks up the MFS root
+written by another one when it has no unflushed changes of its own, and the
+root is only written if it's still the one the changes were made on, so that
+concurrent changes fail instead of overwriting each other
+"""
+import os
+import io
+import json
+import base64
+import threading
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, where flushes aren't locked between processes
+    fcntl = None
+from pathlib import Path
+from functools import wraps
+from collections import namedtuple
+
+import ipfsapi
+
+from ipvc.dag import (
+    MAX_LEAF_SIZE, UNIXFS_DIRECTORY, balanced_file, block_hash, decode_node,
+    decode_unixfs, directory_node)
+
+# Decoded nodes kept in memory, the cache is cleared when it gets bigger
+NODE_CACHE_SIZE = 16384
+# Value type 5 is a HAMT sharded directory, which we only read
+UNIXFS_HAMT_SHARD = 5
+
+# A link to an immutable node, with the cumulative size of the node
+Ref = namedtuple('Ref', ['hash', 'size'])
+
+
+def _error(message):
+    return ipfsapi.exceptions.ErrorResponse(message, None)
+
+
+def _parts(path):
+    return [part for part in str(path).split('/') if len(part) > 0]
+
+
+def _read_chunks(f):
+    while True:
+        chunk = f.read(MAX_LEAF_SIZE)
+        if len(chunk) == 0:
+            return
+        yield chunk
+
+
+class BlockStore:
+    """ Blocks are stored under `path`/blocks, keyed by hash. Blocks are
+    written to a temporary file and renamed in place, so several processes
+    can use the same store """
+    def __init__(self, path):
+        self.path = Path(path)
+        self._known = set()
+        self._nodes = {}
+
+    def block_path(self, h):
+        return self.path / 'blocks' / h[-2:] / h
+
+    def put(self, block: bytes):
+        h = block_hash(block)
+        if h in self._known:
+            return h
+        block_path = self.block_path(h)
+        if not block_path.exists():
+            block_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = block_path.parent / \
+                f'.{h}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(block)
+            os.replace(tmp_path, block_path)
+        self._known.add(h)
+        return h
+
+    def get(self, h):
+        try:
+            with open(self.block_path(h), 'rb') as f:
+                return f.read()
+        except (FileNotFoundError, ValueError, IndexError):
+            raise _error(f'merkledag: not found: {h}')
+
+    def node(self, h):
+        node = self._nodes.get(h, None)
+        if node is None:
+            node = decode_node(self.get(h))
+            if len(self._nodes) >= NODE_CACHE_SIZE:
+                self._nodes.clear()
+            self._nodes[h] = node
+        return node
+
+    def unixfs(self, h):
+        return decode_unixfs(self.node(h).data)
+
+    def is_dir(self, h):
+        return self.unixfs(h)['Type'] in [UNIXFS_DIRECTORY, UNIXFS_HAMT_SHARD]
+
+    def cumulative_size(self, h):
+        node = self.node(h)
+        return len(node.block) + sum(size for _, _, size in node.links)
+
+
+class MFSDir:
+    """ A directory in MFS. Entries are either loaded MFSDirs or Refs, and
+    `_link` is the (hash, cumulative size) of the directory, or None if it
+    has changed since it was last hashed """
+    def __init__(self, blocks, link):
+        self.blocks = blocks
+        self._link = link
+        self._entries = None
+
+    @property
+    def entries(self):
+        if self._entries is None:
+            node = self.blocks.node(self._link[0])
+            if self.blocks.unixfs(self._link[0])['Type'] != UNIXFS_DIRECTORY:
+                raise _error('sharded directories are not supported in MFS')
+            self._entries = {name: Ref(h, size) for name, h, size in node.links}
+        return self._entries
+
+    def child_dir(self, name):
+        """ Returns the child directory `name`, or None if there is none """
+        entry = self.entries.get(name, None)
+        if isinstance(entry, MFSDir):
+            return entry
+        if entry is None or not self.blocks.is_dir(entry.hash):
+            return None
+        child = MFSDir(self.blocks, entry)
+        self.entries[name] = child
+        return child
+
+    def link(self):
+        """ Hashes the directory and writes its block, along with the blocks
+        of changed subdirectories """
+        if self._link is None:
+            links = [(name, *entry_link(entry))
+                     for name, entry in self.entries.items()]
+            node = directory_node(links)
+            self.blocks.put(node.block)
+            self._link = Ref(node.hash, node.cumulative_size)
+        return self._link
+
+
+def entry_link(entry):
+    return entry.link() if isinstance(entry, MFSDir) else entry
+
+
+class Store:
+    """ The blocks and MFS of a store directory, shared by all backends that
+    use the same directory in a process """
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.blocks = BlockStore(self.path)
+        self.lock = threading.RLock()
+        root_hash = self._read_root_hash()
+        if root_hash is None:
+            self.root = self.empty_dir()
+        else:
+            self._load_root(root_hash)
+        # The root hash on disk that the MFS in memory is based on
+        self.base_hash = self.root.link().hash
+
+    def empty_dir(self):
+        node = directory_node([])
+        self.blocks.put(node.block)
+        return MFSDir(self.blocks, Ref(node.hash, node.cumulative_size))
+
+    def _read_root_hash(self):
+        try:
+            with open(self.path / 'mfs_root') as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            return None
+
+    def _load_root(self, root_hash):
+        self.root = MFSDir(self.blocks, Ref(
+            root_hash, self.blocks.cumulative_size(root_hash)))
+        self.base_hash = root_hash
+
+    def _is_clean(self):
+        """ Whether there are no changes to MFS since it was loaded or flushed """
+        return self.root._link is not None and self.root._link.hash == self.base_hash
+
+    def refresh(self):
+        """ Loads the MFS root written by another process, unless there are
+        changes that haven't been flushed """
+        root_hash = self._read_root_hash()
+        if root_hash is not None and root_hash != self.base_hash and self._is_clean():
+            self._load_root(root_hash)
+
+    def flush(self):
+        """ Writes the MFS root hash to disk, if the root on disk is still the
+        one that the changes were made on. Otherwise another process has
+        flushed its changes in the meantime, and ours are dropped """
+        root_hash = self.root.link().hash
+        with open(self.path / 'lock', 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            disk_hash = self._read_root_hash()
+            if disk_hash is not None and disk_hash != self.base_hash:
+                self._load_root(disk_hash)
+                raise _error('MFS was changed by another process, try again')
+            if root_hash == disk_hash:
+                return
+            tmp_path = self.path / f'.mfs_root.{os.getpid()}.tmp'
+            with open(tmp_path, 'w') as f:
+                f.write(root_hash)
+            os.replace(tmp_path, self.path / 'mfs_root')
+            self.base_hash = root_hash
+
+
+_STORES = {}
+_STORES_LOCK = threading.Lock()
+
+
+def open_store(path):
+    path = Path(path).resolve()
+    with _STORES_LOCK:
+        if path not in _STORES:
+            _STORES[path] = Store(path)
+        return _STORES[path]
+
+
+def locked(method):
+    @wraps(method)
+    def _impl(self, *args, **kwargs):
+        with self.store.lock:
+            if not self.is_deferred():
+                self.store.refresh()
+            return method(self, *args, **kwargs)
+    return _impl
+
+
+class LocalBackend:
+    """ Implements the same methods as ipvc.backend.HTTPBackend on a local
+    store. `is_deferred` is called to check whether mutations of MFS should
+    be written to disk right away, or only on files_flush() """
+    def __init__(self, store_dir, is_deferred=lambda: False):
+        self.store = open_store(store_dir)
+        self.blocks = self.store.blocks
+        self.is_deferred = is_deferred
+        self.mutation_count = 0
+
+    def _mutated(self, chain):
+        for mfs_dir in chain:
+            mfs_dir._link = None
+        self.mutation_count += 1
+        if not self.is_deferred():
+            self.store.flush()
+
+    # ---------- Paths ----------
+
+    def _walk(self, parts, parents=False):
+        """ Returns the chain of MFS directories from the root to the
+        directory at `parts`, creating missing ones if `parents` is set """
+        chain = [self.store.root]
+        for i, name in enumerate(parts):
+            child = chain[-1].child_dir(name)
+            if child is None:
+                if not parents or name in chain[-1].entries:
+                    raise _error(f'{"/" + "/".join(parts[:i+1])}: file does not exist')
+                child = self.store.empty_dir()
+                chain[-1].entries[name] = child
+            chain.append(child)
+        return chain
+
+    def _resolve_ipfs(self, path):
+        """ Resolves an /ipfs/, /ipns/ or plain hash path to a Ref """
+        parts = _parts(path)
+        if len(parts) == 0:
+            raise _error(f'invalid path "{path}"')
+        if parts[0] == 'ipns' and len(parts) > 1:
+            parts = _parts(self._resolve_name(parts[1])) + parts[2:]
+        if parts[0] == 'ipfs':
+            parts = parts[1:]
+        if len(parts) == 0:
+            raise _error(f'invalid path "{path}"')
+
+        h, size = parts[0], None
+        for name in parts[1:]:
+            links = {l[0]: l for l in self.blocks.node(h).links}
+            if name not in links:
+                raise _error(f'no link named "{name}" under {h}')
+            _, h, size = links[name]
+        if size is None:
+            size = self.blocks.cumulative_size(h)
+        return Ref(h, size)
+
+    def _ref(self, path):
+        """ Returns the Ref of an MFS or /ipfs/ path """
+        parts = _parts(path)
+        if len(parts) > 0 and parts[0] in ['ipfs', 'ipns']:
+            return self._resolve_ipfs(path)
+        if len(parts) == 0:
+            return self.store.root.link()
+        parent = self._walk(parts[:-1])[-1]
+        if parts[-1] not in parent.entries:
+            raise _error(f'{path}: file does not exist')
+        return entry_link(parent.entries[parts[-1]])
+
+    # ---------- Files ----------
+
+    def _add_chunks(self, chunks):
+        return Ref(*balanced_file(chunks, lambda node: self.blocks.put(node.block)))
+
+    def _read(self, h, offset=0, count=None):
+        end = None if count is None else offset + count
+        out = []
+
+        def _read_range(h, start, end):
+            node = self.blocks.node(h)
+            unixfs = decode_unixfs(node.data)
+            data = unixfs['Data']
+            out.append(data[max(start, 0):end])
+            pos = len(data)
+            for (_, child, _), size in zip(node.links, unixfs['blocksizes']):
+                if (end is None or pos < end) and pos + size > start:
+                    _read_range(child, start - pos,
+                                None if end is None else end - pos)
+                pos += size
+
+        if self.blocks.is_dir(h):
+            raise _error('this dag node is a directory')
+        _read_range(h, offset, end)
+        return b''.join(out)
+
+    @locked
+    def add(self, path, **kwargs):
+        if hasattr(path, 'read'):
+            ref = self._add_chunks(_read_chunks(path))
+            name = ''
+        else:
+            if os.path.isdir(path):
+                raise _error(f'{path} is a directory')
+            with open(path, 'rb') as f:
+                ref = self._add_chunks(_read_chunks(f))
+            name = os.path.basename(str(path))
+        return {'Name': name or ref.hash, 'Hash': ref.hash, 'Size': str(ref.size)}
+
+    @locked
+    def add_bytes(self, data: bytes, **kwargs):
+        return self._add_chunks(_read_chunks(io.BytesIO(data))).hash
+
+    @locked
+    def block_put(self, file, **kwargs):
+        block = file.read() if hasattr(file, 'read') else file
+        return {'Key': self.blocks.put(block), 'Size': len(block)}
+
+    @locked
+    def object_stat(self, path, **kwargs):
+        h = self._resolve_ipfs(path).hash
+        node = self.blocks.node(h)
+        block_size = len(node.block)
+        return {
+            'Hash': h, 'NumLinks': len(node.links), 'BlockSize': block_size,
+            'LinksSize': block_size - len(node.data), 'DataSize': len(node.data),
+            'CumulativeSize': self.blocks.cumulative_size(h)
+        }
+
+    @locked
+    def cat(self, path, **kwargs):
+        return self._read(self._resolve_ipfs(path).hash)
+
+    @locked
+    def ls(self, path, **kwargs):
+        h = self._resolve_ipfs(path).hash
+        links = []
+        # NOTE: the daemon lists the chunks of large files, we list no links
+        # for any file, which is what ipvc checks for
+        if self.blocks.is_dir(h):
+            for name, child, size in self.blocks.node(h).links:
+                child_type = 1 if self.blocks.is_dir(child) else 2
+                links.append({'Name': name, 'Hash': child, 'Size': size,
+                              'Type': child_type})
+        return {'Objects': [{'Hash': str(path), 'Links': links}]}
+
+    @locked
+    def object_links(self, path, **kwargs):
+        h = self._resolve_ipfs(path).hash
+        links = [{'Name': name, 'Hash': child, 'Size': size}
+                 for name, child, size in self.blocks.node(h).links]
+        return {'Hash': h, 'Links': links}
+
+    @locked
+    def object_diff(self, hash_a, hash_b):
+        """ Like `ipfs object diff`, changes are found recursively in
+        directories, while files are compared by hash only """
+        changes = []
+
+        def _diff(a, b, prefix):
+            if a == b:
+                return
+            if not self.blocks.is_dir(a) or not self.blocks.is_dir(b):
+                changes.append({'Type': 2, 'Path': prefix,
+                                'Before': {'/': a}, 'After': {'/': b}})
+                return
+            links_a = {name: h for name, h, _ in self.blocks.node(a).links}
+            links_b = {name: h for name, h, _ in self.blocks.node(b).links}
+            for name, h in links_a.items():
+                if name in links_b:
+                    _diff(h, links_b[name], f'{prefix}/{name}' if prefix else name)
+            for name, h in links_a.items():
+                if name not in links_b:
+                    changes.append({'Type': 1, 'Path': f'{prefix}/{name}' if prefix else name,
+                                    'Before': {'/': h}, 'After': None})
+            for name, h in links_b.items():
+                if name not in links_a:
+                    changes.append({'Type': 0, 'Path': f'{prefix}/{name}' if prefix else name,
+                                    'Before': None, 'After': {'/': h}})
+
+        _diff(self._resolve_ipfs(hash_a).hash, self._resolve_ipfs(hash_b).hash, '')
+        return {'Changes': changes}
+
+    @locked
+    def pin_add(self, path, **kwargs):
+        # Everything in the store is kept, but the content has to be here
+        # since there is no network to fetch it from
+        h = self._resolve_ipfs(path).hash
+        return {'Pins': [h]}
+
+    # ---------- MFS ----------
+
+    @locked
+    def files_stat(self, path, **kwargs):
+        h, size = self._ref(path)
+        unixfs = self.blocks.unixfs(h)
+        is_dir = unixfs['Type'] in [UNIXFS_DIRECTORY, UNIXFS_HAMT_SHARD]
+        return {
+            'Hash': h, 'Size': 0 if is_dir else unixfs['filesize'],
+            'CumulativeSize': size, 'Blocks': len(self.blocks.node(h).links),
+            'Type': 'directory' if is_dir else 'file'
+        }
+
+    @locked
+    def files_ls(self, path, long=False, **kwargs):
+        h = self._ref(path).hash
+        if not self.blocks.is_dir(h):
+            return {'Entries': [{'Name': _parts(path)[-1], 'Type': 0,
+                                 'Size': 0, 'Hash': ''}]}
+        entries = []
+        for name, child, _ in self.blocks.node(h).links:
+            entry = {'Name': name, 'Type': 0, 'Size': 0, 'Hash': ''}
+            if long:
+                unixfs = self.blocks.unixfs(child)
+                is_dir = self.blocks.is_dir(child)
+                entry.update({'Type': 1 if is_dir else 0, 'Hash': child,
+                              'Size': 0 if is_dir else unixfs['filesize']})
+            entries.append(entry)
+        return {'Entries': entries}
+
+    @locked
+    def files_read(self, path, offset=0, count=None, **kwargs):
+        h = self._ref(path).hash
+        if self.blocks.is_dir(h):
+            raise _error(f'{path} was not a file')
+        return self._read(h, offset, count)
+
+    @locked
+    def files_mkdir(self, path, parents=False, **kwargs):
+        parts = _parts(path)
+        if len(parts) == 0:
+            if parents:
+                return
+            raise _error('file already exists')
+        chain = self._walk(parts[:-1], parents)
+        if parts[-1] in chain[-1].entries:
+            if parents and chain[-1].child_dir(parts[-1]) is not None:
+                return
+            raise _error('file already exists')
+        chain[-1].entries[parts[-1]] = self.store.empty_dir()
+        self._mutated(chain)
+
+    @locked
+    def files_rm(self, path, recursive=False, **kwargs):
+        parts = _parts(path)
+        if len(parts) == 0:
+            raise _error('cannot delete root')
+        chain = self._walk(parts[:-1])
+        if parts[-1] not in chain[-1].entries:
+            raise _error(f'{path}: file does not exist')
+        if not recursive and chain[-1].child_dir(parts[-1]) is not None:
+            raise _error(f'{path} is a directory, use -r to remove directories')
+        del chain[-1].entries[parts[-1]]
+        self._mutated(chain)
+
+    @locked
+    def files_cp(self, source, dest, **kwargs):
+        ref = self._ref(source)
+        parts = _parts(dest)
+        if len(parts) == 0:
+            raise _error('directory already has entry by that name')
+        chain = self._walk(parts[:-1])
+        if parts[-1] in chain[-1].entries:
+            raise _error('directory already has entry by that name')
+        chain[-1].entries[parts[-1]] = Ref(*ref)
+        self._mutated(chain)
+
+    @locked
+    def files_mv(self, source, dest, **kwargs):
+        self.files_cp(source, dest)
+        self.files_rm(source, recursive=True)
+
+    @locked
+    def files_write(self, path, file, offset=0, create=False, truncate=False,
+                    count=None, **kwargs):
+        data = file.read() if hasattr(file, 'read') else file
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        if count is not None:
+            data = data[:count]
+
+        parts = _parts(path)
+        if len(parts) == 0:
+            raise _error(f'{path} was not a file')
+        chain = self._walk(parts[:-1])
+        existing = chain[-1].entries.get(parts[-1], None)
+        if existing is None and not create:
+            raise _error(f'{path}: file does not exist')
+        if existing is not None and chain[-1].child_dir(parts[-1]) is not None:
+            raise _error(f'{path} was not a file')
+
+        old = b''
+        if existing is not None and not truncate:
+            old = self._read(existing.hash)
+        new = old[:offset] + b'\0' * (offset - len(old)) + data + \
+            old[offset + len(data):]
+        chain[-1].entries[parts[-1]] = self._add_chunks(_read_chunks(io.BytesIO(new)))
+        self._mutated(chain)
+
+    @locked
+    def files_flush(self, path='/'):
+        self.store.flush()
+
+    # ---------- Keys and names ----------
+
+    def _ipfs_repo_path(self):
+        """ Keys are read from the IPFS repo if there is one, so that commits
+        are signed by the same peer as with the daemon. Otherwise an identity
+        is generated and stored like in an IPFS repo """
+        ipfs_path = os.environ.get('IPFS_PATH', None)
+        ipfs_path = Path(ipfs_path) if ipfs_path else Path.home() / '.ipfs'
+        if (ipfs_path / 'config').exists():
+            return ipfs_path
+
+        repo_path = self.store.path / 'identity'
+        if not (repo_path / 'config').exists():
+            from ipvc.signing import generate_private_key, peer_id
+            priv_key = generate_private_key()
+            config = {'Identity': {
+                'PeerID': peer_id(priv_key),
+                'PrivKey': base64.b64encode(priv_key).decode('utf-8')}}
+            (repo_path / 'keystore').mkdir(parents=True, exist_ok=True)
+            with open(repo_path / 'config', 'w') as f:
+                f.write(json.dumps(config))
+        return repo_path
+
+    @locked
+    def repo_stat(self, **kwargs):
+        return {'RepoPath': str(self._ipfs_repo_path())}
+
+    @locked
+    def key_list(self, **kwargs):
+        from ipvc.signing import peer_id
+        repo_path = self._ipfs_repo_path()
+        with open(repo_path / 'config') as f:
+            keys = [{'Name': 'self',
+                     'Id': json.loads(f.read())['Identity']['PeerID']}]
+        keystore_path = repo_path / 'keystore'
+        if keystore_path.exists():
+            for key_path in sorted(keystore_path.iterdir()):
+                if key_path.name.startswith('.'):
+                    continue
+                with open(key_path, 'rb') as f:
+                    keys.append({'Name': key_path.name, 'Id': peer_id(f.read())})
+        return {'Keys': keys}
+
+    @locked
+    def key_gen(self, key_name, type, size=2048, **kwargs):
+        from ipvc.signing import generate_private_key, peer_id
+        key_path = self._ipfs_repo_path() / 'keystore' / key_name
+        if key_name == 'self' or key_path.exists():
+            raise _error(f'key by that name already exists')
+        priv_key = generate_private_key(type, size)
+        key_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(os.open(key_path, os.O_WRONLY | os.O_CREAT, 0o600), 'wb') as f:
+            f.write(priv_key)
+        return {'Name': key_name, 'Id': peer_id(priv_key)}
+
+    def _names(self):
+        try:
+            with open(self.store.path / 'names.json') as f:
+                return json.loads(f.read())
+        except FileNotFoundError:
+            return {}
+
+    def _resolve_name(self, name):
+        names = self._names()
+        if name not in names:
+            raise _error(f'could not resolve name {name}')
+        return names[name]
+
+    @locked
+    def name_publish(self, ipfs_path, key='self', **kwargs):
+        """ Names are only published to a registry in the store, so they can
+        be resolved by other repos on this machine """
+        ipfs_path = f'/ipfs/{self._resolve_ipfs(ipfs_path).hash}'
+        keys = {k['Name']: k['Id'] for k in self.key_list()['Keys']}
+        if key not in keys:
+            raise _error(f'no key named {key} was found')
+        names = self._names()
+        names[keys[key]] = ipfs_path
+        with open(self.store.path / 'names.json', 'w') as f:
+            f.write(json.dumps(names))
+        return {'Name': keys[key], 'Value': ipfs_path}
+
+    @locked
+    def name_resolve(self, name=None, **kwargs):
+        if name is None:
+            name = self.key_list()['Keys'][0]['Id']
+        name = _parts(name)[-1]
+        return {'Path': self._resolve_name(name)}
@@ -0,0 +1,151 @@
+"""
+A local content-addressed cache of files keyed by their IPFS hash, shared by
+all repositories and branches on the machine, so that content that has already
+been checked out once doesn't have to be fetched from IPFS again. The same
+cache is used for other immutable data derived from content, such as diffs
+"""
+import os
+import time
+import shutil
+import sqlite3
+import threading
+from pathlib import Path
+
+# ioctl request number for cloning a file on Linux (btrfs, xfs etc.)
+FICLONE = 0x40049409
+
+
+def clone_file(src, dst):
+    """ Copies `src` to `dst` as a copy-on-write clone (reflink) where the
+    filesystem supports it, and as a plain copy otherwise """
+    try:
+        import fcntl
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        return
+    except (ImportError, OSError):
+        pass
+    shutil.copyfile(src, dst)
+
+
+class ObjectCache:
+    """ Files are stored under `path`/objects, and an sqlite index keeps track
+    of their sizes and when they were last used, so that the least recently
+    used files can be evicted when the total size goes above `max_size` bytes.
+    Objects are written to a temporary file and renamed in place, so several
+    processes can use the same cache
+    """
+    def __init__(self, path, max_size):
+        self.path = Path(path)
+        self.max_size = max_size
+        self._initialized = False
+
+    def _connect(self):
+        if not self._initialized:
+            (self.path / 'objects').mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(str(self.path / 'index.sqlite'), timeout=30)
+        if not self._initialized:
+            with conn:
+                conn.execute(('CREATE TABLE IF NOT EXISTS objects '
+                              '(key TEXT PRIMARY KEY, size INTEGER, last_used REAL)'))
+            self._initialized = True
+        return conn
+
+    def object_path(self, key):
+        return self.path / 'objects' / key[-2:] / key
+
+    def _tmp_path(self, key):
+        return self.object_path(key).parent / \
+            f'.{key}.{os.getpid()}.{threading.get_ident()}.tmp'
+
+    def get(self, key, fs_path):
+        """ Materializes the object for `key` at `fs_path` and returns True,
+        or returns False if it is not in the cache """
+        def _clone(object_path):
+            clone_file(object_path, fs_path)
+            return True
+        return self._get(key, _clone) is not None
+
+    def get_bytes(self, key):
+        """ Returns the object for `key`, or None if it is not in the cache """
+        def _read(object_path):
+            with open(object_path, 'rb') as f:
+                return f.read()
+        return self._get(key, _read)
+
+    def _get(self, key, read):
+        """ Returns `read` called with the path of the object, or None if
+        it's not in the cache """
+        object_path = self.object_path(key)
+        conn = self._connect()
+        try:
+            try:
+                ret = read(object_path)
+            except FileNotFoundError:
+                with conn:
+                    conn.execute('DELETE FROM objects WHERE key = ?', (key,))
+                return None
+
+            with conn:
+                conn.execute('UPDATE objects SET last_used = ? WHERE key = ?',
+                             (time.time(), key))
+            return ret
+        finally:
+            conn.close()
+
+    def put(self, key, fs_path):
+        """ Adds the file at `fs_path` to the cache as `key` """
+        self._put(key, os.stat(fs_path).st_size,
+                  lambda tmp_path: clone_file(fs_path, tmp_path))
+
+    def put_bytes(self, key, data: bytes):
+        """ Adds `data` to the cache as `key` """
+        def _write(tmp_path):
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+        self._put(key, len(data), _write)
+
+    def _put(self, key, size, write):
+        if size > self.max_size:
+            return
+
+        object_path = self.object_path(key)
+        if not object_path.exists():
+            object_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self._tmp_path(key)
+            write(tmp_path)
+            os.replace(tmp_path, object_path)
+
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute('INSERT OR REPLACE INTO objects VALUES (?, ?, ?)',
+                             (key, size, time.time()))
+            self._evict(conn)
+        finally:
+            conn.close()
+
+    def _evict(self, conn):
+        total_size = conn.execute('SELECT SUM(size) FROM objects').fetchone()[0] or 0
+        if total_size <= self.max_size:
+            return
+
+        rows = conn.execute('SELECT key, size FROM objects ORDER BY last_used')
+        evicted = []
+        for key, size in rows:
+            if total_size <= self.max_size:
+                break
+            evicted.append(key)
+            total_size -= size
+
+        with conn:
+            for key in evicted:
+                conn.execute('DELETE FROM objects WHERE key = ?', (key,))
+                try:
+                    os.remove(self.object_path(key))
+                except FileNotFoundError:
+                    pass
+
+    def clear(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+        self._initialized = False
@@ -1,9 +1,13 @@
 import io
+import os
 import sys
 import shutil
+from pathlib import Path
 
 import ipfsapi
-from ipvc.common import CommonAPI, atomic
+from ipvc.common import (
+    CommonAPI, atomic, normalize_sparse_pattern, LATEST_COMMIT_FORMAT)
+from ipvc.dag import DagBuilder
 
 class RepoAPI(CommonAPI):
     def __init__(self, *args, **kwargs):
@@ -47,6 +51,7 @@ class RepoAPI(CommonAPI):
                 self.fs_cwd, 'master', branch_info=f'{ref}/data/bundle/files')
             self.ipfs.files_mkdir(mfs_files, parents=True)
 
+        self.register_repo(self.fs_cwd)
         if name is None:
             self.print('Initializing unnamed repository')
             self.print('You can use `ipvc repo name <name>` to set name at a later time')
@@ -101,8 +106,22 @@ class RepoAPI(CommonAPI):
             self.print_err(f'Unable to move directory to {path2}')
             raise RuntimeError()
 
+        main_root = self.get_repo_main_root(path1)
+        worktrees = self.get_worktrees(path1)[1:]
         self.ipfs.files_cp(self.get_mfs_path(path1), self.get_mfs_path(path2))
         self.ipfs.files_rm(self.get_mfs_path(path1), recursive=True)
+        registry = self.repo_registry
+        registry[str(path2)] = registry.pop(str(path1))
+        self.write_repo_registry(registry)
+        self.invalidate_cache()
+
+        # Keep the links between the repo and its worktrees up to date
+        if main_root != path1:
+            self.set_worktrees(main_root, [
+                path2 if p == path1 else p for p in worktrees])
+        else:
+            for worktree in worktrees:
+                self._set_worktree_of(worktree, path2)
         self.invalidate_cache()
         return True
 
@@ -118,13 +137,161 @@ class RepoAPI(CommonAPI):
                 self.print_err(f'No ipvc repository at {path}')
             raise RuntimeError()
 
+        main_root = self.get_repo_main_root(fs_repo_root)
+        worktrees = self.get_worktrees(fs_repo_root)[1:]
+        if main_root == fs_repo_root and len(worktrees) > 0:
+            self.print_err('Repository has worktrees, remove them first:')
+            self.print_err('\n'.join(str(p) for p in worktrees))
+            raise RuntimeError()
+
         mfs_repo_root = self.get_mfs_path(fs_repo_root)
         h = self.ipfs.files_stat(mfs_repo_root)['Hash']
         self.ipfs.files_rm(mfs_repo_root, recursive=True)
+        self.unregister_repo(fs_repo_root)
+        if main_root != fs_repo_root:
+            self.set_worktrees(
+                main_root, [p for p in worktrees if p != fs_repo_root])
         self.invalidate_cache()
         self.print('Repository successfully removed')
         return True
 
+    def _set_worktree_of(self, fs_worktree_root, fs_main_root):
+        mfs_worktree_of = self.get_mfs_path(
+            fs_worktree_root, repo_info='worktree_of')
+        self.ipfs.files_mkdir(mfs_worktree_of.parent, parents=True)
+        self.ipfs.files_write(
+            mfs_worktree_of, io.BytesIO(str(fs_main_root).encode('utf-8')),
+            create=True, truncate=True)
+        self.register_repo(fs_worktree_root, worktree_of=fs_main_root)
+        self.invalidate_cache(['repo_main_roots'])
+
+    @atomic
+    def worktree(self, path=None, branch=None):
+        """
+        Creates a linked worktree at `path` with `branch` checked out. A
+        worktree shares branches, commits and settings with the repo here,
+        but has its own workspace and stage. Lists the worktrees if no path
+        is given
+        """
+        self.common()
+        if path is None:
+            worktrees = self.get_worktrees(self.fs_repo_root)
+            for worktree in worktrees:
+                self.print(f'{worktree} {self.get_active_branch(worktree)}')
+            return worktrees
+
+        fs_worktree_root = Path(os.path.abspath(path))
+        if self.get_repo_root(fs_worktree_root) is not None:
+            self.print_err(f'There is already a repository at or above {fs_worktree_root}')
+            raise RuntimeError()
+
+        branch = branch or self.active_branch
+        if branch not in self.branches:
+            self.print_err('No branch by that name exists')
+            raise RuntimeError()
+        main_root = self.get_repo_main_root(self.fs_repo_root)
+        self._set_worktree_of(fs_worktree_root, main_root)
+        # Checked once linked, so that the worktrees of the repo are found
+        self.ipvc.branch._check_not_in_other_worktree(fs_worktree_root, branch)
+        self.set_worktrees(
+            main_root, self.get_worktrees(main_root)[1:] + [fs_worktree_root])
+        self.set_active_branch(fs_worktree_root, branch)
+        self._ensure_branch_refs(fs_worktree_root, branch)
+
+        self.print(f'Checking out {branch} to {fs_worktree_root}')
+        fs_worktree_root.mkdir(parents=True, exist_ok=True)
+        fs_cwd = self.fs_cwd
+        self.set_cwd(fs_worktree_root)
+        try:
+            self._load_ref_into_repo(fs_worktree_root, branch, 'workspace')
+        finally:
+            self.set_cwd(fs_cwd)
+        return fs_worktree_root
+
+    @atomic
+    def migrate(self, commit_format=LATEST_COMMIT_FORMAT):
+        """
+        Rewrites the commits of all branches in the repo to `commit_format`,
+        and uses that format for new commits. The rewritten commits are
+        signed with the repo's id. Commits by other authors keep their
+        original author and commit hash under 'migrated_from'
+        """
+        self.common()
+        if commit_format not in range(1, LATEST_COMMIT_FORMAT + 1):
+            self.print_err(f'Unknown commit format {commit_format}')
+            raise RuntimeError()
+        id_peer_keys = self.id_peer_keys(self.repo_id)
+
+        heads = {}
+        for branch in self.branches:
+            mfs_head = self.get_mfs_path(self.fs_repo_root, branch, branch_info='head')
+            heads[branch] = self.ipfs.files_stat(mfs_head)['Hash']
+
+        # Collect the commits of all branches in an order where parents come
+        # before their children, along with the links in their data folders
+        data_links = {}
+        commits = []
+        stack = [(h, False) for h in heads.values()]
+        while len(stack) > 0:
+            commit_hash, visited = stack.pop()
+            if visited:
+                commits.append(commit_hash)
+                continue
+            if commit_hash in data_links:
+                continue
+
+            ls = self.ipfs.ls(f'/ipfs/{commit_hash}/data')['Objects'][0]['Links']
+            links = {link['Name']: (link['Hash'], link['Size']) for link in ls}
+            data_links[commit_hash] = links
+            if 'commit_metadata' not in links:
+                # The root of the graph is an empty commit, and stays as is
+                continue
+            stack.append((commit_hash, True))
+            for name in ['parent', 'merge_parent']:
+                if name in links and links[name][0] not in data_links:
+                    stack.append((links[name][0], False))
+
+        builder = DagBuilder(self.ipfs)
+        new_links = {}
+        for commit_hash in commits:
+            links = data_links[commit_hash]
+            parent_link, merge_parent_link = [
+                None if name not in links else
+                new_links.get(links[name][0], links[name])
+                for name in ['parent', 'merge_parent']]
+            metadata = self.get_commit_metadata(commit_hash)
+            parents_changed = (parent_link != links['parent'] or
+                               merge_parent_link != links.get('merge_parent', None))
+            if (not parents_changed and
+                    metadata.get('format', 1) == commit_format):
+                continue
+
+            author = metadata['author']
+            if author.get('peer_id', None) != id_peer_keys['peer_id']:
+                metadata['migrated_from'] = {'commit': commit_hash, 'author': author}
+                metadata['author'] = {
+                    'peer_id': id_peer_keys['peer_id'],
+                    'public_key': id_peer_keys['pub_key_pem']
+                }
+                if id_peer_keys['key_type'] != 'rsa':
+                    metadata['author']['key_type'] = id_peer_keys['key_type']
+
+            new_links[commit_hash] = self.build_commit(
+                builder, links['bundle'], parent_link, merge_parent_link,
+                metadata, id_peer_keys, commit_format)
+        builder.write()
+
+        for branch, head_hash in heads.items():
+            if head_hash not in new_links:
+                continue
+            mfs_head = self.get_mfs_path(self.fs_repo_root, branch, branch_info='head')
+            self.ipfs.files_rm(mfs_head, recursive=True)
+            self.ipfs.files_cp(f'/ipfs/{new_links[head_hash][0]}', mfs_head)
+
+        self.set_commit_format(self.fs_repo_root, commit_format)
+        self.print(f'Rewrote {len(new_links)} of {len(commits)} commits to format {commit_format}')
+        return {h: new_h for h, (new_h, _) in new_links.items()}
+
     @atomic
     def id(self, key=None):
         """ Get/Set the ID to use for this repo """
@@ -203,7 +370,7 @@ class RepoAPI(CommonAPI):
        pass
 
     @atomic
-    def clone(self, remote, as_name=None):
+    def clone(self, remote, as_name=None, sparse=None):
         if self.fs_repo_root is not None:
             self.print_err('There is already a repo here')
             raise RuntimeError()
@@ -215,7 +382,7 @@ class RepoAPI(CommonAPI):
             raise RuntimeError()
         repo_name = as_name or peer_repo
 
-        if repo_name in self.repos:
+        if repo_name in [entry.get('name', None) for entry in self.repo_registry.values()]:
             self.print_err(f'You already have a local repo by the name {repo_name}')
             self.print_err(('To clone by a different name, supply it with the '
                            'argument --as-name <name>'))
@@ -262,6 +429,7 @@ class RepoAPI(CommonAPI):
             self.ipfs.files_mkdir(mfs_repo_path, parents=True)
         except ipfsapi.exceptions.StatusError:
             pass
+        self.register_repo(self.fs_cwd)
         mfs_repo_branches_path = self.get_mfs_path(self.fs_cwd, repo_info='branches')
         for branch_head in self.ipfs.ls(repo_hash)['Objects'][0]['Links']:
             bname = branch_head['Name']
@@ -282,4 +450,8 @@ class RepoAPI(CommonAPI):
         branch = 'master' if 'master' in self.branches else self.branches[0]
 
         self.set_active_branch(self.fs_repo_root, branch)
+        if sparse:
+            self.set_sparse_patterns(
+                self.fs_repo_root, branch,
+                [normalize_sparse_pattern(p) for p in sparse])
         self._load_ref_into_repo(self.fs_repo_root, branch, 'head')
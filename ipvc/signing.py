@@ -0,0 +1,185 @@
+"""
+Signing and verification of commits with IPFS keys. RSA keys are handled with
+pycrypto and signatures are stored as decimal numbers. Ed25519 keys need the
+optional `cryptography` package, and their signatures are stored base64
+encoded with an 'ed25519:' prefix, so both kinds can be verified side by side
+"""
+import base64
+import hashlib
+
+from ipvc.dag import _varint, b58encode
+
+# pycrypto and the protobuf module are slow to import, and only needed by
+# commands that sign or verify, so they are imported where used
+
+ED25519_PREFIX = 'ed25519:'
+
+
+def _import_ed25519():
+    try:
+        from cryptography.hazmat.primitives import serialization
+        from cryptography.hazmat.primitives.asymmetric import ed25519
+        from cryptography.exceptions import InvalidSignature
+    except ImportError:
+        raise ImportError(
+            'Ed25519 keys require the "cryptography" package, '
+            'install it with `pip install cryptography`')
+    return serialization, ed25519, InvalidSignature
+
+
+class RSASigner:
+    key_type = 'rsa'
+
+    def __init__(self, key_data):
+        from Crypto.PublicKey import RSA
+        self.priv_key_pem = key_data
+        self.priv_key = RSA.importKey(key_data)
+        self.pub_key = self.priv_key.publickey()
+        self.pub_key_pem = self.pub_key.exportKey('PEM').decode('utf-8')
+
+    def sign(self, data: bytes):
+        return str(self.priv_key.sign(data, K='wtf?')[0])
+
+
+class Ed25519Signer:
+    key_type = 'ed25519'
+
+    def __init__(self, key_data):
+        serialization, ed25519, _ = _import_ed25519()
+        # The private key data from IPFS is the 32 byte seed followed by the
+        # public key
+        self.priv_key = ed25519.Ed25519PrivateKey.from_private_bytes(key_data[:32])
+        self.priv_key_pem = self.priv_key.private_bytes(
+            serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption())
+        self.pub_key = self.priv_key.public_key()
+        self.pub_key_pem = self.pub_key.public_bytes(
+            serialization.Encoding.PEM,
+            serialization.PublicFormat.SubjectPublicKeyInfo).decode('utf-8')
+
+    def sign(self, data: bytes):
+        signature = base64.b64encode(self.priv_key.sign(data)).decode('utf-8')
+        return ED25519_PREFIX + signature
+
+
+def verify(public_key_pem: str, data: bytes, signature: str):
+    """ Returns whether `signature`, as stored in a commit, is a valid
+    signature of `data` for the public key """
+    signature = signature.strip()
+    if signature.startswith(ED25519_PREFIX):
+        serialization, ed25519, InvalidSignature = _import_ed25519()
+        pub_key = serialization.load_pem_public_key(public_key_pem.encode('utf-8'))
+        if not isinstance(pub_key, ed25519.Ed25519PublicKey):
+            return False
+        try:
+            pub_key.verify(
+                base64.b64decode(signature[len(ED25519_PREFIX):]), data)
+            return True
+        except (InvalidSignature, ValueError):
+            return False
+
+    from Crypto.PublicKey import RSA
+    try:
+        pub_key = RSA.importKey(public_key_pem)
+        return pub_key.verify(data, (int(signature),))
+    except ValueError:
+        return False
+
+
+def _pem_to_der(public_key_pem: str):
+    lines = public_key_pem.strip().splitlines()
+    return base64.b64decode(''.join(l for l in lines if not l.startswith('-----')))
+
+
+def _public_key_bytes(key_type, data):
+    import crypto_pb2
+    pub_key = crypto_pb2.PublicKey()
+    pub_key.Type = crypto_pb2.Ed25519 if key_type == 'ed25519' else crypto_pb2.RSA
+    pub_key.Data = data
+    return pub_key.SerializeToString()
+
+
+def _sha256_peer_id(pub_key_bytes):
+    return b58encode(b'\x12\x20' + hashlib.sha256(pub_key_bytes).digest())
+
+
+def _identity_peer_id(pub_key_bytes):
+    # Small keys are inlined in the peer id with the identity multihash
+    return b58encode(b'\x00' + _varint(len(pub_key_bytes)) + pub_key_bytes)
+
+
+def peer_id_matches(public_key_pem: str, key_type: str, peer_id: str):
+    """ Returns whether `peer_id` is the IPFS peer id of the public key, i.e.
+    that the key belongs to the peer that is named as the author """
+    der = _pem_to_der(public_key_pem)
+    # The raw Ed25519 key is the last 32 bytes of the SubjectPublicKeyInfo
+    pub_key_bytes = _public_key_bytes(
+        key_type, der[-32:] if key_type == 'ed25519' else der)
+    return peer_id in [_sha256_peer_id(pub_key_bytes),
+                       _identity_peer_id(pub_key_bytes)]
+
+
+def peer_id(priv_key_protobuf: bytes):
+    """ Returns the IPFS peer id of a private key, as stored in the keystore
+    of an IPFS repo """
+    from Crypto.PublicKey import RSA
+    import crypto_pb2
+    priv_key = crypto_pb2.PrivateKey()
+    priv_key.ParseFromString(priv_key_protobuf)
+    if priv_key.Type == crypto_pb2.Ed25519:
+        # The private key data is the seed followed by the public key
+        pub_key_bytes = _public_key_bytes('ed25519', priv_key.Data[32:])
+    else:
+        pub_key_der = RSA.importKey(priv_key.Data).publickey().exportKey('DER')
+        pub_key_bytes = _public_key_bytes('rsa', pub_key_der)
+    # Like libp2p, keys of at most 42 bytes are inlined
+    if len(pub_key_bytes) <= 42:
+        return _identity_peer_id(pub_key_bytes)
+    return _sha256_peer_id(pub_key_bytes)
+
+
+def generate_private_key(key_type='rsa', size=2048):
+    """ Generates a key and returns it serialized like in the keystore of an
+    IPFS repo """
+    from Crypto.PublicKey import RSA
+    import crypto_pb2
+    priv_key = crypto_pb2.PrivateKey()
+    if key_type == 'ed25519':
+        serialization, ed25519, _ = _import_ed25519()
+        key = ed25519.Ed25519PrivateKey.generate()
+        raw = serialization.Encoding.Raw
+        priv_key.Type = crypto_pb2.Ed25519
+        priv_key.Data = (
+            key.private_bytes(raw, serialization.PrivateFormat.Raw,
+                              serialization.NoEncryption()) +
+            key.public_key().public_bytes(raw, serialization.PublicFormat.Raw))
+    else:
+        priv_key.Type = crypto_pb2.RSA
+        priv_key.Data = RSA.generate(size).exportKey('DER')
+    return priv_key.SerializeToString()
+
+
+def verify_commit(author, data_hash, bundle_hash, data_signature, bundle_signature,
+                  legacy_data_hash=None):
+    """ Verifies the signatures of a commit against the author in its
+    metadata, and returns None if they are valid, or else the reason why not.
+    Commits made before commit_metadata was signed along with the data have
+    their data signature checked against `legacy_data_hash` as well """
+    public_key_pem = author.get('public_key', None)
+    if public_key_pem is None or data_signature is None or bundle_signature is None:
+        return 'unsigned commit'
+    key_type = author.get('key_type', 'rsa')
+    try:
+        if not peer_id_matches(public_key_pem, key_type, author.get('peer_id', '')):
+            return 'public key does not belong to the author peer id'
+        data_hashes = [h for h in [data_hash, legacy_data_hash] if h is not None]
+        if not any(verify(public_key_pem, h.encode('utf-8'), data_signature)
+                   for h in data_hashes):
+            return 'invalid data signature'
+        if not verify(public_key_pem, bundle_hash.encode('utf-8'), bundle_signature):
+            return 'invalid bundle signature'
+    except ImportError as e:
+        return str(e)
+    except Exception as e:
+        return f'malformed key or signature: {e}'
+    return None
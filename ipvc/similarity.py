@@ -0,0 +1,75 @@
+"""
+Similarity of files for detecting renames that come with edits. A file is
+described by a set of features, the hashes of its lines, or of its chunks for
+files that are too big to read, and two files are as similar as the Jaccard
+index of their feature sets.
+
+Comparing every added file with every removed file is quadratic, so each set
+is first summarized by a MinHash signature, for which the probability that
+two signatures agree on a value is the Jaccard index of the sets. Signatures
+are cut into bands which are hashed into buckets (locality sensitive hashing),
+and only pairs of files that share a bucket are compared
+"""
+import random
+import hashlib
+from collections import defaultdict
+
+SIGNATURE_SIZE = 32
+# With 16 bands of 2 values, pairs that are 50% similar share a bucket with
+# a probability of 99%, and pairs that are 10% similar with 15%
+BAND_SIZE = 2
+_PRIME = (1 << 61) - 1
+# The hash functions of the signature are fixed so that signatures are stable
+_random = random.Random(0)
+_COEFFICIENTS = [(_random.randrange(1, _PRIME), _random.randrange(_PRIME))
+                 for _ in range(SIGNATURE_SIZE)]
+
+
+def feature_hash(data: bytes):
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), 'big')
+
+
+def line_features(data: bytes):
+    return {feature_hash(line) for line in data.split(b'\n')}
+
+
+def chunk_features(hashes):
+    return {feature_hash(h.encode('utf-8')) for h in hashes}
+
+
+def minhash(features):
+    return tuple(min((a * x + b) % _PRIME for x in features)
+                 for a, b in _COEFFICIENTS)
+
+
+def jaccard(features_a, features_b):
+    union = len(features_a | features_b)
+    return len(features_a & features_b) / union if union > 0 else 1.0
+
+
+def candidate_pairs(signatures_a, signatures_b):
+    """ Returns the pairs of keys (a, b) of signatures that share a band """
+    buckets = defaultdict(list)
+    for key, signature in signatures_a.items():
+        for i in range(0, SIGNATURE_SIZE, BAND_SIZE):
+            buckets[i, signature[i:i + BAND_SIZE]].append(key)
+
+    pairs = set()
+    for key_b, signature in signatures_b.items():
+        for i in range(0, SIGNATURE_SIZE, BAND_SIZE):
+            for key_a in buckets.get((i, signature[i:i + BAND_SIZE]), []):
+                pairs.add((key_a, key_b))
+    return pairs
+
+
+def similar_pairs(features_a, features_b, threshold):
+    """ Takes dicts of feature sets and returns (similarity, key_a, key_b) for
+    pairs that are at least `threshold` similar, most similar first """
+    signatures_a = {k: minhash(f) for k, f in features_a.items() if len(f) > 0}
+    signatures_b = {k: minhash(f) for k, f in features_b.items() if len(f) > 0}
+    pairs = []
+    for key_a, key_b in candidate_pairs(signatures_a, signatures_b):
+        similarity = jaccard(features_a[key_a], features_b[key_b])
+        if similarity >= threshold:
+            pairs.append((similarity, key_a, key_b))
+    return sorted(pairs, key=lambda pair: (-pair[0], pair[1], pair[2]))
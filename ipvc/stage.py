@@ -7,6 +7,7 @@ from datetime import datetime
 
 import ipfsapi
 from ipvc.common import CommonAPI, atomic
+from ipvc.dag import DagBuilder
 
 class StageAPI(CommonAPI):
     def __init__(self, *args, **kwargs):
@@ -140,6 +141,8 @@ class StageAPI(CommonAPI):
                 },
                 'timestamp': datetime.utcnow().isoformat(),
             }
+            if id_peer_keys['key_type'] != 'rsa':
+                commit_metadata['author']['key_type'] = id_peer_keys['key_type']
 
             if merge_parent is not None:
                 # Could be useful, so we don't have to check for 'merge_parent'
@@ -148,51 +151,33 @@ class StageAPI(CommonAPI):
 
         mfs_head = self.get_mfs_path(self.fs_repo_root, self.active_branch, branch_info='head')
         mfs_stage = self.get_mfs_path(self.fs_repo_root, self.active_branch, branch_info='stage')
-        head_hash = self.ipfs.files_stat(mfs_head)['Hash']
-        stage_hash = self.ipfs.files_stat(mfs_stage)['Hash']
-        if head_hash == stage_hash:
-            self.print_err('Nothing to commit')
-            raise RuntimeError
-
-        # Set head to stage
-        try:
-            self.ipfs.files_rm(mfs_head, recursive=True)
-        except ipfsapi.exceptions.StatusError:
-            pass
 
-        self.ipfs.files_cp(mfs_stage, mfs_head)
+        def _link(mfs_path):
+            stat = self.ipfs.files_stat(mfs_path)
+            return stat['Hash'], stat['CumulativeSize']
 
-        # Add parent pointer to previous head
-        self.ipfs.files_cp(f'/ipfs/{head_hash}', f'{mfs_head}/data/parent')
+        head_link = _link(mfs_head)
+        if head_link[0] == self.ipfs.files_stat(mfs_stage)['Hash']:
+            self.print_err('Nothing to commit')
+            raise RuntimeError
 
+        # Assemble the new commit locally and write it as a handful of blocks,
+        # so that MFS only has to update the head pointer once
+        builder = DagBuilder(self.ipfs)
+        merge_parent_link = None
         if merge_parent is not None:
             # Add merge_parent to merged head if this was a merge commit
-            self.ipfs.files_cp(merge_parent, f'{mfs_head}/data/merge_parent')
-
-        # Sign the commit bundle and data hash
-        bundle_hash = self.ipfs.files_stat(f'{mfs_head}/data/bundle')['Hash'].encode('utf-8')
-        data_hash = self.ipfs.files_stat(f'{mfs_head}/data/')['Hash'].encode('utf-8')
-        data_signature = id_peer_keys['rsa_priv_key'].sign(data_hash, K='wtf?')[0]
-        assert id_peer_keys['rsa_pub_key'].verify(data_hash, (data_signature,))
-        bundle_signature = id_peer_keys['rsa_priv_key'].sign(bundle_hash, K='wtf?')[0]
-        assert id_peer_keys['rsa_pub_key'].verify(bundle_hash, (bundle_signature,))
-
-        # Write signed hashes to commit 
-        self.ipfs.files_write(
-            f'{mfs_head}/bundle_signature',
-            io.BytesIO(str(bundle_signature).encode('utf-8')),
-            create=True, truncate=True)
-        self.ipfs.files_write(
-            f'{mfs_head}/data_signature',
-            io.BytesIO(str(data_signature).encode('utf-8')),
-            create=True, truncate=True)
-
-        # Add commit metadata
-        metadata_bytes = io.BytesIO(json.dumps(commit_metadata).encode('utf-8'))
-        self.ipfs.files_write(
-            f'{mfs_head}/data/commit_metadata', metadata_bytes, create=True, truncate=True)
-
-        return self.ipfs.files_stat(mfs_head)['Hash']
+            merge_parent_link = _link(merge_parent)
+        commit_hash, _ = self.build_commit(
+            builder, _link(f'{mfs_stage}/data/bundle'), head_link,
+            merge_parent_link, commit_metadata, id_peer_keys,
+            self.commit_format)
+        builder.write()
+
+        # Point head at the new commit
+        self.ipfs.files_rm(mfs_head, recursive=True)
+        self.ipfs.files_cp(f'/ipfs/{commit_hash}', mfs_head)
+        return commit_hash
 
     @atomic
     def uncommit(self):
@@ -206,5 +191,5 @@ class StageAPI(CommonAPI):
         self.common()
         self._notify_conflict(self.fs_repo_root, self.active_branch)
         changes = self._diff_changes(Path('@stage'), Path('@head'))
-        self.print(self._format_changes(changes, files=False))
+        self._print_diff(changes, files=False)
         return changes
@@ -0,0 +1,188 @@
+"""
+Keyed diffs of tables, such as CSV and TSV files. Rows of the two versions
+are matched by the values of a set of key columns rather than by their
+position, so that a table that was sorted differently is not shown as a
+rewrite, and the cells of matched rows are compared column by column.
+
+Tables can be much bigger than memory, so as the two versions are streamed
+their rows are spread over partition files on disk by the hash of their key
+(hash partitioning). Matching rows end up in the same partition, and the
+partitions are diffed one at a time, with only the old rows of one partition
+in memory. The changes of each partition are sorted by key and written to
+disk, and then merged, so that changes are listed by key
+"""
+import os
+import csv
+import zlib
+import heapq
+import pickle
+import tempfile
+
+# Number of bytes of a table per partition, which bounds the memory use of a
+# diff to about this size times the overhead of the rows as Python objects
+PARTITION_SIZE = 32 * 1024**2
+# Maximum number of partitions, each of which has a file open while rows are
+# partitioned
+MAX_PARTITIONS = 512
+# Delimiters of table files by their extension
+DELIMITERS = {'.csv': ',', '.tsv': '\t', '.tab': '\t'}
+
+
+def num_partitions(size):
+    return min(MAX_PARTITIONS, size // PARTITION_SIZE + 1)
+
+
+def iter_rows(lines, delimiter=','):
+    """ Parses rows from lines of bytes without their newlines, such as the
+    ones of CommonAPI._iter_file_lines. Quoted values can span lines """
+    return csv.reader((line.decode('utf-8', errors='replace') + '\n'
+                       for line in lines), delimiter=delimiter)
+
+
+def _key_indices(header, key_columns, version):
+    missing = [column for column in key_columns if column not in header]
+    if len(missing) > 0:
+        raise ValueError(f'The {version} version has no column '
+                         f'{", ".join(missing)}')
+    return [header.index(column) for column in key_columns]
+
+
+def _keyed_rows(rows, key_indices):
+    for row in rows:
+        yield tuple(row[i] if i < len(row) else '' for i in key_indices), row
+
+
+def _partition_of(key, num_partitions):
+    """ Returns the partition of a key, which is the same in every process,
+    unlike with the built-in hash() """
+    data = '\0'.join(key).encode('utf-8', errors='surrogatepass')
+    return zlib.crc32(data) % num_partitions
+
+
+def _iter_pickled(path):
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+
+
+def _partition(keyed_rows, num_partitions, directory, name):
+    """ Writes (key, row) pairs to a file per partition, and returns iterators
+    over the partitions. A single partition is not written to disk, the rows
+    are then read as they're needed """
+    if num_partitions == 1:
+        return [keyed_rows]
+    paths = [os.path.join(directory, f'{name}{i}') for i in range(num_partitions)]
+    files = [open(path, 'wb') for path in paths]
+    try:
+        for key, row in keyed_rows:
+            pickle.dump((key, row), files[_partition_of(key, num_partitions)])
+    finally:
+        for f in files:
+            f.close()
+    return [_iter_pickled(path) for path in paths]
+
+
+def _format_key(key_columns, key):
+    return ', '.join(f'{column}={value}' for column, value in zip(key_columns, key))
+
+
+def _diff_partition(from_rows, to_rows, columns):
+    """ Returns the changes between the rows of a partition, sorted by key,
+    as (key, sign, row or changed cells) """
+    old = {}
+    for key, row in from_rows:
+        if key in old:
+            raise ValueError(f'The key {key} is not unique in the old version')
+        old[key] = row
+
+    changes, seen = [], set()
+    for key, row in to_rows:
+        if key in seen:
+            raise ValueError(f'The key {key} is not unique in the new version')
+        seen.add(key)
+        old_row = old.pop(key, None)
+        if old_row is None:
+            changes.append((key, '+', row))
+            continue
+        cells = []
+        for column, from_index, to_index in columns:
+            from_value = old_row[from_index] if from_index < len(old_row) else ''
+            to_value = row[to_index] if to_index < len(row) else ''
+            if from_value != to_value:
+                cells.append((column, from_value, to_value))
+        if len(cells) > 0:
+            changes.append((key, '~', cells))
+    changes += [(key, '-', row) for key, row in old.items()]
+    return sorted(changes, key=lambda change: change[0])
+
+
+def _merge_partition_changes(from_partitions, to_partitions, columns, directory):
+    """ Diffs the partitions one at a time, writing the changes of each to
+    disk, and yields all changes in order of key """
+    paths = []
+    for n, (from_partition, to_partition) in enumerate(zip(from_partitions, to_partitions)):
+        paths.append(os.path.join(directory, f'changes{n}'))
+        with open(paths[-1], 'wb') as f:
+            for change in _diff_partition(from_partition, to_partition, columns):
+                pickle.dump(change, f)
+    yield from heapq.merge(*[_iter_pickled(path) for path in paths],
+                           key=lambda change: change[0])
+
+
+def diff_tables(from_lines, to_lines, key_columns, delimiter=',',
+                num_partitions=1, stats=None):
+    """ Yields the lines of a keyed diff of two tables given as lines of
+    bytes, where the first row is the header. Rows with a key that's only in
+    the new version are added (+), only in the old version removed (-), and
+    rows with changed cells in columns of both versions are changed (~). The
+    numbers of rows and cells are counted in `stats` if given. A ValueError is
+    raised if a key column is missing, or if a key isn't unique """
+    stats = stats if stats is not None else {}
+    stats.update(added=0, removed=0, changed=0, cells=0)
+    from_rows = iter_rows(from_lines, delimiter)
+    to_rows = iter_rows(to_lines, delimiter)
+    from_header, to_header = next(from_rows, []), next(to_rows, [])
+    from_key = _key_indices(from_header, key_columns, 'old')
+    to_key = _key_indices(to_header, key_columns, 'new')
+    columns = [(column, from_header.index(column), i)
+               for i, column in enumerate(to_header) if column in from_header]
+
+    for column in from_header:
+        if column not in to_header:
+            yield f'column removed: {column}'
+    for column in to_header:
+        if column not in from_header:
+            yield f'column added: {column}'
+
+    with tempfile.TemporaryDirectory(prefix='ipvc_table_') as directory:
+        from_partitions = _partition(
+            _keyed_rows(from_rows, from_key), num_partitions, directory, 'from')
+        to_partitions = _partition(
+            _keyed_rows(to_rows, to_key), num_partitions, directory, 'to')
+        if num_partitions == 1:
+            changes = _diff_partition(from_partitions[0], to_partitions[0], columns)
+        else:
+            changes = _merge_partition_changes(
+                from_partitions, to_partitions, columns, directory)
+        for key, sign, value in changes:
+            key = _format_key(key_columns, key)
+            if sign == '~':
+                stats['changed'] += 1
+                stats['cells'] += len(value)
+                cells = '; '.join(f'{column}: {from_value!r} -> {to_value!r}'
+                                  for column, from_value, to_value in value)
+                yield f'~ {key}: {cells}'
+            else:
+                stats['added' if sign == '+' else 'removed'] += 1
+                yield f'{sign} {key}: {delimiter.join(value)}'
+
+
+def format_summary(key_columns, stats):
+    def _count(num, noun):
+        return f'{num} {noun}{"s" if num != 1 else ""}'
+    return (f'rows by {", ".join(key_columns)}: {stats["added"]} added, '
+            f'{stats["removed"]} removed, {stats["changed"]} changed '
+            f'({_count(stats["cells"], "cell")})')
@@ -9,9 +9,14 @@ import cProfile, pstats, io
 NAMESPACE = Path('/test')
 REPO = Path('/tmp/ipvc/repo')
 REPO2 = Path('/tmp/ipvc/repo2')
+CACHE = Path('/tmp/ipvc_cache')
+# Tests run on the local store unless IPVC_TEST_BACKEND=daemon
+BACKEND = os.environ.get('IPVC_TEST_BACKEND', 'local')
+STORE = Path('/tmp/ipvc_store')
 
 def get_environment(path=REPO, mkdirs=True):
-    ipvc = IPVC(path, NAMESPACE, delete_mfs=True)
+    ipvc = IPVC(path, NAMESPACE, delete_mfs=True, cache_dir=CACHE,
+                backend=BACKEND, store_dir=STORE)
 
     try:
         shutil.rmtree('/tmp/ipvc')
@@ -0,0 +1,51 @@
+import json
+import asyncio
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+import ipfsapi
+
+from ipvc.aioipfs import AsyncIPFSClient
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """ Answers every command like `files stat` would, and fails for paths
+    containing 'missing' """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if 'missing' in self.path:
+            code, body = 500, {'Message': 'file does not exist', 'Code': 0}
+        else:
+            code, body = 200, {'Hash': 'QmHash', 'Path': self.path}
+        body = json.dumps(body).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def test_concurrent_requests():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    client = AsyncIPFSClient('127.0.0.1', server.server_address[1],
+                             max_connections=4)
+
+    async def _run():
+        stats = await asyncio.gather(*[
+            client.files_stat(f'/some dir/{i}') for i in range(20)])
+        assert stats[3]['Path'] == '/api/v0/files/stat?stream-channels=true&arg=%2Fsome%20dir%2F3'
+        # Connections are kept for reuse
+        assert len(client._idle) == 4
+
+        with pytest.raises(ipfsapi.exceptions.StatusError):
+            await client.files_stat('/missing')
+        await client.close()
+
+    asyncio.run(_run())
+    server.shutdown()
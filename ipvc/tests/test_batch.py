@@ -0,0 +1,58 @@
+import io
+import json
+
+from ipvc.cli import run_batch
+from helpers import REPO, get_environment, write_file
+
+SCRIPT = '''
+repo init
+# comments and blank lines are skipped
+
+stage add
+stage commit -m "first commit"
+branch create feature
+branch ls
+stage commit -m "nothing to commit"
+branch nosuchcommand
+stage add /nonexistent
+-c /tmp stage status
+'''
+
+
+def test_batch():
+    ipvc = get_environment()
+    write_file(REPO / 'test_file.txt', 'hello world')
+    out = io.StringIO()
+    num_failed = run_batch(ipvc, io.StringIO(SCRIPT), REPO, out)
+    results = [json.loads(line) for line in out.getvalue().splitlines()]
+
+    assert num_failed == 4
+    assert [r['ok'] for r in results] == [True] * 5 + [False] * 4
+    assert [r['line'] for r in results] == [2, 5, 6, 7, 8, 9, 10, 11, 12]
+    assert results[0]['command'] == 'repo init'
+    assert results[0]['error'] is None
+    assert results[1]['result'][0]['Type'] == 0
+    assert results[4]['result'] == ['feature', 'master']
+    # Unexpected exceptions are reported, and later commands still run
+    assert results[7]['error'].startswith('ValueError: ')
+    assert 'No ipvc repository here' in results[8]['stderr']
+
+    # Commands after a failure are not run with stop_on_error
+    out = io.StringIO()
+    run_batch(ipvc, io.StringIO('branch nosuchcommand\nbranch ls'), REPO, out,
+              stop_on_error=True)
+    assert len(out.getvalue().splitlines()) == 1
+
+
+def test_unchanged_workspace():
+    ipvc = get_environment()
+    ipvc.repo.init()
+    write_file(REPO / 'test_file.txt', 'hello world')
+    ipvc.stage.status()
+
+    # Nothing is written to MFS when the workspace hasn't changed, except
+    # for the snapshots taken by the two atomic calls
+    mutations = ipvc.mfs_mutation_count
+    ipvc.stage.status()
+    ipvc.branch.status()
+    assert ipvc.mfs_mutation_count - mutations == 2
@@ -1,10 +1,12 @@
 import os
+import json
 import pytest
 import time
 from pathlib import Path
 
 from ipvc import IPVC
-from helpers import NAMESPACE, REPO, REPO2, get_environment, write_file, Profile
+from ipvc.dag import DagBuilder
+from helpers import NAMESPACE, REPO, REPO2, CACHE, get_environment, write_file, Profile
 
 
 def assert_list_equals(l1, l2):
@@ -122,6 +124,125 @@ def test_merge_replay():
     ipvc.print_ipfs_profile_info()
 
 
+@pytest.mark.parametrize('merge_type', ['merge', 'replay'])
+def test_merge_renames(merge_type):
+    ipvc = get_environment()
+    ipvc.repo.init()
+    lines = [f'line{i}' for i in range(10)]
+    write_file(REPO / 'edited.txt', '\n'.join(lines) + '\n')
+    write_file(REPO / 'moved.txt', 'moved\n')
+    ipvc.stage.add()
+    ipvc.stage.commit('msg1')
+    ipvc.branch.create('other', no_checkout=True)
+
+    # Rename both files in master, one with an edit
+    os.mkdir(REPO / 'dir')
+    os.rename(REPO / 'moved.txt', REPO / 'dir' / 'moved.txt')
+    os.remove(REPO / 'edited.txt')
+    write_file(REPO / 'renamed.txt', '\n'.join(lines + ['appended']) + '\n')
+    ipvc.stage.add()
+    ipvc.stage.commit('msg2')
+
+    # Edit the renamed file in other
+    ipvc.branch.checkout('other')
+    time.sleep(1) # resolution of modification timestamp is a second
+    write_file(REPO / 'edited.txt', '\n'.join(['prepended'] + lines) + '\n')
+    ipvc.stage.add()
+    ipvc.stage.commit('msg2other')
+
+    # When merging, they renamed the file that we edited, and when replaying
+    # our edit onto their branch, we edited the file that they renamed
+    if merge_type == 'merge':
+        pulled_files, merged_files, conflict_files = ipvc.branch.merge(
+            'master', message='merge')
+        assert pulled_files == {'dir/moved.txt'}
+    else:
+        _, merged_files, conflict_files = ipvc.branch.replay('master')
+    assert conflict_files == set()
+    assert merged_files == {'renamed.txt'}
+    assert not (REPO / 'edited.txt').exists()
+    assert not (REPO / 'moved.txt').exists()
+    assert open(REPO / 'dir' / 'moved.txt').read() == 'moved\n'
+    assert open(REPO / 'renamed.txt').read().splitlines() == (
+        ['prepended'] + lines + ['appended'])
+    head_stage, stage_workspace = ipvc.stage.status()
+    assert len(head_stage) == 0 and len(stage_workspace) == 0
+
+
+def test_merge_binary():
+    ipvc = get_environment()
+    ipvc.repo.init()
+    with open(REPO / 'binary', 'wb') as f:
+        f.write(b'\0base')
+    ipvc.stage.add()
+    ipvc.stage.commit('msg1')
+    ipvc.branch.create('other', no_checkout=True)
+
+    with open(REPO / 'binary', 'wb') as f:
+        f.write(b'\0theirs')
+    ipvc.stage.add()
+    ipvc.stage.commit('msg2')
+
+    ipvc.branch.checkout('other')
+    time.sleep(1) # resolution of modification timestamp is a second
+    with open(REPO / 'binary', 'wb') as f:
+        f.write(b'\0ours')
+    ipvc.stage.add()
+    ipvc.stage.commit('msg2other')
+
+    # Binary files aren't merged line by line, their version is put next to ours
+    _, _, conflict_files = ipvc.branch.merge('master')
+    assert conflict_files == {'binary'}
+    assert open(REPO / 'binary', 'rb').read() == b'\0ours'
+    assert open(REPO / 'binary.theirs', 'rb').read() == b'\0theirs'
+    with pytest.raises(RuntimeError):
+        ipvc.branch.merge(resolve='msg')
+
+    os.replace(REPO / 'binary.theirs', REPO / 'binary')
+    ipvc.branch.merge(resolve='msg')
+    assert ipvc.branch.history()[0][-1] is not None
+    assert ipvc.stage.status() == ([], [])
+
+
+def test_merge_sparse():
+    ipvc = get_environment()
+    ipvc.repo.init()
+    (REPO / 'data').mkdir()
+    (REPO / 'src').mkdir()
+    write_file(REPO / 'data' / 'a.bin', 'a')
+    write_file(REPO / 'data' / 'b.bin', 'b')
+    write_file(REPO / 'data' / 'c.txt', 'c1\nc2\nc3\n')
+    write_file(REPO / 'src' / 'code.py', 'code')
+    ipvc.stage.add()
+    ipvc.stage.commit('msg1')
+    ipvc.branch.create('other', no_checkout=True)
+
+    # Their branch removes and changes files outside of our checkout
+    os.remove(REPO / 'data' / 'a.bin')
+    write_file(REPO / 'data' / 'b.bin', 'b2')
+    write_file(REPO / 'data' / 'c.txt', 'c1\nmaster\nc2\nc3\n')
+    ipvc.stage.add()
+    ipvc.stage.commit('msg2')
+
+    # Both branches change a file that ends up outside of our checkout
+    ipvc.branch.checkout('other')
+    write_file(REPO / 'data' / 'c.txt', 'c1\nc2\nc3\nother\n')
+    ipvc.stage.add()
+    ipvc.stage.commit('msg1other')
+    ipvc.branch.sparse(['src'])
+    write_file(REPO / 'src' / 'code2.py', 'code2')
+    ipvc.stage.add()
+    ipvc.stage.commit('msg2other')
+
+    ipvc.branch.merge('master', message='merge')
+    assert not (REPO / 'data').exists()
+    with pytest.raises(RuntimeError):
+        ipvc.branch.show(Path('@head/data/a.bin'))
+    assert ipvc.branch.show(Path('@head/data/b.bin')) == 'b2'
+    assert ipvc.branch.show(Path('@head/data/c.txt')) == 'c1\nmaster\nc2\nc3\nother\n'
+    assert ipvc.stage.status() == ([], [])
+
+
 def test_create_and_checkout():
     ipvc = get_environment()
     ipvc.repo.init()
@@ -173,6 +294,96 @@ def test_create_and_checkout():
     ipvc.print_ipfs_profile_info()
 
 
+def test_checkout_only_changed_files():
+    ipvc = get_environment()
+    ipvc.repo.init()
+
+    write_file(REPO / 'unchanged.txt', 'hello world')
+    ipvc.stage.add()
+    ipvc.stage.commit('msg1')
+
+    ipvc.branch.create('develop')
+    time.sleep(1) # resolution of modification timestamp is a second
+    (REPO / 'subdir').mkdir()
+    write_file(REPO / 'subdir' / 'new_file.txt', 'new')
+    write_file(REPO / 'unchanged.txt', 'hello world')
+    t1 = (REPO / 'unchanged.txt').stat().st_mtime_ns
+
+    ipvc.branch.checkout('master')
+    # The directory is removed with its last file
+    assert not (REPO / 'subdir').exists()
+    # Same content, so only the timestamp of the file should have changed
+    assert (REPO / 'unchanged.txt').stat().st_mtime_ns != t1
+
+    ipvc.branch.checkout('develop')
+    assert open(REPO / 'subdir' / 'new_file.txt', 'r').read() == 'new'
+    assert (REPO / 'unchanged.txt').stat().st_mtime_ns == t1
+    head_stage, stage_workspace = ipvc.stage.status()
+    assert len(head_stage) == 0 and len(stage_workspace) == 1
+
+
+def test_checkout_chunked():
+    ipvc = get_environment()
+    ipvc.repo.init()
+    ipvc.buffer_size = 7 # read a few bytes at a time
+
+    content = ''.join(f'line{i}\n' for i in range(100))
+    write_file(REPO / 'test_file.txt', content)
+    ipvc.stage.add()
+    ipvc.stage.commit('msg1')
+
+    ipvc.branch.create('develop')
+    write_file(REPO / 'test_file.txt', 'other content')
+    ipvc.branch.checkout('master')
+    assert open(REPO / 'test_file.txt', 'r').read() == content
+
+    # Leave a partially written file behind, and check that it is resumed
+    ipvc.object_cache = None
+    mfs_path = ipvc.branch.get_mfs_path(
+        REPO, 'master', branch_info='workspace/data/bundle/files/test_file.txt')
+    h = ipvc.ipfs.files_stat(mfs_path)['Hash']
+    partial_path = REPO / f'.resumed.txt.{h}.ipvc_partial'
+    write_file(partial_path, content[:50])
+    ipvc.branch._materialize_file(mfs_path, REPO / 'resumed.txt')
+    assert open(REPO / 'resumed.txt', 'r').read() == content
+    assert not partial_path.exists()
+
+
+def test_sparse_checkout():
+    ipvc = get_environment()
+    ipvc.repo.init()
+
+    (REPO / 'data').mkdir()
+    (REPO / 'src').mkdir()
+    write_file(REPO / 'data' / 'big_file.bin', 'big data')
+    write_file(REPO / 'src' / 'code.py', 'print("hello")')
+    ipvc.stage.add()
+    ipvc.stage.commit('msg1')
+
+    assert ipvc.branch.sparse() == []
+    ipvc.branch.sparse(['src'])
+    with pytest.raises(FileNotFoundError):
+        (REPO / 'data' / 'big_file.bin').stat()
+
+    # Files outside of the checkout are still in the branch
+    head_stage, stage_workspace = ipvc.stage.status()
+    assert len(head_stage) == 0 and len(stage_workspace) == 0
+    assert ipvc.branch.show(Path('@workspace/data/big_file.bin')) == 'big data'
+
+    write_file(REPO / 'src' / 'code2.py', 'print("hello2")')
+    head_stage, stage_workspace = ipvc.stage.status()
+    assert len(head_stage) == 0 and len(stage_workspace) == 1
+
+    # A new branch inherits the patterns, master keeps them after checkout
+    ipvc.branch.create('develop')
+    ipvc.branch.sparse(clear=True)
+    assert open(REPO / 'data' / 'big_file.bin', 'r').read() == 'big data'
+    ipvc.branch.checkout('master')
+    with pytest.raises(FileNotFoundError):
+        (REPO / 'data' / 'big_file.bin').stat()
+    assert (REPO / 'src' / 'code2.py').exists()
+
+
 def test_create_from():
     ipvc = get_environment()
     ipvc.repo.init()
@@ -231,3 +442,68 @@ def test_history():
     assert ipvc.branch.show(Path('@head/test_file.txt')) == 'hello world'
 
     ipvc.print_ipfs_profile_info()
+
+
+def test_verify():
+    ipvc = get_environment()
+    (CACHE / 'verified_commits').unlink(missing_ok=True)
+    ipvc.repo.init()
+
+    for i in range(3):
+        write_file(REPO / 'test_file.txt', f'hello world {i}')
+        ipvc.stage.add()
+        ipvc.stage.commit(f'commit {i}')
+
+    assert len(ipvc.branch.verify(since='@head~')) == 1
+    assert len(ipvc.branch.verify()) == 3
+    # Verified commits are cached
+    assert len(ipvc.branch.verify()) == 0
+
+    write_file(REPO / 'test_file.txt', 'hello world 3')
+    ipvc.stage.add()
+    ipvc.stage.commit('commit 3')
+    assert len(ipvc.branch.verify()) == 1
+
+    # Tamper with the commit message, keeping the original signatures
+    mfs_metadata = ipvc.repo.get_mfs_path(
+        REPO, 'master', branch_info='head/data/commit_metadata')
+    metadata = ipvc.repo.mfs_read_json(mfs_metadata)
+    metadata['message'] = 'something else'
+    ipvc.repo.mfs_write_json(metadata, mfs_metadata)
+    with pytest.raises(RuntimeError):
+        ipvc.branch.verify()
+
+
+def test_verify_legacy():
+    ipvc = get_environment()
+    (CACHE / 'verified_commits').unlink(missing_ok=True)
+    ipvc.repo.init()
+    write_file(REPO / 'test_file.txt', 'hello world')
+    ipvc.stage.add()
+    ipvc.stage.commit('commit 0')
+
+    # Rebuild the commit the way it used to be made, where the data folder
+    # was signed before commit_metadata was written to it
+    ipfs = ipvc.repo.ipfs
+    mfs_head = ipvc.repo.get_mfs_path(REPO, 'master', branch_info='head')
+    head_hash = ipfs.files_stat(mfs_head)['Hash']
+    def _link(path):
+        stat = ipfs.files_stat(f'/ipfs/{head_hash}/{path}')
+        return stat['Hash'], stat['CumulativeSize']
+
+    signer = ipvc.repo.id_peer_keys(ipvc.repo.repo_id)['signer']
+    metadata = ipvc.repo.get_commit_metadata(head_hash)
+    assert 'format' not in metadata
+    builder = DagBuilder(ipfs)
+    data_entries = {'bundle': _link('data/bundle'), 'parent': _link('data/parent')}
+    data_signature = signer.sign(builder.directory(data_entries)[0].encode('utf-8'))
+    data_entries['commit_metadata'] = builder.file(json.dumps(metadata).encode('utf-8'))
+    commit_hash, _ = builder.directory({
+        'data': builder.directory(data_entries),
+        'bundle_signature': _link('bundle_signature'),
+        'data_signature': builder.file(data_signature.encode('utf-8')),
+    })
+    builder.write()
+    ipfs.files_rm(mfs_head, recursive=True)
+    ipfs.files_cp(f'/ipfs/{commit_hash}', mfs_head)
+    assert ipvc.branch.verify() == [commit_hash]
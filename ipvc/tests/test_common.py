@@ -1,8 +1,27 @@
 from ipvc import IPVC
-from helpers import NAMESPACE, REPO, REPO2, get_environment, write_file
+from helpers import (
+    NAMESPACE, REPO, REPO2, CACHE, BACKEND, STORE, get_environment, write_file)
 
 #from common import *
 #
 #def test_refs():
     #assert separate_refpath('head~~/test/file') == 'head~~', 'test/file'
 
+
+
+def test_persisted_property_cache():
+    ipvc = get_environment()
+    ipvc.repo.init()
+    assert ipvc.branch.ls() == ['master']
+
+    # A new instance reuses the properties of the last one, without reading
+    # them from MFS
+    ipvc2 = IPVC(REPO, NAMESPACE, cache_dir=CACHE, backend=BACKEND, store_dir=STORE)
+    assert ipvc2.branch.ls() == ['master']
+    assert ipvc2.tracer.call_counts['files_ls'] == 0
+    assert ipvc2.tracer.call_counts['files_read'] == 0
+
+    # They are not used after MFS has changed
+    ipvc.branch.create('other', no_checkout=True)
+    ipvc3 = IPVC(REPO, NAMESPACE, cache_dir=CACHE, backend=BACKEND, store_dir=STORE)
+    assert ipvc3.branch.ls() == ['master', 'other']
@@ -0,0 +1,17 @@
+from ipvc.dag import b58decode, b58encode, directory_node, file_node
+
+
+def test_known_hashes():
+    # Hashes as produced by `ipfs add` and `ipfs object new unixfs-dir`
+    assert directory_node([]).hash == 'QmUNLLsPACCz1vLxQVkXqqLX5R1X345qqfHbsf67hvA3Nn'
+    assert file_node(b'').hash == 'QmbFMke1KXqnYyBBWxB74N4c5SBnJMVAiMNRcGu6x1AwQH'
+    assert file_node(b'hello world\n').hash == 'QmT78zSuBmuS4z925WZfrqQ1qHaJ56DQaTfyMUF7F8ff5o'
+
+
+def test_directory_links():
+    h = file_node(b'hello world\n').hash
+    assert b58encode(b58decode(h)) == h
+    node1 = directory_node([('b', h, 20), ('a', h, 20)])
+    node2 = directory_node([('a', h, 20), ('b', h, 20)])
+    assert node1.hash == node2.hash
+    assert node1.cumulative_size == len(node1.block) + 40
@@ -1,8 +1,10 @@
 import os
 import time
+import difflib
 import pytest
 
 from ipvc import IPVC
+from ipvc.common import DIFF_PREFETCH, DIFF_TEXT_SIZE
 from helpers import NAMESPACE, REPO, REPO2, get_environment, write_file
 
 
@@ -30,3 +32,211 @@ def test_stage_diff():
 
     diff = ipvc.diff.run(files=True)
     assert len(diff) == 0
+
+
+def test_renames():
+    ipvc = get_environment()
+    ipvc.repo.init()
+    lines = [f'line {i}' for i in range(20)]
+    write_file(REPO / 'edited.txt', '\n'.join(lines))
+    write_file(REPO / 'moved.txt', 'moved')
+    write_file(REPO / 'kept.txt', 'kept')
+    ipvc.stage.add()
+    ipvc.stage.commit('msg')
+
+    os.remove(REPO / 'edited.txt')
+    os.remove(REPO / 'moved.txt')
+    os.mkdir(REPO / 'dir')
+    write_file(REPO / 'dir' / 'renamed.txt',
+               '\n'.join(lines[:10] + ['changed'] + lines[11:]))
+    write_file(REPO / 'dir' / 'moved.txt', 'moved')
+    write_file(REPO / 'copy.txt', 'kept')
+    ipvc.stage.add()
+
+    ipvc.tracer.enabled = True
+    out = ipvc.diff._format_changes(ipvc.stage.diff()).split('\n')
+    assert 'rename moved.txt -> dir/moved.txt (100%)' in out
+    assert 'rename edited.txt -> dir/renamed.txt (90%)' in out
+    assert '--- edited.txt' in out and '+line 9' not in out
+    assert '-line 10' in out and '+changed' in out
+    # The moved file is paired by hash, so it's never read
+    moved_hash = ipvc.ipfs.add_bytes(b'moved')
+    assert not any(e['name'] == 'cat' and moved_hash in e['args']['path']
+                   for e in ipvc.tracer.events)
+
+    # Copies are only found from removed or modified files
+    out = ipvc.diff._format_changes(ipvc.stage.diff(), files=True)
+    assert 'R moved.txt -> dir/moved.txt' in out
+    assert '+ copy.txt' in out
+
+
+def test_streamed_diff(capsys):
+    ipvc = get_environment()
+    ipvc.repo.init()
+    for i in range(4 * DIFF_PREFETCH):
+        write_file(REPO / f'file{i:02}.txt', f'file {i}\nline\n')
+    ipvc.stage.add()
+    changes = ipvc.stage.diff()
+
+    # Lines are produced as each file is diffed, with a bounded number of
+    # files fetched ahead
+    ipvc.tracer.reset()
+    lines = ipvc.stage._iter_diff_lines(changes)
+    assert next(lines) == '--- /dev/null'
+    assert ipvc.tracer.call_counts['cat'] <= DIFF_PREFETCH + 1
+    lines.close()
+
+    capsys.readouterr()
+    ipvc.stage.diff()
+    out = capsys.readouterr().out.splitlines()
+    assert out.count('+line') == 4 * DIFF_PREFETCH
+    assert out[-3:] == ['@@ -0,0 +1,2 @@', f'+file {4 * DIFF_PREFETCH - 1}', '+line']
+
+
+def test_binary_and_large_files(monkeypatch):
+    ipvc = get_environment()
+    ipvc.repo.init()
+    with open(REPO / 'binary', 'wb') as f:
+        f.write(bytes(range(256)))
+    lines = [f'line {i}' for i in range(DIFF_TEXT_SIZE // 8)]
+    write_file(REPO / 'large.txt', '\n'.join(lines) + '\n')
+    ipvc.stage.add()
+    ipvc.stage.commit('msg')
+
+    with open(REPO / 'binary', 'wb') as f:
+        f.write(bytes(range(128)))
+    lines[10] = 'changed'
+    lines.insert(1000, 'inserted')
+    del lines[-1]
+    write_file(REPO / 'large.txt', '\n'.join(lines) + '\n')
+    ipvc.stage.add()
+
+    changes = {c['Path']: c for c in ipvc.stage.diff()}
+    out = ipvc.stage._change_diff(changes['binary'])
+    assert out == ['Binary files binary and binary differ (size 256 -> 128)']
+
+    # Large files are diffed by line hashes, with the same result as difflib
+    ipvc.tracer.reset()
+    out = ipvc.stage._change_diff(changes['large.txt'])
+    assert ipvc.tracer.call_counts['cat'] == 0
+    from_lines, to_lines = [
+        ipvc.ipfs.cat(changes['large.txt'][side]['/']).decode('utf-8').splitlines()
+        for side in ['Before', 'After']]
+    assert out == list(difflib.unified_diff(
+        from_lines, to_lines, lineterm='', fromfile='large.txt', tofile='large.txt'))
+
+    monkeypatch.setattr('ipvc.common.DIFF_MAX_LINES', 10)
+    out = ipvc.stage._change_diff(changes['large.txt'])
+    assert out[-1] == '... 22 more lines of diff not shown'
+
+    # Files with too many changes to diff only get a summary
+    monkeypatch.setattr('ipvc.linediff.MAX_DIFF_WORK', 0)
+    out = ipvc.stage._change_diff(changes['large.txt'])
+    assert out[-1].endswith('too many changes to diff')
+
+
+def test_diff_cache():
+    ipvc = get_environment()
+    ipvc.repo.init()
+    write_file(REPO / 'test_file.txt', 'hello world')
+    ipvc.stage.add()
+    ipvc.stage.commit('msg')
+    write_file(REPO / 'test_file.txt', 'hello world 2')
+    ipvc.stage.add()
+    changes = ipvc.stage.diff()
+
+    # The diff is in the cache, so the files are not read again
+    ipvc.tracer.reset()
+    out = ipvc.stage._format_changes(changes)
+    assert '+hello world 2' in out.split('\n')
+    assert ipvc.tracer.call_counts['cat'] == 0
+    assert ipvc.tracer.call_counts['files_read'] == 0
+
+
+def test_diff_stat(monkeypatch):
+    ipvc = get_environment()
+    ipvc.repo.init()
+    write_file(REPO / 'a.txt', 'one\ntwo\nthree\n')
+    os.mkdir(REPO / 'old')
+    write_file(REPO / 'old' / 'b.txt', 'b' * 999 + '\n')
+    ipvc.stage.add()
+    ipvc.stage.commit('msg')
+
+    write_file(REPO / 'a.txt', 'one\n2\nthree\nfour\n')
+    os.remove(REPO / 'old' / 'b.txt')
+    os.rmdir(REPO / 'old')
+    os.makedirs(REPO / 'new' / 'sub')
+    write_file(REPO / 'new' / 'sub' / 'c.txt', 'c' * 9 + '\n' + 'c' * 9 + '\n')
+    with open(REPO / 'new' / 'binary', 'wb') as f:
+        f.write(bytes(range(256)))
+
+    stats = {s['path']: s for s in ipvc.diff.run(stat=True)}
+    assert set(stats) == {'a.txt', 'old/b.txt', 'new/sub/c.txt', 'new/binary'}
+    assert (stats['a.txt']['added'], stats['a.txt']['removed']) == (2, 1)
+    assert (stats['old/b.txt']['added'], stats['old/b.txt']['removed']) == (0, 1)
+    assert (stats['new/sub/c.txt']['added'], stats['new/sub/c.txt']['removed']) == (2, 0)
+    assert stats['new/binary']['added'] is None
+    assert stats['new/binary']['to_size'] == 256
+
+    out = ipvc.diff._format_stat(list(stats.values()))
+    assert ' new/binary    | Bin 0 -> 256 bytes' in out
+    assert ' a.txt         | 3 ++-' in out
+    assert out.endswith(' 4 files changed, 4 insertions(+), 2 deletions(-)')
+    out = ipvc.diff._format_numstat(list(stats.values()))
+    assert '-\t-\tnew/binary' in out.split('\n')
+    assert '2\t1\ta.txt' in out.split('\n')
+
+    # Added and removed directories are counted without listing them
+    ipvc.tracer.reset()
+    dir_stats = ipvc.diff.run(dirstat=True)
+    assert ipvc.tracer.call_counts['files_ls'] == 0
+    assert dir_stats['dirs']['old'] >= 1000
+    assert dir_stats['dirs']['new'] > 256 + 20
+    assert 'new/sub' not in dir_stats['dirs']
+    assert dir_stats['total'] == (dir_stats['dirs']['old'] + dir_stats['dirs']['new']
+                                  + len('two\n') + len('2\n') + len('four\n'))
+
+    # Big files are counted in other processes, with the same result
+    ipvc.diff_cache = None
+    monkeypatch.setattr('ipvc.diff.STAT_PROCESS_MIN_SIZE', 0)
+    assert {s['path']: s for s in ipvc.diff.run(stat=True)} == stats
+
+    # Files renamed without changes aren't read
+    ipvc.stage.add()
+    ipvc.stage.commit('msg2')
+    os.rename(REPO / 'a.txt', REPO / 'b.txt')
+    changes = ipvc.diff.run(files=True)
+    ipvc.tracer.reset()
+    stats = ipvc.diff._file_stats(changes)
+    assert ipvc.tracer.call_counts['files_read'] == 0
+    assert [(s['path'], s['added'], s['removed']) for s in stats] == [
+        ('a.txt -> b.txt', 0, 0)]
+
+
+
+def test_table_diff(capsys, monkeypatch):
+    ipvc = get_environment()
+    ipvc.repo.init()
+    rows = [f'{i},name {i}' for i in range(100)]
+    write_file(REPO / 'data.csv', '\n'.join(['id,name'] + rows) + '\n')
+    write_file(REPO / 'other.txt', 'a\n')
+    ipvc.stage.add()
+    ipvc.stage.commit('msg')
+
+    rows[3] = '3,changed'
+    write_file(REPO / 'data.csv', '\n'.join(['id,name'] + rows[::-1]) + '\n')
+    write_file(REPO / 'other.txt', 'b\n')
+    # Keep the partitions small so that they're written to disk
+    monkeypatch.setattr('ipvc.tabular.PARTITION_SIZE', 100)
+    capsys.readouterr()
+    ipvc.diff.run(key='id')
+    out = capsys.readouterr().out.split('\n')
+    assert out[:4] == [
+        '--- data.csv', '+++ data.csv',
+        'rows by id: 0 added, 0 removed, 1 changed (1 cell)',
+        "~ id=3: name: 'name 3' -> 'changed'"]
+    assert '+b' in out
+
+    write_file(REPO / 'data.csv', 'name\nx\n')
+    with pytest.raises(RuntimeError):
+        ipvc.diff.run(key='id')
@@ -0,0 +1,49 @@
+import random
+import difflib
+
+from ipvc.linediff import matching_blocks, opcodes, grouped_opcodes
+
+
+def _apply(a, b, codes):
+    out = []
+    for tag, i1, i2, j1, j2 in codes:
+        if tag == 'equal':
+            assert a[i1:i2] == b[j1:j2]
+            out += a[i1:i2]
+        else:
+            out += b[j1:j2]
+    return out
+
+
+def test_matching_blocks():
+    r = random.Random(0)
+    for _ in range(500):
+        a = [r.randrange(4) for _ in range(r.randrange(20))]
+        b = [r.randrange(4) for _ in range(r.randrange(20))]
+        assert _apply(a, b, opcodes(matching_blocks(a, b))) == b
+
+    # Scattered changes in a long file are found without comparing every line
+    a = list(range(100000))
+    b = list(a)
+    for i in r.sample(range(len(a)), 20):
+        b[i] = -1
+    del b[500:510]
+    blocks = matching_blocks(a, b, budget=1000)
+    assert blocks is not None
+    assert _apply(a, b, opcodes(blocks)) == b
+    assert sum(size for _, _, size in blocks) >= len(b) - 20
+
+    # Without unique lines to anchor on, the work is bounded
+    a = [r.randrange(2) for _ in range(2000)]
+    b = [r.randrange(2) for _ in range(2000)]
+    assert matching_blocks(a, b, budget=1000) is None
+
+
+def test_grouped_opcodes():
+    r = random.Random(0)
+    for _ in range(500):
+        a = [r.randrange(3) for _ in range(r.randrange(30))]
+        b = [r.randrange(3) for _ in range(r.randrange(30))]
+        matcher = difflib.SequenceMatcher(None, a, b)
+        assert grouped_opcodes(matcher.get_opcodes()) == \
+            list(matcher.get_grouped_opcodes(3))
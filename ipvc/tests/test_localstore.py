@@ -0,0 +1,118 @@
+import io
+import os
+import shutil
+
+import pytest
+import ipfsapi
+
+import ipvc.localstore
+from ipvc.dag import MAX_FILE_LINKS, MAX_LEAF_SIZE
+from ipvc.localstore import LocalBackend
+
+STORE = '/tmp/ipvc_test_localstore'
+HELLO_HASH = 'QmT78zSuBmuS4z925WZfrqQ1qHaJ56DQaTfyMUF7F8ff5o'
+
+
+def get_backend():
+    shutil.rmtree(STORE, ignore_errors=True)
+    ipvc.localstore._STORES.clear()
+    return LocalBackend(STORE)
+
+
+def test_mfs():
+    ipfs = get_backend()
+    ipfs.files_mkdir('/a/b', parents=True)
+    ipfs.files_write('/a/b/hello', io.BytesIO(b'hello world\n'), create=True)
+    assert ipfs.files_stat('/a/b/hello')['Hash'] == HELLO_HASH
+    assert ipfs.files_read('/a/b/hello') == b'hello world\n'
+    assert ipfs.cat(HELLO_HASH) == b'hello world\n'
+
+    ipfs.files_cp('/a/b', '/a/c')
+    assert ipfs.files_stat('/a/c')['Hash'] == ipfs.files_stat('/a/b')['Hash']
+    ipfs.files_write('/a/c/hello', io.BytesIO(b'j'), offset=6)
+    assert ipfs.files_read('/a/c/hello') == b'hello jorld\n'
+    assert ipfs.files_read('/a/b/hello') == b'hello world\n'
+    assert [e['Name'] for e in ipfs.files_ls('/a')['Entries']] == ['b', 'c']
+
+    with pytest.raises(ipfsapi.exceptions.StatusError):
+        ipfs.files_cp('/a/b', '/a/c')
+    with pytest.raises(ipfsapi.exceptions.StatusError):
+        ipfs.files_rm('/a/c')
+    ipfs.files_rm('/a/c', recursive=True)
+    with pytest.raises(ipfsapi.exceptions.StatusError):
+        ipfs.files_stat('/a/c')
+
+
+def test_object_diff():
+    ipfs = get_backend()
+    ipfs.files_mkdir('/a/b', parents=True)
+    ipfs.files_write('/a/b/hello', io.BytesIO(b'hello world\n'), create=True)
+    ipfs.files_write('/a/removed', io.BytesIO(b'removed'), create=True)
+    before = ipfs.files_stat('/a')['Hash']
+    ipfs.files_write('/a/b/hello', io.BytesIO(b'hello'), truncate=True)
+    ipfs.files_rm('/a/removed')
+    ipfs.files_write('/a/added', io.BytesIO(b'added'), create=True)
+    after = ipfs.files_stat('/a')['Hash']
+
+    changes = {c['Path']: c for c in ipfs.object_diff(before, after)['Changes']}
+    assert changes['b/hello']['Type'] == 2
+    assert changes['b/hello']['Before'] == {'/': HELLO_HASH}
+    assert changes['removed']['Type'] == 1 and changes['removed']['After'] is None
+    assert changes['added']['Type'] == 0 and changes['added']['Before'] is None
+    assert ipfs.object_diff(after, after)['Changes'] == []
+
+
+def test_large_file():
+    ipfs = get_backend()
+    # Enough chunks for two levels of internal nodes
+    data = os.urandom(MAX_LEAF_SIZE * (MAX_FILE_LINKS + 1) + 10)
+    h = ipfs.add_bytes(data)
+    assert ipfs.object_stat(h)['NumLinks'] == 2
+    links = ipfs.object_links(h)['Links']
+    assert len(links) == 2 and links[0]['Size'] > MAX_LEAF_SIZE * MAX_FILE_LINKS
+    assert ipfs.cat(h) == data
+
+    ipfs.files_cp(f'/ipfs/{h}', '/large')
+    assert ipfs.files_stat('/large')['Size'] == len(data)
+    offset = MAX_LEAF_SIZE * MAX_FILE_LINKS - 5
+    assert ipfs.files_read('/large', offset=offset, count=20) == \
+        data[offset:offset + 20]
+
+
+def test_flush():
+    get_backend()
+    ipfs = LocalBackend(STORE, is_deferred=lambda: True)
+    ipfs.files_write('/persisted', io.BytesIO(b'hello world\n'), create=True)
+    ipfs.files_flush()
+    ipfs.files_write('/not_persisted', io.BytesIO(b'hello world\n'), create=True)
+
+    ipvc.localstore._STORES.clear()
+    ipfs = LocalBackend(STORE)
+    assert ipfs.files_stat('/persisted')['Hash'] == HELLO_HASH
+    with pytest.raises(ipfsapi.exceptions.StatusError):
+        ipfs.files_stat('/not_persisted')
+
+
+def test_shared_store():
+    # Backends with their own copy of the store, as in separate processes
+    get_backend()
+    ipfs1 = LocalBackend(STORE)
+    ipvc.localstore._STORES.clear()
+    deferred = False
+    ipfs2 = LocalBackend(STORE, is_deferred=lambda: deferred)
+
+    # Changes flushed by one are picked up by the other
+    ipfs1.files_write('/a', io.BytesIO(b'hello world\n'), create=True)
+    assert ipfs2.files_stat('/a')['Hash'] == HELLO_HASH
+    ipfs2.files_write('/b', io.BytesIO(b'hello world\n'), create=True)
+    assert ipfs1.files_stat('/b')['Hash'] == HELLO_HASH
+
+    # Changes made on a root that has since been replaced fail to flush
+    deferred = True
+    ipfs2.files_rm('/a')
+    ipfs1.files_write('/c', io.BytesIO(b'hello world\n'), create=True)
+    deferred = False
+    with pytest.raises(ipfsapi.exceptions.ErrorResponse):
+        ipfs2.files_flush()
+    assert ipfs2.files_stat('/a')['Hash'] == HELLO_HASH
+    assert ipfs2.files_stat('/c')['Hash'] == HELLO_HASH
@@ -0,0 +1,40 @@
+import time
+import shutil
+
+from ipvc.object_cache import ObjectCache
+from helpers import CACHE, write_file
+
+
+def test_get_put():
+    shutil.rmtree(CACHE, ignore_errors=True)
+    CACHE.mkdir(parents=True)
+    cache = ObjectCache(CACHE / 'objects', 1000)
+
+    write_file(CACHE / 'file.txt', 'hello world')
+    assert cache.get('QmHash', CACHE / 'out.txt') == False
+    cache.put('QmHash', CACHE / 'file.txt')
+    assert cache.get('QmHash', CACHE / 'out.txt') == True
+    assert open(CACHE / 'out.txt', 'r').read() == 'hello world'
+
+    assert cache.get_bytes('QmHash2') is None
+    cache.put_bytes('QmHash2', b'hello bytes')
+    assert cache.get_bytes('QmHash2') == b'hello bytes'
+
+
+def test_lru_eviction():
+    shutil.rmtree(CACHE, ignore_errors=True)
+    CACHE.mkdir(parents=True)
+    cache = ObjectCache(CACHE / 'objects', 25)
+
+    for i in range(3):
+        write_file(CACHE / f'file{i}.txt', 'x'*10)
+        cache.put(f'QmHash{i}', CACHE / f'file{i}.txt')
+        time.sleep(0.01)
+        if i == 1:
+            # Use the first object so that the second one is evicted instead
+            assert cache.get('QmHash0', CACHE / 'out.txt')
+            time.sleep(0.01)
+
+    assert cache.get('QmHash0', CACHE / 'out.txt') == True
+    assert cache.get('QmHash1', CACHE / 'out.txt') == False
+    assert cache.get('QmHash2', CACHE / 'out.txt') == True
@@ -5,7 +5,8 @@ import pytest
 from pathlib import Path
 
 from ipvc import IPVC
-from helpers import NAMESPACE, REPO, REPO2, get_environment, write_file
+from helpers import (
+    BACKEND, NAMESPACE, REPO, REPO2, STORE, get_environment, write_file)
 
 
 def test_init_and_ls():
@@ -52,7 +53,8 @@ def test_mv_rm():
         ipvc.repo.mv(REPO, REPO)
 
     with pytest.raises(RuntimeError):
-        IPVC(Path('/'), NAMESPACE).repo.mv(REPO, None)
+        IPVC(Path('/'), NAMESPACE, backend=BACKEND,
+             store_dir=STORE).repo.mv(REPO, None)
     assert ipvc.repo.mv(REPO, REPO2) == True
     assert not REPO.exists()
     assert REPO2.exists()
@@ -73,6 +75,33 @@ def test_mv_rm():
     assert h is None # should not exist on MFS
 
 
+def test_repo_registry():
+    ipvc = get_environment(mkdirs=False)
+    root = REPO.parent
+    for i in range(10):
+        (root / f'repo{i}').mkdir(parents=True)
+        ipvc.set_cwd(root / f'repo{i}')
+        ipvc.repo.init(name=f'repo{i}')
+    ipvc.repo.mv(root / 'repo0', root / 'moved')
+    ipvc.set_cwd(root / 'repo1')
+    ipvc.repo.rm()
+
+    # Finding the repo of a path reads the registry once, however many repos
+    # there are
+    ipvc = IPVC(root / 'repo5/a/b/c', NAMESPACE, backend=BACKEND,
+                store_dir=STORE, persist_properties=False)
+    assert ipvc.repo.fs_repo_root == root / 'repo5'
+    assert sum(ipvc.tracer.call_counts.values()) == 1
+    assert ipvc.repo.get_repo_root(root) is None
+    assert ipvc.repo.get_repo_root(root / 'repo1') is None
+    assert ipvc.repo.get_repo_root(root / 'moved/x') == root / 'moved'
+
+    repos = ipvc.repo.repos
+    assert [path for _, _, path in repos] == (
+        [str(root / 'moved')] + [str(root / f'repo{i}') for i in range(2, 10)])
+    assert repos[0][0] == 'repo0'
+
+
 def test_clone():
     ipvc = get_environment()
     ipvc.repo.init(name='myrepo')
@@ -88,3 +117,76 @@ def test_clone():
     ipvc.repo.clone(f'{id1}/myrepo')
     with open(test_file, 'r') as f:
         assert f.read() == 'hello world'
+
+
+def test_worktree():
+    ipvc = get_environment()
+    ipvc.repo.init()
+    test_file = REPO / 'test_file.txt'
+    write_file(test_file, 'hello world')
+    ipvc.stage.add(test_file)
+    ipvc.stage.commit(message='msg')
+    ipvc.branch.create('other', no_checkout=True)
+
+    # The same branch can't be checked out in two worktrees
+    with pytest.raises(RuntimeError):
+        ipvc.repo.worktree(REPO2, branch='master')
+
+    assert ipvc.repo.worktree(REPO2, branch='other') == REPO2
+    with open(REPO2 / 'test_file.txt', 'r') as f:
+        assert f.read() == 'hello world'
+    assert ipvc.repo.worktree() == [REPO, REPO2]
+
+    # Commits made in the worktree are visible from the main repo
+    ipvc.set_cwd(REPO2)
+    write_file(REPO2 / 'test_file.txt', 'other text')
+    ipvc.stage.add(REPO2 / 'test_file.txt')
+    ipvc.stage.commit(message='msg2')
+    assert ipvc.branch.active_branch == 'other'
+
+    ipvc.set_cwd(REPO)
+    assert ipvc.branch.active_branch == 'master'
+    with pytest.raises(RuntimeError):
+        ipvc.branch.checkout('other')
+
+    with pytest.raises(RuntimeError):
+        ipvc.repo.rm(REPO)
+    assert ipvc.repo.rm(REPO2) == True
+    assert ipvc.repo.worktree() == [REPO]
+
+    ipvc.branch.checkout('other')
+    with open(test_file, 'r') as f:
+        assert f.read() == 'other text'
+
+
+def test_migrate():
+    ipvc = get_environment()
+    ipvc.repo.init()
+    for i in range(3):
+        write_file(REPO / 'test_file.txt', f'hello world {i}')
+        ipvc.stage.add()
+        ipvc.stage.commit(f'commit {i}')
+    commits_v1 = ipvc.branch.history()
+
+    mapping = ipvc.repo.migrate(2)
+    assert len(mapping) == 3
+    commits_v2 = ipvc.branch.history()
+    assert len(commits_v2) == 3
+    assert [mapping[h] for h, _, _ in commits_v1] == [h for h, _, _ in commits_v2]
+
+    metadata = ipvc.branch.get_commit_metadata(commits_v2[0][0])
+    assert metadata['format'] == 2
+    assert metadata['parent'] == commits_v2[1][0]
+    assert metadata['message'] == 'commit 2'
+    assert len(ipvc.branch.verify()) == 3
+
+    # New commits use the new format, and migrating again changes nothing
+    write_file(REPO / 'test_file.txt', 'hello world 3')
+    ipvc.stage.add()
+    head = ipvc.stage.commit('commit 3')
+    assert ipvc.branch.get_commit_metadata(head)['format'] == 2
+    assert ipvc.repo.migrate(2) == {}
+
+    # Migrate back
+    assert len(ipvc.repo.migrate(1)) == 4
+    assert 'format' not in ipvc.branch.get_commit_metadata(ipvc.branch.history()[0][0])
@@ -0,0 +1,24 @@
+import pytest
+from Crypto.PublicKey import RSA
+
+from ipvc.signing import RSASigner, Ed25519Signer, verify
+
+
+def test_rsa():
+    signer = RSASigner(RSA.generate(1024).exportKey('PEM'))
+    signature = signer.sign(b'QmHash')
+    assert verify(signer.pub_key_pem, b'QmHash', signature)
+    assert not verify(signer.pub_key_pem, b'QmOther', signature)
+
+
+def test_ed25519():
+    pytest.importorskip('cryptography')
+    signer = Ed25519Signer(bytes(range(64)))
+    signature = signer.sign(b'QmHash')
+    assert signature.startswith('ed25519:')
+    assert verify(signer.pub_key_pem, b'QmHash', signature)
+    assert not verify(signer.pub_key_pem, b'QmOther', signature)
+
+    # RSA and Ed25519 signatures can't be confused for each other
+    rsa_signer = RSASigner(RSA.generate(1024).exportKey('PEM'))
+    assert not verify(rsa_signer.pub_key_pem, b'QmHash', signature)
@@ -0,0 +1,17 @@
+from ipvc.similarity import line_features, similar_pairs
+
+
+def test_similar_pairs():
+    lines = [f'line {i}'.encode('utf-8') for i in range(100)]
+    removed = {
+        'a': line_features(b'\n'.join(lines)),
+        'b': line_features(b'\n'.join(lines[:10])),
+    }
+    added = {
+        'edited': line_features(b'\n'.join(lines[:90] + [b'new'] * 10)),
+        'unrelated': line_features(b'\n'.join(l + b'!' for l in lines)),
+        'empty': set(),
+    }
+    pairs = similar_pairs(removed, added, 0.5)
+    assert [(a, b) for _, a, b in pairs] == [('a', 'edited')]
+    assert 0.85 < pairs[0][0] < 0.95
@@ -0,0 +1,52 @@
+import os
+import sys
+import subprocess
+
+from helpers import STORE
+
+# Budgets for the time spent importing modules when running a command, in
+# seconds. They are generous, the modules that must not be imported are what
+# catches regressions
+VERSION_IMPORT_BUDGET = 0.15
+BRANCH_LS_IMPORT_BUDGET = 1.0
+# Slow to import modules that are only needed by some commands
+DEFERRED_MODULES = {'Crypto', 'crypto_pb2', 'webbrowser', 'cProfile'}
+
+
+def run_importtime(*args):
+    """ Runs the CLI with `args` and returns the names of the imported
+    modules, and the time spent importing ipvc modules in seconds """
+    code = (f'import sys; sys.argv = ["ipvc"] + {list(args)!r}; import ipvc; '
+            f'ipvc.main(); print("MODULES", *sys.modules, file=sys.stderr)')
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    ret = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                         cwd='/tmp', env=env)
+    modules, total = set(), 0
+    for line in ret.stderr.decode('utf-8').splitlines():
+        if line.startswith('MODULES'):
+            modules = set(line.split()[1:])
+        elif line.startswith('import time:') and 'cumulative' not in line:
+            _, cumulative, name = line[len('import time:'):].split('|')
+            # Modules imported at the top level have a single space of
+            # indentation
+            if name.startswith(' ipvc'):
+                total += int(cumulative) / 1e6
+    return modules, total
+
+
+def test_version():
+    modules, total = run_importtime('version')
+    assert total < VERSION_IMPORT_BUDGET
+    assert 'ipvc.ipvc_api' not in modules
+    assert 'ipfsapi' not in modules
+    assert not DEFERRED_MODULES & modules
+
+
+def test_branch_ls():
+    modules, total = run_importtime('--backend', 'local', '--store-dir',
+                                    str(STORE), 'branch', 'ls')
+    assert 'ipvc.branch' in modules
+    assert total < BRANCH_LS_IMPORT_BUDGET
+    assert not {'ipvc.stage', 'ipvc.diff', 'ipvc.id', 'ipvc.aioipfs'} & modules
+    assert not DEFERRED_MODULES & modules
@@ -0,0 +1,72 @@
+import os
+import sys
+import random
+import subprocess
+import pytest
+
+from ipvc.tabular import diff_tables, format_summary
+
+
+def _lines(rows):
+    return [','.join(row).encode('utf-8') for row in rows]
+
+
+@pytest.mark.parametrize('num_partitions', [1, 7])
+def test_diff_tables(num_partitions):
+    rows = [[str(i), f'name {i}', str(i * 10)] for i in range(1000)]
+    from_lines = _lines([['id', 'name', 'value']] + rows)
+    rows = [list(row) for row in rows]
+    rows[5][2] = 'changed'
+    rows[6][1], rows[6][2] = 'renamed', '0'
+    del rows[7]
+    rows.append(['1000', 'new', '1'])
+    random.Random(0).shuffle(rows)
+    to_lines = _lines([['id', 'name', 'value']] + rows)
+
+    stats = {}
+    out = list(diff_tables(from_lines, to_lines, ['id'], ',', num_partitions, stats))
+    # Changes are in order of key, however many partitions there are
+    assert out == [
+        '+ id=1000: 1000,new,1',
+        "~ id=5: value: '50' -> 'changed'",
+        "~ id=6: name: 'name 6' -> 'renamed'; value: '60' -> '0'",
+        '- id=7: 7,name 7,70',
+    ]
+    assert stats == {'added': 1, 'removed': 1, 'changed': 2, 'cells': 3}
+    assert format_summary(['id'], stats) == \
+        'rows by id: 1 added, 1 removed, 2 changed (3 cells)'
+
+
+def test_diff_tables_columns():
+    from_lines = [b'a\tb\tc', b'1\tx\t"multi', b'line"', b'2\ty\tz']
+    to_lines = [b'b\ta\td', b'y\t2\tnew', b'x\t1\t']
+    out = list(diff_tables(from_lines, to_lines, ['a'], '\t'))
+    assert out == ['column removed: c', 'column added: d']
+
+    # Quoted values can span lines
+    out = list(diff_tables(from_lines, [b'a\tc', b'1\tmulti', b'2\tz'], ['a'], '\t'))
+    assert out == ['column removed: b', "~ a=1: c: 'multi\\nline' -> 'multi'"]
+
+    with pytest.raises(ValueError):
+        list(diff_tables(from_lines, to_lines, ['c'], '\t'))
+    with pytest.raises(ValueError):
+        list(diff_tables(from_lines, [b'a\tb', b'1\tx', b'1\ty'], ['a'], '\t'))
+
+
+def test_diff_tables_hash_seed():
+    # The output doesn't depend on the hash seed of the process
+    code = (
+        'from ipvc.tabular import diff_tables\n'
+        'rows = [[str(i), str(i % 7)] for i in range(500)]\n'
+        'from_lines = [",".join(r).encode() for r in [["id", "v"]] + rows]\n'
+        'to_lines = [",".join(r).encode() for r in [["id", "v"]] + rows[::2]]\n'
+        'print("\\n".join(diff_tables(from_lines, to_lines, ["v", "id"], ",", 5)))')
+    outputs = set()
+    for seed in ['1', '2', '3']:
+        env = dict(os.environ, PYTHONHASHSEED=seed,
+                   PYTHONPATH=os.pathsep.join(sys.path))
+        outputs.add(subprocess.run([sys.executable, '-c', code], env=env,
+                                   stdout=subprocess.PIPE, check=True).stdout)
+    assert len(outputs) == 1
+    lines = outputs.pop().decode('utf-8').splitlines()
+    assert len(lines) == 250 and lines == sorted(lines, key=lambda l: l.split(': ')[0])
@@ -0,0 +1,56 @@
+import json
+from pathlib import Path
+
+from ipvc import IPVC
+from ipvc.trace import Tracer, traced_call
+from helpers import NAMESPACE, REPO, CACHE, BACKEND, STORE, get_environment, write_file
+
+TRACE = Path('/tmp/ipvc_trace.json')
+
+
+def test_tracer():
+    tracer = Tracer(enabled=True)
+    double = traced_call(tracer, 'double', lambda x: 2 * x)
+    with tracer.span('outer', answer=42):
+        for i in range(10):
+            assert double(i) == 2 * i
+
+    summary = tracer.summary()
+    assert summary['calls']['double']['count'] == 10
+    assert sum(summary['calls']['double']['histogram'].values()) == 10
+    assert summary['spans']['outer']['count'] == 1
+    events = [e for e in tracer.events if e['name'] == 'double']
+    assert [e['args']['path'] for e in events] == [str(i) for i in range(10)]
+    outer, = [e for e in tracer.events if e['name'] == 'outer']
+    assert outer['args'] == {'answer': 42}
+    # Calls are nested within the outer span
+    assert all(outer['ts'] <= e['ts'] and
+               e['ts'] + e['dur'] <= outer['ts'] + outer['dur'] for e in events)
+
+
+def test_disabled():
+    tracer = Tracer()
+    double = traced_call(tracer, 'double', lambda x: 2 * x)
+    with tracer.span('outer'):
+        double(1)
+    assert tracer.call_counts['double'] == 1
+    assert tracer.events == []
+
+
+def test_trace_api():
+    get_environment()
+    ipvc = IPVC(REPO, NAMESPACE, cache_dir=CACHE, backend=BACKEND,
+                store_dir=STORE, trace=True)
+    ipvc.repo.init()
+    write_file(REPO / 'test_file.txt', 'hello world')
+    ipvc.stage.add(REPO / 'test_file.txt')
+    ipvc.stage.commit('msg')
+    ipvc.tracer.export_chrome(TRACE)
+
+    with open(TRACE) as f:
+        trace = json.load(f)
+    names = set(e['name'] for e in trace['traceEvents'])
+    assert {'RepoAPI.init', 'StageAPI.add', 'StageAPI.commit',
+            'CommonAPI.add_fs_to_mfs', 'files_cp'} <= names
+    assert trace['otherData']['calls']['files_cp']['count'] > 0
+    assert 'files_cp' in ipvc.tracer.format_summary()
@@ -0,0 +1,67 @@
+import os
+import json
+import asyncio
+import tempfile
+import threading
+import socketserver
+from http.server import BaseHTTPRequestHandler
+
+import pytest
+
+from ipvc.aioipfs import AsyncIPFSClient
+from ipvc.transport import keep_alive_session, parse_ipfs_ip
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        body = json.dumps({'Path': self.path}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super().get_request()
+        return request, ('unix', 0)
+
+
+def test_parse_ipfs_ip():
+    assert parse_ipfs_ip(None) == (None, None, None)
+    assert parse_ipfs_ip('127.0.0.1:5002') == ('127.0.0.1', 5002, None)
+    assert parse_ipfs_ip('localhost:') == ('localhost', None, None)
+    assert parse_ipfs_ip('unix:/tmp/api.sock') == (None, None, '/tmp/api.sock')
+    with pytest.raises(ValueError):
+        parse_ipfs_ip('unix:')
+    with pytest.raises(ValueError):
+        parse_ipfs_ip('localhost')
+
+
+def test_unix_socket():
+    socket_path = os.path.join(tempfile.mkdtemp(), 'api.sock')
+    server = UnixServer(socket_path, StandInHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    session = keep_alive_session(socket_path)
+    for i in range(3):
+        res = session.post(f'http://localhost:5001/api/v0/files/stat?arg=/{i}')
+        assert res.json()['Path'] == f'/api/v0/files/stat?arg=/{i}'
+    # All requests went over the same connection
+    assert session.get_adapter('http://').pool.num_connections == 1
+
+    client = AsyncIPFSClient(socket_path=socket_path)
+    async def _run():
+        stats = await asyncio.gather(*[client.files_stat(f'/{i}') for i in range(4)])
+        await client.close()
+        return stats
+    assert len(asyncio.run(_run())) == 4
+    server.shutdown()
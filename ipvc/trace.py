@@ -0,0 +1,187 @@
+"""
+Span based tracing of ipvc. API methods and their phases are recorded as
+nested spans, and every call to the storage backend as a span with its path
+argument. Traces are exported in the Chrome trace event format, which can be
+opened in chrome://tracing or https://ui.perfetto.dev, along with a summary
+of backend call latencies.
+
+When tracing is disabled, spans are no-ops and backend calls are only
+counted and timed in total per method
+"""
+import os
+import json
+import asyncio
+import threading
+from time import perf_counter_ns
+from functools import wraps
+from collections import defaultdict
+from contextlib import nullcontext
+
+_NULL_SPAN = nullcontext()
+
+
+class Span:
+    def __init__(self, tracer, name, cat, args):
+        self.tracer = tracer
+        self.name = name
+        self.cat = cat
+        self.args = args
+
+    def __enter__(self):
+        self.start = perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        self.tracer.add_span(self.name, self.cat, self.start,
+                             perf_counter_ns(), self.args)
+
+
+class Tracer:
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.call_counts = defaultdict(int)
+        self.call_seconds = defaultdict(float)
+        self.events = []
+        # Durations in ns per backend method, for percentiles and histograms
+        self.call_durations = defaultdict(list)
+        self.span_durations = defaultdict(list)
+        self._origin = perf_counter_ns()
+        self._async_id = 0
+        self._lock = threading.Lock()
+
+    def span(self, name, cat='ipvc', **args):
+        """ Returns a context manager that records a span """
+        if not self.enabled:
+            return _NULL_SPAN
+        return Span(self, name, cat, args)
+
+    def add_span(self, name, cat, start, end, args=None, is_async=False):
+        self.span_durations[name].append(end - start)
+        event = {'name': name, 'cat': cat, 'pid': os.getpid(),
+                 'ts': (start - self._origin) / 1000}
+        if args:
+            event['args'] = args
+        if is_async:
+            # Concurrent calls on the event loop overlap, so they are recorded
+            # as async events, which are drawn on separate tracks
+            with self._lock:
+                self._async_id += 1
+                event_id = self._async_id
+            self.events.append(dict(event, ph='b', id=event_id, tid=0))
+            self.events.append({'name': name, 'cat': cat, 'ph': 'e', 'id': event_id,
+                                'pid': event['pid'], 'tid': 0,
+                                'ts': (end - self._origin) / 1000})
+        else:
+            self.events.append(dict(event, ph='X', dur=(end - start) / 1000,
+                                    tid=threading.get_ident()))
+
+    def record_call(self, name, args, start, end, is_async=False):
+        self.call_counts[name] += 1
+        self.call_seconds[name] += (end - start) / 1e9
+        if self.enabled:
+            self.call_durations[name].append(end - start)
+            span_args = {'path': str(args[0])} if len(args) > 0 else None
+            self.add_span(name, 'ipfs', start, end, span_args, is_async)
+
+    def reset(self):
+        self.call_counts.clear()
+        self.call_seconds.clear()
+        self.events = []
+        self.call_durations.clear()
+        self.span_durations.clear()
+
+    def summary(self):
+        """ Returns latency statistics per backend method, with a histogram
+        of durations in power of two buckets of microseconds, and the count
+        and total duration of each kind of span """
+        calls = {}
+        for name, durations in self.call_durations.items():
+            durations = sorted(durations)
+            histogram = defaultdict(int)
+            for d in durations:
+                histogram[f'<{2 ** (d // 1000).bit_length()}us'] += 1
+            calls[name] = {
+                'count': len(durations),
+                'total_ms': sum(durations) / 1e6,
+                'mean_ms': sum(durations) / len(durations) / 1e6,
+                'p50_ms': _percentile(durations, 50) / 1e6,
+                'p90_ms': _percentile(durations, 90) / 1e6,
+                'p99_ms': _percentile(durations, 99) / 1e6,
+                'max_ms': durations[-1] / 1e6,
+                'histogram': dict(histogram),
+            }
+        spans = {name: {'count': len(durations), 'total_ms': sum(durations) / 1e6}
+                 for name, durations in self.span_durations.items()
+                 if name not in self.call_durations}
+        return {'calls': calls, 'spans': spans}
+
+    def format_summary(self):
+        summary = self.summary()
+        lines = [f'{"call":<16}{"count":>8}{"total ms":>12}{"mean ms":>10}'
+                 f'{"p50 ms":>10}{"p90 ms":>10}{"p99 ms":>10}{"max ms":>10}']
+        for name, s in sorted(summary['calls'].items(),
+                              key=lambda item: -item[1]['total_ms']):
+            lines.append(f'{name:<16}{s["count"]:>8}{s["total_ms"]:>12.2f}'
+                         f'{s["mean_ms"]:>10.3f}{s["p50_ms"]:>10.3f}'
+                         f'{s["p90_ms"]:>10.3f}{s["p99_ms"]:>10.3f}{s["max_ms"]:>10.3f}')
+        lines.append('')
+        lines.append(f'{"span":<48}{"count":>8}{"total ms":>12}')
+        for name, s in sorted(summary['spans'].items(),
+                              key=lambda item: -item[1]['total_ms']):
+            lines.append(f'{name:<48}{s["count"]:>8}{s["total_ms"]:>12.2f}')
+        return '\n'.join(lines)
+
+    def export_chrome(self, path):
+        """ Writes the trace in the Chrome trace event format, with the
+        summary under 'otherData' """
+        threads = sorted(set(e['tid'] for e in self.events if e['ph'] == 'X'))
+        metadata = [{'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(),
+                     'tid': tid, 'args': {'name': f'thread {i}'}}
+                    for i, tid in enumerate(threads)]
+        metadata.append({'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(),
+                         'tid': 0, 'args': {'name': 'async'}})
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': metadata + self.events,
+                       'displayTimeUnit': 'ms',
+                       'otherData': self.summary()}, f)
+
+
+def _percentile(sorted_values, percent):
+    index = min(len(sorted_values) - 1, len(sorted_values) * percent // 100)
+    return sorted_values[index]
+
+
+def traced_call(tracer, name, method):
+    """ Wraps a backend method to record its calls """
+    if asyncio.iscoroutinefunction(method):
+        @wraps(method)
+        async def _async_impl(*args, **kwargs):
+            start = perf_counter_ns()
+            try:
+                return await method(*args, **kwargs)
+            finally:
+                tracer.record_call(name, args, start, perf_counter_ns(), True)
+        return _async_impl
+
+    @wraps(method)
+    def _impl(*args, **kwargs):
+        start = perf_counter_ns()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            tracer.record_call(name, args, start, perf_counter_ns())
+    return _impl
+
+
+def traced(method):
+    """ Records calls to a method of the API classes as spans """
+    name = method.__qualname__
+
+    @wraps(method)
+    def _impl(self, *args, **kwargs):
+        tracer = self.ipvc.tracer
+        if not tracer.enabled:
+            return method(self, *args, **kwargs)
+        with Span(tracer, name, 'ipvc', None):
+            return method(self, *args, **kwargs)
+    return _impl
@@ -0,0 +1,101 @@
+"""
+Transports for the connection to the IPFS daemon API. The ipfsapi client
+opens a new connection for every request unless it is given a session, so we
+always give it a requests session that keeps connections alive, optionally
+over a Unix domain socket instead of TCP
+"""
+import socket
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from urllib3.connectionpool import HTTPConnectionPool
+
+import ipfsapi
+
+# Scheme prefix of --ipfs-ip for connecting over a Unix domain socket
+UNIX_PREFIX = 'unix:'
+# Number of connections to keep alive, enough for the thread pools in ipvc
+POOL_SIZE = 16
+
+
+class UnixHTTPConnection(HTTPConnection):
+    def __init__(self, socket_path, *args, **kwargs):
+        super().__init__('localhost', *args, **kwargs)
+        self.socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if isinstance(self.timeout, (int, float)):
+            sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+
+class UnixHTTPConnectionPool(HTTPConnectionPool):
+    def __init__(self, socket_path, maxsize):
+        super().__init__('localhost', maxsize=maxsize, block=False)
+        self.socket_path = socket_path
+
+    def _new_conn(self):
+        self.num_connections += 1
+        return UnixHTTPConnection(
+            self.socket_path, timeout=self.timeout.connect_timeout)
+
+
+class UnixHTTPAdapter(HTTPAdapter):
+    """ Sends all requests of a session to the socket at `socket_path`,
+    regardless of the host in the url """
+    def __init__(self, socket_path, pool_size=POOL_SIZE):
+        super().__init__(pool_connections=1, pool_maxsize=pool_size)
+        self.socket_path = socket_path
+        self.pool = UnixHTTPConnectionPool(socket_path, pool_size)
+
+    def get_connection(self, url, proxies=None):
+        return self.pool
+
+    def get_connection_with_tls_context(self, request, verify, proxies=None, cert=None):
+        return self.pool
+
+    def close(self):
+        self.pool.close()
+        super().close()
+
+
+def keep_alive_session(socket_path=None, pool_size=POOL_SIZE):
+    session = requests.Session()
+    # The daemon is local, so skip looking up proxy settings and .netrc
+    # files from the environment on every request
+    session.trust_env = False
+    if socket_path is None:
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    else:
+        adapter = UnixHTTPAdapter(socket_path, pool_size)
+    session.mount('http://', adapter)
+    return session
+
+
+def parse_ipfs_ip(ipfs_ip):
+    """ Parses the --ipfs-ip argument into (host, port, socket_path), where
+    host and port are None if not given, and socket_path is None for TCP.
+    Raises ValueError if it's not on the right format """
+    if ipfs_ip is None:
+        return None, None, None
+    if ipfs_ip.startswith(UNIX_PREFIX):
+        socket_path = ipfs_ip[len(UNIX_PREFIX):]
+        if len(socket_path) == 0:
+            raise ValueError(ipfs_ip)
+        return None, None, socket_path
+
+    host, port = ipfs_ip.split(':')
+    return host, (int(port) if len(port) > 0 else None), None
+
+
+def connect(host=None, port=None, socket_path=None):
+    """ Like ipfsapi.connect, but with connections kept alive, and over a Unix
+    domain socket if `socket_path` is given """
+    args = [arg for arg in [host, port] if arg is not None]
+    client = ipfsapi.Client(*args)
+    client._client._session = keep_alive_session(socket_path)
+    ipfsapi.assert_version(client.version()['Version'])
+    return client